@@ -0,0 +1,130 @@
+"""
+BaiduOCR.parse_vat_invoice 商品行合并基准
+
+先以 benchmarks/fixtures/baidu_vat 下保存的 words_result 校验当前实现与旧实现
+(逐单元格复制并补齐各列后切片拼接) 结果一致, 再以 P 页 x R 行的合成结果对比 CPU 时间与内存峰值.
+
+    python benchmarks/bench_baidu_parser.py [--pages 20] [--rows 300]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.invoice import InvoiceItem  # noqa: E402
+from core.invoice.baidu_ocr import BaiduOCR  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "baidu_vat")
+
+ALL_LISTS = ("CommodityName", "CommodityType", "CommodityUnit", "CommodityNum",
+             "CommodityPrice", "CommodityAmount", "CommodityTaxRate", "CommodityTax")
+
+
+def legacy_merge(results):
+    """旧实现中 parse_vat_invoice 的商品行合并部分"""
+    next_row_index = 0
+    items = {key: [] for key in ALL_LISTS}
+    for page in results:
+        cache = {}
+        max_row = 0
+        for key in ALL_LISTS:
+            cache[key] = page.get(key, [])
+            if cache[key]:
+                max_row = max(int(cache[key][-1]["row"]), max_row)
+        for key in ALL_LISTS:
+            for i in cache[key]:
+                items[key].append({**i, "row": str(int(i["row"]) + next_row_index)})
+        next_row_index += max_row
+
+    format_str_list = {}
+    for key in ALL_LISTS:
+        format_str_list[key] = []
+        index = 0
+        for i in items[key]:
+            while index < int(i["row"]):
+                format_str_list[key].append("")
+                index += 1
+            format_str_list[key].append(i["word"])
+            index += 1
+
+    items_start_row_index = [int(i["row"]) for i in items["CommodityAmount"]]
+    items_start_row_index.append(int(next_row_index) + 1)
+    splice_string = lambda str_list, start, end: "".join(str_list[start:end])
+    merged = []
+    for i in range(len(items_start_row_index) - 1):
+        item = InvoiceItem()
+        start, end = items_start_row_index[i], items_start_row_index[i + 1]
+        item.set_name(splice_string(format_str_list["CommodityName"], start, end))
+        item.set_type(splice_string(format_str_list["CommodityType"], start, end))
+        item.set_unit(splice_string(format_str_list["CommodityUnit"], start, end))
+        item.set_num(splice_string(format_str_list["CommodityNum"], start, end))
+        item.set_unit_price(splice_string(format_str_list["CommodityPrice"], start, end))
+        item.set_amount(splice_string(format_str_list["CommodityAmount"], start, end))
+        item.set_tax_rate(splice_string(format_str_list["CommodityTaxRate"], start, end))
+        item.set_tax(splice_string(format_str_list["CommodityTax"], start, end))
+        merged.append(item)
+    return merged
+
+
+def synthetic_results(pages, rows):
+    """每页 rows 行, 每个商品名称折行占两行, 其余列只在起始行出现"""
+    results = []
+    for _ in range(pages):
+        page = {key: [] for key in ALL_LISTS}
+        for row in range(1, rows + 1, 2):
+            page["CommodityName"].append({"row": str(row), "word": "*办公用品*签字笔黑色0.5mm"})
+            page["CommodityName"].append({"row": str(row + 1), "word": "替芯"})
+            for key, word in (("CommodityType", "0.5mm"), ("CommodityUnit", "支"),
+                              ("CommodityNum", "10"), ("CommodityPrice", "1.5"),
+                              ("CommodityAmount", "15.00"), ("CommodityTaxRate", "13%"),
+                              ("CommodityTax", "1.95")):
+                page[key].append({"row": str(row), "word": word})
+        results.append(page)
+    return results
+
+
+def validate():
+    paths = sorted(glob.glob(os.path.join(FIXTURES, "*.json")))
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            results = json.load(f)["words_result"]
+        expected = [item.data for item in legacy_merge(results)]
+        invoice = BaiduOCR.parse_vat_invoice(results)
+        if invoice.items != expected:
+            raise AssertionError(f"{os.path.basename(path)}: {invoice.items} != {expected}")
+        print(f"ok {os.path.basename(path)} ({len(expected)} items)")
+    return len(paths)
+
+
+def measure(name, func, results):
+    tracemalloc.start()
+    start = time.process_time()
+    items = func(results)
+    elapsed = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<8} items={len(items):<8} cpu={elapsed:.3f}s peak={peak / 2**20:.1f}MiB")
+    return items, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=300)
+    args = parser.parse_args()
+
+    validate()
+    results = synthetic_results(args.pages, args.rows)
+    legacy_items, legacy_cpu, legacy_peak = measure("legacy", legacy_merge, results)
+    items, cpu, peak = measure("merger", BaiduOCR.merge_commodity_rows, results)
+    assert [item.data for item in items] == [item.data for item in legacy_items]
+    print(f"cpu x{legacy_cpu / cpu:.1f}, memory x{legacy_peak / peak:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Invoice / InvoiceItem 微基准
+
+对比旧实现 (逐字段 try/except 类型转换, 每次访问 data 重建 dict) 与当前实现
+构造并序列化 N 个商品, 以及逐行包装数据库结果后执行校验规则的 CPU 时间与内存峰值.
+
+    python benchmarks/bench_invoice_model.py [--items 1000000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.invoice import Invoice, InvoiceItem  # noqa: E402
+
+
+class LegacyInvoiceItem:
+    _types = InvoiceItem._types
+
+    def __init__(self, data):
+        for key, default in self._types.items():
+            value = data.get(key, default) if data else default
+            try:
+                if isinstance(default, float):
+                    if isinstance(value, str) and value.endswith("%"):
+                        value = float(value.strip('%')) / 100
+                    else:
+                        value = float(value)
+                elif isinstance(default, int):
+                    value = int(float(value))
+                elif isinstance(default, str):
+                    value = str(value)
+                else:
+                    value = default
+            except (ValueError, TypeError):
+                value = default
+            self.__setattr__(key, value)
+
+    @property
+    def data(self):
+        return {key: getattr(self, key) for key in self._types}
+
+
+class LegacyInvoice:
+    """旧实现中以数据库行构造的发票: 每次访问 data 重建 dict"""
+
+    def __init__(self, data):
+        self._fields = data
+
+    @property
+    def number(self):
+        return self._fields.get("number", "")
+
+    @property
+    def totalAmount(self):
+        try:
+            return float(self._fields.get("totalAmount", 0.0))
+        except (ValueError, TypeError):
+            return 0.0
+
+
+RAW_ITEM = {"name": "*办公用品*纸张", "type": "", "unit": "包", "num": "2",
+            "unit_price": "25.0", "amount": "50.00", "tax_rate": "13%", "tax": "6.5"}
+TYPED_ITEM = InvoiceItem(RAW_ITEM).data
+COLUMNS = ("file_token", "number", "totalAmount", "items", "status")
+
+
+def legacy_items(count):
+    return [LegacyInvoiceItem(RAW_ITEM).data for _ in range(count)]
+
+
+def current_items(count):
+    return [InvoiceItem(RAW_ITEM).data for _ in range(count)]
+
+
+def trusted_items(count):
+    return [InvoiceItem.from_trusted(TYPED_ITEM).data for _ in range(count)]
+
+
+def make_rows(count):
+    items = json.dumps([TYPED_ITEM], ensure_ascii=False)
+    return [(f"tok{i:08d}", str(i), "56.50", items, "0") for i in range(count)]
+
+
+def rule(invoice):
+    return invoice.number and invoice.totalAmount > 0
+
+
+def legacy_rows(rows):
+    # 旧流程: 每行先转换为 dict 再包装
+    return [rule(LegacyInvoice(dict(zip(COLUMNS, row)))) for row in rows]
+
+
+def current_rows(rows):
+    index = {column: i for i, column in enumerate(COLUMNS)}
+    return [rule(Invoice.from_row(row, index)) for row in rows]
+
+
+def measure(name, func, arg):
+    tracemalloc.start()
+    start = time.process_time()
+    result = func(arg)
+    elapsed = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<14} n={len(result):<8} cpu={elapsed:.3f}s peak={peak / 2**20:.1f}MiB")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=1000000)
+    args = parser.parse_args()
+
+    legacy = measure("legacy items", legacy_items, args.items)
+    current = measure("items", current_items, args.items)
+    trusted = measure("trusted items", trusted_items, args.items)
+    print(f"items cpu x{legacy / current:.1f}, trusted x{legacy / trusted:.1f}")
+
+    rows = make_rows(args.items)
+    legacy = measure("legacy rows", legacy_rows, rows)
+    current = measure("rows", current_rows, rows)
+    print(f"rows cpu x{legacy / current:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+invoice_view 基准测试
+
+对比旧实现 (SELECT 后逐行构造 dict, Python 循环做类型转换, 再用 json_extract
+关联上传人/收款人) 与 core.view.iter_invoice_rows 在 N 张发票下的 CPU 时间与内存峰值.
+
+    python benchmarks/bench_invoice_view.py [--invoices 100000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.db import open_database  # noqa: E402
+from core.view import ensure_invoice_view, iter_invoice_rows, refresh_attachments  # noqa: E402
+
+INVOICE_COLUMN_NAME = "发票"
+UPLOADER_COLUMN_NAME = "创建人"
+BELONGER_COLUMN_NAME = "收款人"
+
+table_fields_type_map = {
+    "file_token": 1, "uploader": 11, "belonger": 11, "type": 1, "number": 1,
+    "date": 1, "buyerName": 1, "buyerTaxID": 1, "sellerName": 1,
+    "sellerTaxID": 1, "items_brief": 1, "totalAmount": 2, "error_message": 1,
+    "remark": 1, "items": 1, "item_num": 2, "total_items_num": 2,
+    "items_unit": 1, "status": 3,
+}
+
+
+def build_database(path: str, count: int):
+    db = open_database(path)
+    random.seed(0)
+    people = [{"id": f"ou_{i:04d}", "name": f"user{i}"} for i in range(200)]
+    invoices, records = [], []
+    token_index = 0
+    while token_index < count:
+        files = []
+        for _ in range(random.randint(1, 3)):
+            if token_index >= count:
+                break
+            token = f"tok{token_index:08d}"
+            token_index += 1
+            files.append({"file_token": token, "type": "application/pdf"})
+            items = [{"name": "*办公用品*纸张", "type": "", "unit": "包", "num": 2,
+                      "unit_price": 25.0, "amount": 50.0, "tax_rate": "13%", "tax": 6.5}]
+            invoices.append({
+                "file_token": token, "type": "电子发票(普通发票)", "code": "",
+                "number": f"{24000000000000000000 + token_index}",
+                "date": "2024年05月01日", "buyerTaxID": "12100000466007642Y",
+                "buyerName": "南京理工大学", "sellerTaxID": "91320100MA1XXXXX",
+                "sellerName": f"供应商{token_index % 500}",
+                "items_brief": "*办公用品*纸张", "items_unit": "包",
+                "remark": "", "item_num": 1, "total_items_num": 2,
+                "totalAmount": 56.5, "error_message": None,
+                "items": json.dumps(items, ensure_ascii=False),
+                "status": "0", "processed": 1,
+            })
+        records.append({
+            "uid": f"tbl_rec{len(records):07d}",
+            INVOICE_COLUMN_NAME: json.dumps(files),
+            UPLOADER_COLUMN_NAME: json.dumps([random.choice(people)]),
+            BELONGER_COLUMN_NAME: json.dumps([random.choice(people)]),
+        })
+    db["invoices"].insert_all(invoices, pk="file_token", batch_size=5000)
+    db["records"].insert_all(records, pk="uid", batch_size=5000)
+    refresh_attachments(db, INVOICE_COLUMN_NAME, UPLOADER_COLUMN_NAME,
+                        BELONGER_COLUMN_NAME)
+    ensure_invoice_view(db, INVOICE_COLUMN_NAME, UPLOADER_COLUMN_NAME,
+                        BELONGER_COLUMN_NAME)
+    return db
+
+
+def legacy(db):
+    """旧的 create_lark_app_table / sync_to_table 数据准备流程"""
+    keys = ("file_token", "type", "number", "date", "buyerTaxID",
+            "buyerName", "sellerTaxID", "sellerName", "items_brief",
+            "items_unit", "remark", "item_num", "total_items_num",
+            "totalAmount", "error_message", "items", "status")
+    result = db.execute(f"SELECT {', '.join(keys)} FROM invoices").fetchall()
+    invoices_data = [{key: row[index] for index, key in enumerate(keys)}
+                     for row in result]
+    for invoice_data in invoices_data:
+        for key, type_value in table_fields_type_map.items():
+            if key in invoice_data:
+                value = invoice_data[key]
+                if value in (None, '', [], {}, ()):
+                    del invoice_data[key]
+                    continue
+                if type_value == 2:
+                    invoice_data[key] = int(value)
+                elif type_value == 3:
+                    invoice_data[key] = str(value)
+    result = db.execute(f"""
+        SELECT
+            json_extract(records.{UPLOADER_COLUMN_NAME}, '$[0].id') AS uploader_id,
+            json_extract(records.{BELONGER_COLUMN_NAME}, '$[0].id') AS belonger_id,
+            json_extract(value, '$.file_token') AS file_token
+        FROM records, json_each(records.{INVOICE_COLUMN_NAME})
+    """).fetchall()
+    invoices_by_token = {data['file_token']: data for data in invoices_data}
+    for row in result:
+        if row[2] in invoices_by_token:
+            invoice_data = invoices_by_token[row[2]]
+            if row[0]:
+                invoice_data['uploader'] = [{"id": row[0], "type": "user"}]
+            if row[1]:
+                invoice_data['belonger'] = [{"id": row[1], "type": "user"}]
+    return invoices_data
+
+
+def view(db):
+    return list(iter_invoice_rows(db))
+
+
+def measure(name, func, db):
+    tracemalloc.start()
+    start = time.process_time()
+    rows = func(db)
+    elapsed = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<8} rows={len(rows):<8} cpu={elapsed:.3f}s peak={peak / 2**20:.1f}MiB")
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--invoices", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = build_database(os.path.join(tmp, "bench.db"), args.invoices)
+        legacy_cpu, legacy_peak = measure("legacy", legacy, db)
+        view_cpu, view_peak = measure("view", view, db)
+        print(f"cpu x{legacy_cpu / view_cpu:.1f}, memory x{legacy_peak / view_peak:.1f}")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
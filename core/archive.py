@@ -0,0 +1,124 @@
+import json
+import zlib
+from typing import *
+from sqlite_utils import Database
+from .invoice import BaiduOCR, TencentOCR
+from .log import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 识别接口 -> 由原始响应解析发票的方法 (不访问网络)
+RESPONSE_PARSERS = {
+    "baidu_vat_invoice": BaiduOCR.parse_vat_pages,
+    "baidu_multiple_invoice": BaiduOCR.parse_multiple_pages,
+    "tencent_general_invoice": TencentOCR.parse_pages,
+}
+
+
+def compress(data: bytes) -> Tuple[str, bytes]:
+    """压缩数据, 安装了 zstandard 时使用 zstd, 否则使用 zlib"""
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    return "zlib", zlib.compress(data, 9)
+
+
+def decompress(codec: str, blob: bytes) -> bytes:
+    if codec == "zlib":
+        return zlib.decompress(blob)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd compressed responses.")
+        return zstandard.ZstdDecompressor().decompress(blob)
+    raise ValueError(f"Unknown codec {{{codec}}}")
+
+
+def ensure_ocr_responses(db: Database):
+    with db.conn:
+        db.conn.execute("""
+            CREATE TABLE IF NOT EXISTS ocr_responses (
+                file_hash TEXT NOT NULL,
+                provider TEXT NOT NULL,
+                codec TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (file_hash, provider)
+            )
+        """)
+
+
+class ResponseArchive:
+    """
+    识别接口原始响应的存档, 以 (文件哈希, 接口) 为键压缩保存在 ocr_responses 表
+
+    与 InvoiceWriter 相同, 缓存后按批提交; 同一文件同一接口只保留最新的响应.
+    """
+
+    def __init__(self, db: Database, batch_size: Optional[int] = 50):
+        self.db = db
+        self.batch_size = batch_size
+        self._pending: Dict[Tuple[str, str], list] = {}
+        ensure_ocr_responses(db)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def add(self, file_hash: str, provider: str, pages: list):
+        self._pending[(file_hash, provider)] = pages
+        if self.batch_size and len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        rows = []
+        for (file_hash, provider), pages in self._pending.items():
+            codec, payload = compress(
+                json.dumps(pages, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+            rows.append((file_hash, provider, codec, payload))
+        with self.db.conn:
+            self.db.conn.executemany("""
+                INSERT INTO ocr_responses (file_hash, provider, codec, payload)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(file_hash, provider) DO UPDATE SET
+                    codec = excluded.codec,
+                    payload = excluded.payload,
+                    created_at = CURRENT_TIMESTAMP
+            """, rows)
+        logger.debug(f"Archived {len(rows)} OCR responses.")
+        self._pending.clear()
+
+
+def reparse_responses(
+        chunk: List[Tuple[str, List[Tuple[str, str, bytes]]]]
+) -> List[Tuple[str, Optional[str], Optional[dict], Optional[str]]]:
+    """
+    离线重新解析一组发票的存档响应, 可在子进程中运行
+
+    chunk 为 [(file_token, [(provider, codec, payload), ...]), ...], 每张发票依次尝试各响应,
+    取第一个解析出 number 与 totalAmount 的结果.
+
+    Returns:
+        list: [(file_token, provider | None, 发票数据 | None, 错误信息 | None), ...]
+    """
+    results = []
+    for file_token, responses in chunk:
+        error = "No archived response."
+        for provider, codec, payload in responses:
+            try:
+                parse = RESPONSE_PARSERS[provider]
+                invoice = parse(json.loads(decompress(codec, payload)))
+                if not invoice.number or not invoice.totalAmount:
+                    raise ValueError("Missing required fields: number or totalAmount.")
+                results.append((file_token, provider, invoice.data, None))
+                break
+            except Exception as e:
+                error = f"{provider}: {e}"
+        else:
+            results.append((file_token, None, None, error))
+    return results
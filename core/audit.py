@@ -0,0 +1,115 @@
+from collections import Counter
+from typing import *
+from sqlite_utils import Database
+from .db import ensure_invoice_identity, ensure_invoice_items
+
+# 检查项 -> 说明
+AUDIT_CHECKS = {
+    "amount_tax_total": "金额 + 税额 != 价税合计",
+    "items_total": "商品金额合计 + 商品税额合计 != 价税合计",
+    "record_total": "审批后金额 != 所属发票价税合计之和",
+}
+
+
+def ensure_audit_findings(db: Database):
+    with db.conn:
+        db.conn.execute("""
+            CREATE TABLE IF NOT EXISTS audit_findings (
+                check_name TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                expected INTEGER,
+                actual INTEGER,
+                difference INTEGER,
+                detail TEXT,
+                PRIMARY KEY (check_name, subject)
+            )
+        """)
+
+
+def run_audit(db: Database,
+              total_column: str,
+              tolerance: int = 1,
+              error_column: str = "error_message") -> Counter:
+    """
+    金额一致性审计, 结果写入 audit_findings 表 (每次审计前清空)
+
+    全部检查均为基于集合的 SQL 语句, 金额经 cents() 以 Decimal 换算为整数(分)后比较,
+    差额超过 tolerance(分) 即记为问题. expected / actual / difference 单位均为分.
+    已标记为重复的发票不参与检查.
+
+    - amount_tax_total: 发票 amount + taxAmount 与 totalAmount (不含无价税拆分的发票, 如火车票)
+    - items_total: invoice_items 中 amount 与 tax 之和 与 totalAmount
+    - record_total: 记录的 total_column 与其附件中无错误发票 totalAmount 之和
+
+    Returns:
+        Counter: {检查项: 问题数量}
+    """
+    ensure_invoice_identity(db)
+    ensure_invoice_items(db)
+    ensure_audit_findings(db)
+    columns = db["invoices"].columns_dict
+    candidates = "processed AND duplicate_of IS NULL"
+
+    statements = {}
+    if {"amount", "taxAmount", "totalAmount"} <= set(columns):
+        statements["amount_tax_total"] = f"""
+            SELECT file_token AS subject,
+                   cents(totalAmount) AS expected,
+                   cents(amount) + cents(taxAmount) AS actual,
+                   'amount=' || amount || ', taxAmount=' || taxAmount || ', totalAmount=' || totalAmount AS detail
+            FROM invoices
+            WHERE {candidates}
+              AND cents(amount) IS NOT NULL AND cents(taxAmount) IS NOT NULL
+              AND cents(totalAmount) IS NOT NULL
+              AND (cents(amount) != 0 OR cents(taxAmount) != 0)
+        """
+    if "totalAmount" in columns:
+        statements["items_total"] = f"""
+            SELECT invoices.file_token AS subject,
+                   cents(invoices.totalAmount) AS expected,
+                   SUM(COALESCE(cents(it.amount), 0)) + SUM(COALESCE(cents(it.tax), 0)) AS actual,
+                   COUNT(*) || ' items' AS detail
+            FROM invoices
+            JOIN invoice_items it ON it.file_token = invoices.file_token
+            WHERE {candidates} AND cents(invoices.totalAmount) IS NOT NULL
+            GROUP BY invoices.file_token
+        """
+    if db["records"].exists() and db["attachments"].exists() \
+            and total_column in db["records"].columns_dict:
+        statements["record_total"] = f"""
+            SELECT records.uid AS subject,
+                   COALESCE(SUM(cents(invoices.totalAmount)), 0) AS expected,
+                   cents(records.[{total_column}]) AS actual,
+                   COUNT(invoices.file_token) || ' invoices' AS detail
+            FROM records
+            LEFT JOIN attachments a ON a.record_uid = records.uid
+            LEFT JOIN invoices ON invoices.file_token = a.file_token
+                AND COALESCE(invoices.[{error_column}], '') = ''
+            WHERE cents(records.[{total_column}]) IS NOT NULL
+            GROUP BY records.uid
+        """
+
+    counts = Counter()
+    with db.conn:
+        db.conn.execute("DELETE FROM audit_findings")
+        for check_name, statement in statements.items():
+            cursor = db.conn.execute(f"""
+                INSERT INTO audit_findings
+                    (check_name, subject, expected, actual, difference, detail)
+                SELECT ?, subject, expected, actual, actual - expected, detail
+                FROM ({statement})
+                WHERE abs(actual - expected) > ?
+            """, (check_name, tolerance))
+            counts[check_name] = cursor.rowcount
+    return counts
+
+
+def iter_findings(db: Database, limit: Optional[int] = None) -> Iterator[dict]:
+    """按差额绝对值从大到小读取审计结果"""
+    query = "SELECT * FROM audit_findings ORDER BY abs(difference) DESC, check_name, subject"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    cursor = db.conn.execute(query)
+    names = [column[0] for column in cursor.description]
+    for row in cursor:
+        yield dict(zip(names, row))
@@ -0,0 +1,472 @@
+import json
+import os
+import re
+import sqlite3
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import *
+from urllib.request import pathname2url
+from sqlite_utils import Database
+from sqlite_utils.db import jsonify_if_needed
+from .invoice.base import extract_item_tag
+from .log import logger
+
+
+def open_database(db_path: str, read_only: bool = False) -> Database:
+    """
+    打开 SQLite 数据库
+
+    启用 WAL 日志模式, 并将 synchronous 调整为 NORMAL (WAL 模式下仍能保证崩溃一致性).
+    read_only 为 True 时以只读方式打开, 任何写入都会报错.
+    """
+    if read_only:
+        db = Database(
+            sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro",
+                            uri=True))
+    else:
+        db = Database(db_path)
+        db.conn.execute("PRAGMA journal_mode = WAL")
+        db.conn.execute("PRAGMA synchronous = NORMAL")
+    db.conn.create_function("invoice_key", 4, invoice_key, deterministic=True)
+    db.conn.create_function("item_tag", 1, extract_item_tag, deterministic=True)
+    db.conn.create_function("cents", 1, to_cents, deterministic=True)
+    return db
+
+
+def invoice_key(code, number, date, seller_tax_id) -> Optional[str]:
+    """
+    发票唯一标识
+
+    - 有发票代码: 代码 + 号码
+    - 无发票代码(全电发票等): 号码 + 开票日期 + 销售方识别号
+    """
+    number = (number or "").strip()
+    if not number:
+        return None
+    code = (code or "").strip()
+    if code:
+        return f"{code}-{number}"
+    return f"{number}-{(date or '').strip()}-{(seller_tax_id or '').strip()}"
+
+
+def to_cents(value) -> Optional[int]:
+    """
+    金额 -> 整数(分), 以 Decimal 换算避免浮点误差
+
+    兼容 "¥1,234.50" 等带符号的文本, 无法解析时返回 None
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value * 100
+    text = re.sub(r"[^\d.\-]", "", str(value))
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        return None
+    return int((amount * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+DUPLICATE_MESSAGE = "This file has been processed in file_token: "
+
+INVOICE_KEY_INDEX = "idx_invoices_invoice_key"
+
+
+def ensure_invoice_identity(db: Database) -> int:
+    """
+    为 invoices 表补齐 invoice_key / duplicate_of 字段及部分唯一索引
+
+    旧数据库会先回填 invoice_key 并标记已有的重复发票, 再建立索引;
+    旧版本仅按号码误判为重复的发票同时恢复 (见 release_duplicates).
+
+    Returns:
+        int: 恢复的发票数量
+    """
+    table = db["invoices"]
+    if not table.exists() or INVOICE_KEY_INDEX in {
+            index.name for index in table.indexes
+    }:
+        return 0
+    released = 0
+    columns = table.columns_dict
+    for column in ("invoice_key", "duplicate_of"):
+        if column not in columns:
+            table.add_column(column, str)
+    if {"code", "number", "date", "sellerTaxID"} <= set(columns):
+        with db.conn:
+            db.conn.execute("""
+                UPDATE invoices
+                SET invoice_key = invoice_key(code, number, date, sellerTaxID)
+                WHERE invoice_key IS NULL AND processed
+            """)
+        mark_duplicates(db)
+        released = release_duplicates(db)
+        if released:
+            logger.info(f"Released {released} invoices wrongly marked as duplicates.")
+    with db.conn:
+        db.conn.execute(f"""
+            CREATE UNIQUE INDEX IF NOT EXISTS {INVOICE_KEY_INDEX}
+            ON invoices(invoice_key)
+            WHERE invoice_key IS NOT NULL AND duplicate_of IS NULL
+        """)
+    return released
+
+
+ITEM_COLUMNS = ("name", "tag", "unit", "num", "unit_price", "amount", "tax_rate", "tax")
+
+
+def ensure_invoice_items(db: Database):
+    """
+    创建 invoice_items 表 (每行一个商品, 由 invoices.items 展开)
+
+    表首次创建时由已有的 invoices.items 一次性回填.
+    """
+    if db["invoice_items"].exists():
+        return
+    with db.conn:
+        db.conn.execute("""
+            CREATE TABLE invoice_items (
+                file_token TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                name TEXT,
+                tag TEXT,
+                unit TEXT,
+                num INTEGER,
+                unit_price FLOAT,
+                amount FLOAT,
+                tax_rate TEXT,
+                tax FLOAT,
+                PRIMARY KEY (file_token, position)
+            )
+        """)
+        db.conn.execute("CREATE INDEX idx_invoice_items_tag ON invoice_items(tag)")
+        db.conn.execute("CREATE INDEX idx_invoice_items_name ON invoice_items(name)")
+        if db["invoices"].exists() and "items" in db["invoices"].columns_dict:
+            db.conn.execute("""
+                INSERT INTO invoice_items
+                SELECT
+                    invoices.file_token,
+                    item.key,
+                    json_extract(item.value, '$.name'),
+                    item_tag(json_extract(item.value, '$.name')),
+                    json_extract(item.value, '$.unit'),
+                    json_extract(item.value, '$.num'),
+                    json_extract(item.value, '$.unit_price'),
+                    json_extract(item.value, '$.amount'),
+                    json_extract(item.value, '$.tax_rate'),
+                    json_extract(item.value, '$.tax')
+                FROM invoices, json_each(invoices.items) AS item
+                WHERE json_valid(invoices.items) AND json_type(invoices.items) = 'array'
+            """)
+
+
+def find_duplicate_clusters(db: Database) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    一次扫描找出所有重复发票簇
+
+    Returns:
+        dict: invoice_key -> [(file_token, 原始发票 file_token), ...]
+        每簇的原始发票优先取已是原始记录的行, 其次取最早写入的行
+    """
+    # 只读扫描时兼容尚未回填 invoice_key / duplicate_of 的旧数据库
+    columns = db["invoices"].columns_dict
+    key_sql = "invoice_key(code, number, date, sellerTaxID)"
+    if "invoice_key" in columns:
+        key_sql = f"COALESCE(invoice_key, {key_sql})"
+    duplicate_sql = "duplicate_of IS NOT NULL" if "duplicate_of" in columns else "0"
+    result = db.execute(f"""
+        SELECT invoice_key, file_token, original FROM (
+            SELECT
+                invoice_key,
+                file_token,
+                FIRST_VALUE(file_token) OVER cluster AS original,
+                COUNT(*) OVER (PARTITION BY invoice_key) AS size
+            FROM (
+                SELECT
+                    rowid AS position,
+                    file_token,
+                    error_message,
+                    {key_sql} AS invoice_key,
+                    {duplicate_sql} AS is_duplicate
+                FROM invoices
+                WHERE processed
+            )
+            WHERE invoice_key IS NOT NULL
+            WINDOW cluster AS (
+                PARTITION BY invoice_key
+                ORDER BY is_duplicate,
+                         COALESCE(error_message, '') LIKE ?,
+                         position
+            )
+        )
+        WHERE size > 1
+        ORDER BY invoice_key
+    """, (f"{DUPLICATE_MESSAGE}%", )).fetchall()
+    clusters = {}
+    for key, file_token, original in result:
+        clusters.setdefault(key, []).append((file_token, original))
+    return clusters
+
+
+def mark_duplicates(db: Database, clusters=None) -> Dict[str, List[Tuple[str, str]]]:
+    """按 find_duplicate_clusters 的结果重写 duplicate_of 并标记重复发票"""
+    if clusters is None:
+        clusters = find_duplicate_clusters(db)
+    duplicates = [(original, file_token)
+                  for members in clusters.values()
+                  for file_token, original in members
+                  if file_token != original]
+    originals = {original for members in clusters.values()
+                 for _, original in members}
+    with db.conn:
+        # 先标记重复项再清除原始项, 避免违反部分唯一索引
+        db.conn.executemany(
+            "UPDATE invoices SET duplicate_of = ? WHERE file_token = ?",
+            duplicates)
+        db.conn.executemany(
+            "UPDATE invoices SET duplicate_of = NULL WHERE file_token = ?",
+            [(file_token, ) for file_token in originals])
+        db.conn.execute(
+            """
+            UPDATE invoices
+            SET error_message = ? || duplicate_of, status = '-1'
+            WHERE duplicate_of IS NOT NULL
+              AND COALESCE(error_message, '') != ? || duplicate_of
+            """, (DUPLICATE_MESSAGE, DUPLICATE_MESSAGE))
+    return clusters
+
+
+def release_duplicates(db: Database) -> int:
+    """
+    恢复带有重复提示但 duplicate_of 为空的发票 (如旧版本仅按号码误判的重复), 返回恢复的数量
+
+    状态恢复为 0 并清除错误信息; 同时清除 verified_with, 下次校验时重新按规则校验.
+    """
+    columns = db["invoices"].columns_dict
+    if not {"duplicate_of", "error_message", "status"} <= set(columns):
+        return 0
+    reset_verified = ", verified_with = NULL" if "verified_with" in columns else ""
+    with db.conn:
+        cursor = db.conn.execute(f"""
+            UPDATE invoices
+            SET status = '0', error_message = NULL{reset_verified}
+            WHERE duplicate_of IS NULL AND error_message LIKE ?
+        """, (f"{DUPLICATE_MESSAGE}%", ))
+    logger.debug(f"Released {cursor.rowcount} invoices wrongly marked as duplicates.")
+    return cursor.rowcount
+
+
+class InvoiceIndex:
+    """
+    内存中的发票索引, 在运行开始时一次性载入
+
+    - processed: 已成功处理的 file_token 集合 (用于跳过已处理文件)
+
+    通过 InvoiceWriter 写入的记录会同步更新索引.
+    查重由数据库在写入时完成, 见 ensure_invoice_identity.
+    """
+
+    def __init__(self):
+        self.processed: Set[str] = set()
+
+    @classmethod
+    def load(cls, db: Database) -> "InvoiceIndex":
+        index = cls()
+        if "invoices" not in db.table_names():
+            return index
+        index.processed.update(
+            row[0] for row in db.execute(
+                "SELECT file_token FROM invoices WHERE processed"))
+        logger.debug(f"Loaded {len(index.processed)} processed tokens.")
+        return index
+
+    def add(self, record: dict):
+        if record.get("processed"):
+            self.processed.add(record["file_token"])
+        else:
+            self.processed.discard(record["file_token"])
+
+    def is_processed(self, file_token: str) -> bool:
+        return file_token in self.processed
+
+
+class InvoiceWriter:
+    """
+    invoices 表的批量写入层
+
+    - insert: 整行写入(等价于 replace), 按 file_token 去重后缓存
+    - update: 部分字段更新, 按字段组合分组缓存
+    - flush: 在一个显式事务内用 executemany 提交全部缓存
+
+    表结构只在首次写入时读取一次, 之后仅当出现新字段时才执行 ALTER.
+    batch_size 为 None 时不自动提交, 需调用 flush (或使用 with 语句).
+
+    整行写入时计算 invoice_key, 与已有原始发票重复的记录在同一事务内
+    被标记 duplicate_of 并置为 -1; 记录中的商品列表同时写入 invoice_items 表.
+    """
+
+    def __init__(self,
+                 db: Database,
+                 batch_size: Optional[int] = 200,
+                 index: Optional[InvoiceIndex] = None):
+        self.db = db
+        self.batch_size = batch_size
+        self.index = index
+        self._columns: Optional[Dict[str, Any]] = None
+        self._inserts: Dict[str, dict] = {}
+        self._updates: Dict[Tuple[str, ...], List[tuple]] = {}
+        self._pending_updates = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def insert(self, record: dict):
+        record["invoice_key"] = invoice_key(record.get("code"),
+                                            record.get("number"),
+                                            record.get("date"),
+                                            record.get("sellerTaxID"))
+        self._inserts[record["file_token"]] = record
+        if self.index is not None:
+            self.index.add(record)
+        self._maybe_flush()
+
+    def update(self, file_token: str, fields: dict):
+        if file_token in self._inserts:
+            # 尚未落盘的整行记录直接合并, 保证写入顺序
+            self._inserts[file_token].update(fields)
+            return
+        keys = tuple(fields.keys())
+        self._updates.setdefault(keys, []).append(
+            tuple(fields[key] for key in keys) + (file_token, ))
+        self._pending_updates += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self.batch_size and len(
+                self._inserts) + self._pending_updates >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._inserts and not self._updates:
+            return
+        self._ensure_columns()
+        with self.db.conn:
+            if self._inserts:
+                self._write_inserts(list(self._inserts.values()))
+            for keys, rows in self._updates.items():
+                assignments = ", ".join(f"[{key}] = ?" for key in keys)
+                self.db.conn.executemany(
+                    f"UPDATE [invoices] SET {assignments} WHERE [file_token] = ?",
+                    [tuple(jsonify_if_needed(v) for v in row) for row in rows])
+        logger.debug(
+            f"Flushed {len(self._inserts)} inserts and {self._pending_updates} updates."
+        )
+        self._inserts.clear()
+        self._updates.clear()
+        self._pending_updates = 0
+
+    def _write_inserts(self, records: List[dict]):
+        columns = [c for c in self._columns if c != "duplicate_of"]
+        placeholders = ", ".join("?" for _ in columns)
+        assignments = ", ".join(f"[{column}] = excluded.[{column}]"
+                                for column in columns + ["duplicate_of"]
+                                if column != "file_token")
+        # 显式列出全部字段(缺省为 NULL), 与 replace 语义一致, 但保留 rowid 并正常触发 UPDATE 触发器
+        # duplicate_of 由数据库按 invoice_key 查找当前的原始发票
+        self.db.conn.executemany(
+            f"""
+            INSERT INTO [invoices] ({", ".join(f"[{c}]" for c in columns)}, [duplicate_of])
+            VALUES ({placeholders}, (
+                SELECT file_token FROM invoices
+                WHERE invoice_key = ? AND duplicate_of IS NULL AND file_token != ?
+            ))
+            ON CONFLICT([file_token]) DO UPDATE SET {assignments}
+            """,
+            [
+                tuple(jsonify_if_needed(record.get(column)) for column in columns)
+                + (record.get("invoice_key"), record["file_token"])
+                for record in records
+            ])
+        self.db.conn.executemany(
+            """
+            UPDATE invoices SET error_message = ? || duplicate_of, status = '-1'
+            WHERE file_token = ? AND duplicate_of IS NOT NULL
+            """,
+            [(DUPLICATE_MESSAGE, record["file_token"]) for record in records])
+
+        self.db.conn.executemany(
+            "DELETE FROM invoice_items WHERE file_token = ?",
+            [(record["file_token"], ) for record in records])
+        self.db.conn.executemany(
+            f"""
+            INSERT INTO invoice_items (file_token, position, {", ".join(ITEM_COLUMNS)})
+            VALUES (?, ?, {", ".join("?" for _ in ITEM_COLUMNS)})
+            """,
+            [(record["file_token"], position, *_item_values(item))
+             for record in records
+             for position, item in enumerate(_record_items(record))])
+
+    def _ensure_columns(self):
+        """缓存表结构, 仅在出现新字段时建表/加列"""
+        table = self.db["invoices"]
+        if self._columns is None and table.exists():
+            ensure_invoice_identity(self.db)
+            ensure_invoice_items(self.db)
+            self._columns = dict(table.columns_dict)
+
+        new_columns = {}
+        for record in self._inserts.values():
+            for key, value in record.items():
+                if (self._columns is None or key not in self._columns) \
+                        and new_columns.get(key) in (None, str):
+                    new_columns[key] = _column_type(value)
+        for keys in self._updates:
+            for key in keys:
+                if (self._columns is None or key not in self._columns) \
+                        and key not in new_columns:
+                    new_columns[key] = str
+
+        if self._columns is None:
+            new_columns.setdefault("file_token", str)
+            new_columns.setdefault("duplicate_of", str)
+            table.create(new_columns, pk="file_token")
+            ensure_invoice_identity(self.db)
+            ensure_invoice_items(self.db)
+            self._columns = dict(new_columns)
+        else:
+            for key, column_type in new_columns.items():
+                table.add_column(key, column_type)
+                self._columns[key] = column_type
+
+
+def _column_type(value):
+    if isinstance(value, bool):
+        return int
+    if isinstance(value, (int, float)):
+        return type(value)
+    return str
+
+
+def _record_items(record: dict) -> list:
+    items = record.get("items")
+    if isinstance(items, str):
+        try:
+            items = json.loads(items)
+        except ValueError:
+            return []
+    return items if isinstance(items, list) else []
+
+
+def _item_values(item: dict) -> tuple:
+    return (
+        item.get("name"),
+        extract_item_tag(item.get("name")),
+        item.get("unit"),
+        item.get("num"),
+        item.get("unit_price"),
+        item.get("amount"),
+        jsonify_if_needed(item.get("tax_rate")),
+        item.get("tax"),
+    )
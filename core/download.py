@@ -0,0 +1,156 @@
+import os
+import time
+from typing import *
+from sqlite_utils import Database
+from .log import logger
+from .utils import file_sha256, fsync_directory
+
+# 下载失败后的重试次数及首次重试前的等待时间(秒), 之后每次翻倍
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 1.0
+
+
+class DownloadError(Exception):
+    pass
+
+
+def ensure_raw_manifest(db: Database):
+    with db.conn:
+        db.conn.execute("""
+            CREATE TABLE IF NOT EXISTS raw_manifest (
+                file_token TEXT PRIMARY KEY,
+                file_name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                file_hash TEXT NOT NULL,
+                mtime_ns INTEGER
+            )
+        """)
+    if "mtime_ns" not in db["raw_manifest"].columns_dict:
+        db["raw_manifest"].add_column("mtime_ns", int)
+
+
+def record_raw_files(db: Database, directory: str, rows: Iterable[Tuple[str, str, int, str]]):
+    """记录已完整写入 directory 的文件 (file_token, 文件名, 大小, 哈希), 修改时间取自文件"""
+    rows = [
+        (file_token, file_name, size, file_hash,
+         os.stat(os.path.join(directory, file_name)).st_mtime_ns)
+        for file_token, file_name, size, file_hash in rows
+    ]
+    ensure_raw_manifest(db)
+    with db.conn:
+        db.conn.executemany("""
+            INSERT INTO raw_manifest (file_token, file_name, size, file_hash, mtime_ns)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(file_token) DO UPDATE SET
+                file_name = excluded.file_name,
+                size = excluded.size,
+                file_hash = excluded.file_hash,
+                mtime_ns = excluded.mtime_ns
+        """, rows)
+
+
+def scan_raw_files(db: Database,
+                   directory: str,
+                   file_tokens: Optional[Collection[str]] = None) -> Dict[str, str]:
+    """
+    以 raw_manifest 为准, 用一次 os.scandir 校验 directory 中已下载的文件
+
+    - 大小与修改时间均与清单一致: 视为完整
+    - 大小一致但修改时间不同: 重新计算哈希, 一致时更新修改时间
+    - 清单中的文件缺失、大小或哈希不同: 从清单中删除, 磁盘上的文件一并删除以便重新下载
+    - 未记录在清单中的文件 (如旧版本导出的文件): 文件名为 file_tokens 中的 file_token + 扩展名时
+      计算哈希并加入清单, 其余文件保持不变
+    .part 文件保留, 由 download_file 续传.
+
+    Returns:
+        dict: file_token -> 文件名
+    """
+    ensure_raw_manifest(db)
+    manifest = {
+        file_name: (file_token, size, file_hash, mtime_ns)
+        for file_token, file_name, size, file_hash, mtime_ns in db.execute(
+            "SELECT file_token, file_name, size, file_hash, mtime_ns FROM raw_manifest")
+    }
+    valid, touched, removed, unknown = {}, [], [], []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(".part") or not entry.is_file():
+                continue
+            record = manifest.pop(entry.name, None)
+            if record is None:
+                unknown.append(entry)
+                continue
+            file_token, size, file_hash, mtime_ns = record
+            stat = entry.stat()
+            if stat.st_size == size and stat.st_mtime_ns != mtime_ns \
+                    and file_sha256(entry.path) == file_hash:
+                touched.append((stat.st_mtime_ns, file_token))
+            elif stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                removed.append(entry.path)
+                manifest[entry.name] = record
+                continue
+            valid[file_token] = entry.name
+
+    # 清单中剩余的记录对应的文件已缺失或损坏
+    missing = [(record[0], ) for record in manifest.values()]
+    with db.conn:
+        db.conn.executemany("UPDATE raw_manifest SET mtime_ns = ? WHERE file_token = ?", touched)
+        db.conn.executemany("DELETE FROM raw_manifest WHERE file_token = ?", missing)
+    for path in removed:
+        os.remove(path)
+
+    adopted = []
+    for entry in unknown:
+        file_token = os.path.splitext(entry.name)[0]
+        if file_tokens is None or file_token not in file_tokens or file_token in valid:
+            continue
+        adopted.append((file_token, entry.name, entry.stat().st_size, file_sha256(entry.path)))
+        valid[file_token] = entry.name
+    if adopted:
+        record_raw_files(db, directory, adopted)
+
+    if removed or missing or adopted:
+        logger.info(
+            f"Raw files: {len(valid)} valid, {len(missing)} missing or changed, "
+            f"{len(removed)} invalid files removed, {len(adopted)} existing files recorded.")
+    return valid
+
+
+def download_file(fetch: Callable[[int], Tuple[Optional[str], bytes, bool]],
+                  directory: str,
+                  file_token: str,
+                  retries: int = DOWNLOAD_RETRIES,
+                  backoff: float = DOWNLOAD_BACKOFF) -> Tuple[str, int, str]:
+    """
+    下载文件到 {directory}/{file_token}{扩展名}, 可在线程中运行 (不访问数据库)
+
+    内容先写入 {file_token}.part 并 fsync, 完成后原子重命名; 中途退出只会留下 .part 文件.
+    fetch(offset) 返回 (原始文件名, 内容, 是否为从 offset 开始的部分内容);
+    已有 .part 文件时从其末尾续传, 服务端不支持续传时重新写入.
+    失败时按 backoff 指数退避重试, 全部失败后抛出 DownloadError.
+
+    Returns:
+        (文件名, 大小, 哈希)
+    """
+    part_path = os.path.join(directory, f"{file_token}.part")
+    error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            file_name, content, partial = fetch(offset)
+            with open(part_path, "ab" if partial and offset else "wb") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            _, ext = os.path.splitext(file_name or "")
+            name = file_token + ext
+            size, file_hash = os.path.getsize(part_path), file_sha256(part_path)
+            os.replace(part_path, os.path.join(directory, name))
+            fsync_directory(directory)
+            return name, size, file_hash
+        except Exception as e:
+            error = e
+            logger.debug(f"Download {file_token} failed (attempt {attempt + 1}): {e}")
+    raise DownloadError(f"{error} (after {retries + 1} attempts)")
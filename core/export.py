@@ -0,0 +1,253 @@
+import csv
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from collections import Counter
+from typing import *
+from sqlite_utils import Database
+from .log import logger
+from .utils import link_or_copy
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def ensure_export_links(db: Database):
+    with db.conn:
+        db.conn.execute("""
+            CREATE TABLE IF NOT EXISTS export_links (
+                path TEXT PRIMARY KEY,
+                raw_file TEXT NOT NULL
+            )
+        """)
+
+
+def plan_export(links: Iterable[Tuple[str, str]]) -> Dict[str, str]:
+    """
+    由 (相对 output_dir 的导出路径, raw 目录下的文件名) 计算期望的导出目录树
+
+    多张发票得到相同路径时保留第一张, 与逐个创建硬链接时跳过已存在文件的行为一致.
+    """
+    plan = {}
+    for path, raw_file in links:
+        plan.setdefault(os.path.normpath(path), raw_file)
+    return plan
+
+
+def keep_export_links(db: Database, plan: Dict[str, str], file_tokens: Collection[str]) -> int:
+    """
+    将 file_tokens (如本次下载失败的发票) 上次导出的链接原样加入 plan, 返回加入的数量
+
+    raw 文件缺失时这些链接可能是文件仅存的副本, 不应作为过期链接删除.
+    raw 文件名为 file_token + 扩展名.
+    """
+    if not file_tokens:
+        return 0
+    ensure_export_links(db)
+    kept = 0
+    for path, raw_file in db.execute("SELECT path, raw_file FROM export_links"):
+        if os.path.splitext(raw_file)[0] in file_tokens and path not in plan:
+            plan[path] = raw_file
+            kept += 1
+    return kept
+
+
+def _remove_empty_dirs(output_dir: str, directories: Iterable[str]):
+    """自深向浅删除变为空的目录, 不超出 output_dir"""
+    root = os.path.abspath(output_dir)
+    for directory in sorted(set(directories), key=len, reverse=True):
+        path = os.path.abspath(os.path.join(output_dir, directory))
+        while path != root and path.startswith(root):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            path = os.path.dirname(path)
+
+
+def apply_export(db: Database, output_dir: str, plan: Dict[str, str]) -> Counter:
+    """
+    将导出目录树更新为 plan, 只执行与上次导出(export_links 表)的差异
+
+    - 不再需要或指向其他 raw 文件的链接被删除, 删除后为空的目录一并删除
+    - 同一 raw 文件的旧路径直接重命名为新路径 (如状态或收款人变化)
+    - 其余新路径创建硬链接 (无法链接时复制), 所需目录在开始前一次性创建
+
+    目录整个缺失(如被手动删除)时, 其下的链接视为需要重新创建.
+
+    Returns:
+        Counter: created / removed / renamed / unchanged
+    """
+    ensure_export_links(db)
+    previous = dict(db.execute("SELECT path, raw_file FROM export_links"))
+    raw_dir = os.path.join(output_dir, "raw")
+
+    directories = {os.path.dirname(path) for path in plan}
+    missing_dirs = {d for d in directories if not os.path.isdir(os.path.join(output_dir, d))}
+
+    stale = [path for path, raw_file in previous.items() if plan.get(path) != raw_file]
+    wanted = [
+        path for path, raw_file in plan.items()
+        if previous.get(path) != raw_file or os.path.dirname(path) in missing_dirs
+    ]
+
+    # 同一 raw 文件的 删除 + 创建 合并为重命名
+    stale_by_raw = {}
+    for path in stale:
+        stale_by_raw.setdefault(previous[path], []).append(path)
+    renames, creates = [], []
+    for path in wanted:
+        sources = stale_by_raw.get(plan[path])
+        if sources:
+            renames.append((sources.pop(), path))
+        else:
+            creates.append(path)
+    removes = [path for paths in stale_by_raw.values() for path in paths]
+
+    stats = Counter(unchanged=len(plan) - len(wanted))
+    for path in removes:
+        try:
+            os.remove(os.path.join(output_dir, path))
+        except FileNotFoundError:
+            pass
+        stats["removed"] += 1
+
+    for directory in sorted({os.path.dirname(path) for path in creates + [dst for _, dst in renames]}):
+        os.makedirs(os.path.join(output_dir, directory), exist_ok=True)
+
+    for src, dst in renames:
+        try:
+            os.replace(os.path.join(output_dir, src), os.path.join(output_dir, dst))
+            stats["renamed"] += 1
+        except FileNotFoundError:
+            creates.append(dst)
+
+    for path in creates:
+        src, dst = os.path.join(raw_dir, plan[path]), os.path.join(output_dir, path)
+        try:
+            link_or_copy(src, dst)
+        except FileNotFoundError:
+            # 由 keep_export_links 保留、raw 文件缺失且链接已不存在的路径
+            logger.warning(f"Raw file {plan[path]} is missing, {path} is not exported.")
+            continue
+        except FileExistsError:
+            # 旧版本导出或手动放置的文件, 内容不同时替换
+            if os.path.samefile(src, dst):
+                stats["unchanged"] += 1
+                continue
+            os.remove(dst)
+            link_or_copy(src, dst)
+        stats["created"] += 1
+
+    _remove_empty_dirs(output_dir, [os.path.dirname(path) for path in removes]
+                       + [os.path.dirname(src) for src, _ in renames])
+
+    with db.conn:
+        db.conn.executemany("DELETE FROM export_links WHERE path = ?",
+                            [(path, ) for path in stale])
+        db.conn.executemany("""
+            INSERT INTO export_links (path, raw_file) VALUES (?, ?)
+            ON CONFLICT(path) DO UPDATE SET raw_file = excluded.raw_file
+        """, [(path, plan[path]) for path in wanted])
+    logger.debug(f"Export links: {dict(stats)}")
+    return stats
+
+
+ARCHIVE_MANIFEST = "manifest.csv"
+ARCHIVE_MANIFEST_FIELDS = ("path", "file_token", "status", "belonger", "number", "date", "totalAmount", "size")
+ARCHIVE_TYPES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.zst")
+
+
+def check_archive_path(archive_path: str):
+    """检查压缩包类型是否受支持, 不支持时抛出 ValueError / RuntimeError"""
+    if not archive_path.endswith(ARCHIVE_TYPES):
+        raise ValueError(f"Unsupported archive type {{{archive_path}}}, use one of {ARCHIVE_TYPES}")
+    if archive_path.endswith(".tar.zst") and zstandard is None:
+        raise RuntimeError("zstandard is required to write .tar.zst archives.")
+
+
+def _open_tar(fileobj, archive_path: str):
+    """返回 (TarFile, zstd 压缩流 | None)"""
+    if archive_path.endswith(".tar.zst"):
+        stream = zstandard.ZstdCompressor(level=10).stream_writer(fileobj, closefd=False)
+        return tarfile.open(fileobj=stream, mode="w|"), stream
+    if archive_path.endswith((".tar.gz", ".tgz")):
+        return tarfile.open(fileobj=fileobj, mode="w|gz"), None
+    return tarfile.open(fileobj=fileobj, mode="w|"), None
+
+
+def write_archive(archive_path: str,
+                  raw_dir: str,
+                  entries: Iterable[Tuple[str, str, dict]]) -> int:
+    """
+    按导出路径将 raw 目录中的文件直接写入压缩包, 不创建导出目录树
+
+    entries 为 (导出路径, raw 目录下的文件名, 清单字段) 的迭代器, 路径重复时保留第一个.
+    文件逐个流式写入, 清单先写入临时文件, 最后以 manifest.csv 加入压缩包, 内存占用与压缩包大小无关.
+    支持 .zip / .tar / .tar.gz / .tar.zst (需要 zstandard), tar 中同一 raw 文件的其余路径保存为硬链接.
+    先写入 {archive_path}.tmp, 完成后原子替换.
+
+    Returns:
+        int: 写入的文件数量
+    """
+    check_archive_path(archive_path)
+    is_zip = archive_path.endswith(".zip")
+
+    tmp_path = f"{archive_path}.tmp"
+    seen, written = set(), {}
+    try:
+        with tempfile.TemporaryFile() as manifest, open(tmp_path, "wb") as f:
+            text = io.TextIOWrapper(manifest, encoding="utf-8-sig", newline="")
+            writer = csv.DictWriter(text, ARCHIVE_MANIFEST_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            if is_zip:
+                archive, stream = zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED), None
+            else:
+                archive, stream = _open_tar(f, archive_path)
+            with archive:
+                for path, raw_file, fields in entries:
+                    arcname = os.path.normpath(path).replace(os.sep, "/")
+                    if arcname in seen:
+                        continue
+                    seen.add(arcname)
+                    src = os.path.join(raw_dir, raw_file)
+                    if is_zip:
+                        # 发票多为 PDF/图片, 本身已压缩, 直接存储
+                        archive.write(src, arcname, compress_type=zipfile.ZIP_STORED)
+                    elif raw_file in written:
+                        info = tarfile.TarInfo(arcname)
+                        info.type, info.linkname = tarfile.LNKTYPE, written[raw_file]
+                        info.mtime = int(time.time())
+                        archive.addfile(info)
+                    else:
+                        archive.add(src, arcname, recursive=False)
+                        written[raw_file] = arcname
+                    writer.writerow({**fields, "path": arcname, "size": os.path.getsize(src)})
+
+                text.flush()
+                size = manifest.tell()
+                manifest.seek(0)
+                if is_zip:
+                    with archive.open(ARCHIVE_MANIFEST, "w") as dst:
+                        shutil.copyfileobj(manifest, dst)
+                else:
+                    info = tarfile.TarInfo(ARCHIVE_MANIFEST)
+                    info.size, info.mtime = size, int(time.time())
+                    archive.addfile(info, manifest)
+            if stream is not None:
+                stream.close()
+            text.detach()
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, archive_path)
+    return len(seen)
@@ -0,0 +1,170 @@
+import json
+import sqlite3
+from typing import *
+from sqlite_utils import Database
+from .utils import batched
+
+# trigram 分词器最短可检索长度, 更短的关键字回退为 instr 匹配
+TRIGRAM_MIN_LENGTH = 3
+
+
+def read_group_request(file_path: str) -> Tuple[dict, Iterator[Tuple[str, str]]]:
+    """
+    读取 group 参数文件
+
+    支持两种格式:
+    - JSON: {"key": ..., "like_match": ..., "case_insensitive": ..., "target": [{关键字: 状态}, ...]}
+    - NDJSON: 首行为不含 target 的参数对象, 之后每行为一个 {关键字: 状态} 对象, 逐行读取
+
+    Returns:
+        (参数 dict, (关键字, 状态) 迭代器)
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        first_line = f.readline()
+        try:
+            header = json.loads(first_line)
+        except ValueError:
+            header = None
+
+        if isinstance(header, dict) and "target" not in header:
+            def iter_entries():
+                with open(file_path, "r", encoding="utf-8") as f:
+                    f.readline()
+                    for line in f:
+                        if line.strip():
+                            yield from json.loads(line).items()
+
+            return header, iter_entries()
+
+        f.seek(0)
+        request = json.load(f)
+    if not isinstance(request.get("target"), list):
+        raise ValueError("target has wrong type.")
+    return request, (item for data in request["target"] for item in data.items())
+
+
+def trigram_available(db: Database) -> bool:
+    try:
+        db.conn.execute(
+            "CREATE VIRTUAL TABLE temp.group_trigram_probe USING fts5(value, tokenize='trigram')")
+        db.conn.execute("DROP TABLE temp.group_trigram_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def apply_group(db: Database,
+                key: str,
+                entries: Iterable[Tuple[str, str]],
+                like_match: bool = False,
+                case_insensitive: bool = True,
+                batch_size: int = 10000) -> dict:
+    """
+    将 {关键字: 状态} 映射批量写入 invoices.status
+
+    映射先载入带索引的临时表, 精确匹配以一次连接完成; 模糊匹配(子串)借助
+    临时的 FTS5 trigram 索引. 多个关键字命中同一发票时, 后出现的生效,
+    与逐条执行 UPDATE 的结果一致.
+
+    Returns:
+        dict: {"entries": 关键字数量, "matched": 命中发票的关键字数量,
+               "unmatched": 未命中的关键字数量, "updated": 更新的发票数量,
+               "unmatched_examples": [未命中的关键字, ...]}
+    """
+    if key not in db["invoices"].columns_dict:
+        raise ValueError(f"Unknown key {{{key}}}, not a column of invoices.")
+    column = f"invoices.[{key}]"
+    collation = "NOCASE" if case_insensitive else "BINARY"
+
+    conn = db.conn
+    try:
+        with conn:
+            conn.execute("""
+                CREATE TEMP TABLE group_targets (
+                    seq INTEGER PRIMARY KEY,
+                    keyword TEXT NOT NULL,
+                    status TEXT
+                )
+            """)
+            conn.execute("CREATE TEMP TABLE group_matches (invoice_rowid INTEGER, seq INTEGER)")
+            seq = 0
+            for batch in batched(entries, batch_size):
+                conn.executemany(
+                    "INSERT INTO group_targets (seq, keyword, status) VALUES (?, ?, ?)",
+                    ((seq + i, str(keyword), status)
+                     for i, (keyword, status) in enumerate(batch)))
+                seq += len(batch)
+
+            if not like_match:
+                conn.execute(
+                    f"CREATE INDEX temp.idx_group_targets_keyword ON group_targets(keyword COLLATE {collation})")
+                conn.execute(f"""
+                    INSERT INTO group_matches
+                    SELECT invoices.rowid, t.seq
+                    FROM invoices
+                    JOIN group_targets t ON t.keyword = {column} COLLATE {collation}
+                """)
+            else:
+                lower = (lambda expression: f"lower({expression})") if case_insensitive \
+                    else (lambda expression: expression)
+                instr_filter = "1"
+                if trigram_available(db):
+                    instr_filter = f"length(t.keyword) < {TRIGRAM_MIN_LENGTH}"
+                    conn.execute(f"""
+                        CREATE VIRTUAL TABLE temp.group_fts USING fts5(
+                            value, tokenize='trigram case_sensitive {0 if case_insensitive else 1}')
+                    """)
+                    conn.execute(f"""
+                        INSERT INTO group_fts (rowid, value)
+                        SELECT rowid, {column} FROM invoices WHERE {column} IS NOT NULL
+                    """)
+                    conn.execute(f"""
+                        INSERT INTO group_matches
+                        SELECT group_fts.rowid, t.seq
+                        FROM group_targets t
+                        CROSS JOIN group_fts
+                        WHERE length(t.keyword) >= {TRIGRAM_MIN_LENGTH}
+                          AND group_fts MATCH '"' || replace(t.keyword, '"', '""') || '"'
+                    """)
+                # trigram 不可用或关键字过短时, 逐对比较
+                conn.execute(f"""
+                    INSERT INTO group_matches
+                    SELECT invoices.rowid, t.seq
+                    FROM group_targets t
+                    JOIN invoices
+                    WHERE {instr_filter}
+                      AND instr({lower(column)}, {lower('t.keyword')}) > 0
+                """)
+
+            conn.execute("""
+                CREATE TEMP TABLE group_best AS
+                SELECT invoice_rowid, MAX(seq) AS seq FROM group_matches GROUP BY invoice_rowid
+            """)
+            conn.execute("CREATE UNIQUE INDEX temp.idx_group_best ON group_best(invoice_rowid)")
+            updated = conn.execute("""
+                UPDATE invoices
+                SET status = (
+                    SELECT t.status FROM group_best b JOIN group_targets t ON t.seq = b.seq
+                    WHERE b.invoice_rowid = invoices.rowid
+                )
+                WHERE rowid IN (SELECT invoice_rowid FROM group_best)
+            """).rowcount
+
+            total = conn.execute("SELECT COUNT(*) FROM group_targets").fetchone()[0]
+            matched = conn.execute("SELECT COUNT(DISTINCT seq) FROM group_matches").fetchone()[0]
+            unmatched_examples = [row[0] for row in conn.execute("""
+                SELECT keyword FROM group_targets
+                WHERE seq NOT IN (SELECT seq FROM group_matches)
+                ORDER BY seq LIMIT 10
+            """)]
+    finally:
+        for table in ("group_targets", "group_matches", "group_best", "group_fts"):
+            conn.execute(f"DROP TABLE IF EXISTS temp.{table}")
+
+    return {
+        "entries": total,
+        "matched": matched,
+        "unmatched": total - matched,
+        "updated": updated,
+        "unmatched_examples": unmatched_examples,
+    }
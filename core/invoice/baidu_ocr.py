@@ -2,6 +2,7 @@ import os
 import requests
 import urllib.parse
 import re
+from bisect import bisect_right
 from .base import *
 from ..log import logger
 BAIDU_API_KEY = os.getenv("BAIDU_API_KEY")
@@ -37,6 +38,54 @@ class BaiduOCR(object):
         response = requests.post(url, params=params)
         BaiduOCR.access_token = response.json().get("access_token", None)
 
+    # 商品各列 -> InvoiceItem 的设置方法
+    commodity_columns = (
+        ("CommodityName", InvoiceItem.set_name),
+        ("CommodityType", InvoiceItem.set_type),
+        ("CommodityUnit", InvoiceItem.set_unit),
+        ("CommodityNum", InvoiceItem.set_num),
+        ("CommodityPrice", InvoiceItem.set_unit_price),
+        ("CommodityAmount", InvoiceItem.set_amount),
+        ("CommodityTaxRate", InvoiceItem.set_tax_rate),
+        ("CommodityTax", InvoiceItem.set_tax),
+    )
+
+    @staticmethod
+    def merge_commodity_rows(results) -> List[InvoiceItem]:
+        """
+        合并多页识别结果中的商品行
+
+        各页的行号依次累加前面各页的最大行号, 以 CommodityAmount 所在行作为每个商品的起始行,
+        起始行之间(含折行)的各列文字依次拼接为该商品的字段值. 各列行数可以不一致.
+        逐页单遍处理, 每个单元格只访问一次, 不复制单元格也不构造补齐的中间列表.
+        """
+        keys = [key for key, _ in BaiduOCR.commodity_columns]
+        starts: List[int] = []
+        words: List[List[List[str]]] = []  # 商品 -> 列 -> 文字
+        row_offset = 0
+        for page in results:
+            for cell in page.get("CommodityAmount") or ():
+                starts.append(int(cell["row"]) + row_offset)
+                words.append([[] for _ in keys])
+            max_row = 0
+            for column, key in enumerate(keys):
+                for cell in page.get(key) or ():
+                    row = int(cell["row"])
+                    max_row = max(max_row, row)
+                    row += row_offset
+                    # 首个商品之前的文字(如表头)丢弃, 其余归入所在区间的商品
+                    if starts and row >= starts[0]:
+                        words[bisect_right(starts, row) - 1][column].append(cell["word"])
+            row_offset += max_row
+
+        items = []
+        for item_words in words:
+            item = InvoiceItem()
+            for (_, setter), column_words in zip(BaiduOCR.commodity_columns, item_words):
+                setter(item, "".join(column_words))
+            items.append(item)
+        return items
+
     @staticmethod
     def parse_vat_invoice(results):
 
@@ -80,110 +129,13 @@ class BaiduOCR(object):
         for field, key in params_dict.items():
             invoice.set_field(field, extract_param(results[-1], key))
 
-        all_lists = (
-            "CommodityName",
-            "CommodityType",
-            "CommodityUnit",
-            "CommodityNum",
-            "CommodityPrice",
-            "CommodityAmount",
-            "CommodityTaxRate",
-            "CommodityTax",
-        )
-        next_row_index = 0
-        items = {}
-        for key in all_lists:
-            items[key] = []
-        for page in results:
-            cache = {}
-            max_row = 0
-            for key in all_lists:
-                cache[key] = page.get(key, [])
-                if cache[key]:
-                    max_row = max(int(cache[key][-1]["row"]), max_row)
-            for key in all_lists:
-                for i in cache[key]:
-                    items[key].append({
-                        **i, "row":
-                        str(int(i["row"]) + next_row_index)
-                    })
-            next_row_index += max_row
-
-        format_str_list = {}
-        for key in all_lists:
-            format_str_list[key] = []
-            index = 0
-            for i in items[key]:
-                while index < int(i["row"]):
-                    format_str_list[key].append("")
-                    index += 1
-                format_str_list[key].append(i["word"])
-                index += 1
-
-        items_start_row_index = []
-        splice_string = lambda str_list, start, end: "".join(
-            [i for i in str_list[start:end]])
-        for i in items["CommodityAmount"]:
-            items_start_row_index.append(int(i["row"]))
-        items_start_row_index.append(int(next_row_index) + 1)
-        for i in range(len(items_start_row_index) - 1):
-            item = InvoiceItem()
-            item.set_name(
-                splice_string(
-                    format_str_list["CommodityName"],
-                    items_start_row_index[i],
-                    items_start_row_index[i + 1],
-                ))
-            item.set_type(
-                splice_string(
-                    format_str_list["CommodityType"],
-                    items_start_row_index[i],
-                    items_start_row_index[i + 1],
-                ))
-            item.set_unit(
-                splice_string(
-                    format_str_list["CommodityUnit"],
-                    items_start_row_index[i],
-                    items_start_row_index[i + 1],
-                ))
-            item.set_num(
-                splice_string(
-                    format_str_list["CommodityNum"],
-                    items_start_row_index[i],
-                    items_start_row_index[i + 1],
-                ))
-            item.set_unit_price(
-                splice_string(
-                    format_str_list["CommodityPrice"],
-                    items_start_row_index[i],
-                    items_start_row_index[i + 1],
-                ))
-            item.set_amount(
-                splice_string(
-                    format_str_list["CommodityAmount"],
-                    items_start_row_index[i],
-                    items_start_row_index[i + 1],
-                ))
-            item.set_tax_rate(
-                splice_string(
-                    format_str_list["CommodityTaxRate"],
-                    items_start_row_index[i],
-                    items_start_row_index[i + 1],
-                ))
-            item.set_tax(
-                splice_string(
-                    format_str_list["CommodityTax"],
-                    items_start_row_index[i],
-                    items_start_row_index[i + 1],
-                ))
+        for item in BaiduOCR.merge_commodity_rows(results):
             invoice.add_item(item)
 
         if not invoice._items:
             raise ValueError("No items found in the invoice.")
 
-        item_tag = re.findall(r"\*\S+\*", invoice._items[0].name)
-
-        invoice.set_field("item_tag", item_tag[0] if item_tag else "")
+        invoice.set_field("item_tag", extract_item_tag(invoice._items[0].name))
         invoice.set_field(
             "items_brief",
             invoice._items[0].name + (" 等" if len(invoice._items) > 1 else ""))
@@ -245,10 +197,29 @@ class BaiduOCR(object):
         return response
 
     @staticmethod
-    def vat_invoice_recognition(file_type: str, base64_data) -> Invoice:
+    def parse_vat_pages(pages: list) -> Invoice:
+        """由 增值税发票识别 接口各页的原始响应解析发票"""
+        return BaiduOCR.parse_vat_invoice([page["words_result"] for page in pages])
+
+    @staticmethod
+    def parse_multiple_pages(pages: list) -> Invoice:
+        """由 智能财务票据识别 接口各页的原始响应解析发票"""
+        results = [page["words_result"][0]['result'] for page in pages]
+        invoice_type = pages[-1]['words_result'][0]['type'] if pages else ""
+        if invoice_type == "vat_invoice":
+            return BaiduOCR.parse_vat_invoice(results)
+        elif invoice_type == "train_ticket":
+            return BaiduOCR.parse_train_ticket(results)
+        else:
+            raise ValueError(f"Unkown invoice type {{{invoice_type}}}")
+
+    @staticmethod
+    def vat_invoice_recognition(file_type: str, base64_data, on_response: Callable = None) -> Invoice:
         """
         增值税发票识别 免费接口1000次/月
 
+        on_response 不为 None 时以 ("baidu_vat_invoice", 各页原始响应) 调用, 用于存档.
+
         doc: https://cloud.baidu.com/doc/OCR/s/nk3h7xy2t
         """
         if not BaiduOCR.access_token:
@@ -260,7 +231,7 @@ class BaiduOCR(object):
             "Accept": "application/json",
         }
 
-        results = []
+        pages = []
         if file_type == "pdf":
             pdf_page_max = float("inf")
             pdf_page = 1
@@ -274,26 +245,28 @@ class BaiduOCR(object):
                 pdf_page += 1
                 pdf_page_max = min(pdf_page_max,
                                    int(page.get("pdf_file_size")))
-                results.append(page["words_result"])
+                pages.append(page)
         elif file_type == "image":
             payload = f"image={urllib.parse.quote_plus(base64_data)}&seal_tag=false"
             response = BaiduOCR.send("POST",
                                         url,
                                         headers=headers,
                                         data=payload.encode("utf-8"))
-            page = response.json()
-
-            results.append(page["words_result"])
+            pages.append(response.json())
         elif file_type == "ofd":
             pass
 
-        return BaiduOCR.parse_vat_invoice(results)
+        if on_response is not None:
+            on_response("baidu_vat_invoice", pages)
+        return BaiduOCR.parse_vat_pages(pages)
 
     @staticmethod
-    def multiple_invoice_recognition(file_type: str, base64_data) -> Invoice:
+    def multiple_invoice_recognition(file_type: str, base64_data, on_response: Callable = None) -> Invoice:
         """
         智能财务票据识别 免费接口50次/月
 
+        on_response 不为 None 时以 ("baidu_multiple_invoice", 各页原始响应) 调用, 用于存档.
+
         doc: https://cloud.baidu.com/doc/OCR/s/7ktb8md0j
         """
         if not BaiduOCR.access_token:
@@ -304,8 +277,7 @@ class BaiduOCR(object):
             "Content-Type": "application/x-www-form-urlencoded",
         }
 
-        results = []
-        invoice_type = ""
+        pages = []
         if file_type == "pdf":
             pdf_page_max = float("inf")
             pdf_page = 1
@@ -320,23 +292,17 @@ class BaiduOCR(object):
                 pdf_page += 1
                 pdf_page_max = min(pdf_page_max,
                                    int(page.get("pdf_file_size")))
-                invoice_type = page['words_result'][0]['type']
-                results.append(page["words_result"][0]['result'])
+                pages.append(page)
         elif file_type == "image":
             payload = f"image={urllib.parse.quote_plus(base64_data)}&seal_tag=false"
             response = BaiduOCR.send("POST",
                                         url,
                                         headers=headers,
                                         data=payload.encode("utf-8"))
-            page = response.json()
-            invoice_type = page['words_result'][0]['type']
-            results.append(page["words_result"][0]['result'])
+            pages.append(response.json())
         elif file_type == "ofd":
             pass
 
-        if invoice_type == "vat_invoice":
-            return BaiduOCR.parse_vat_invoice(results)
-        elif invoice_type == "train_ticket":
-            return BaiduOCR.parse_train_ticket(results)
-        else:
-            raise ValueError(f"Unkown invoice type {{{invoice_type}}}")
+        if on_response is not None:
+            on_response("baidu_multiple_invoice", pages)
+        return BaiduOCR.parse_multiple_pages(pages)
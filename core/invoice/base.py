@@ -1,6 +1,25 @@
+import json
+import re
 from typing import *
 
 
+def extract_item_tag(name) -> str:
+    """商品名称中的标签, 如 "*办公用品*纸张" -> "*办公用品*" """
+    tag = re.findall(r"\*\S+\*", name or "")
+    return tag[0] if tag else ""
+
+
+def _to_float(value):
+    # 支持带百分号的税率字符串（如 "3.00%" → 0.03）
+    if isinstance(value, str) and value.endswith("%"):
+        return float(value.strip('%')) / 100
+    return float(value)
+
+
+def _to_int(value):
+    return int(float(value))  # 有些值如 "5.0"
+
+
 class InvoiceItem:
     _types = {
         "name": "",
@@ -12,28 +31,32 @@ class InvoiceItem:
         "tax_rate": "0.00%",
         "tax": 0.0,
     }
+    # (字段, 默认值, 转换函数), 类型已正确的值不做转换
+    _converters = tuple(
+        (key, default, _to_float if isinstance(default, float) else
+         _to_int if isinstance(default, int) else str)
+        for key, default in _types.items())
 
-    def __init__(self, data):
-        for key, default in self._types.items():
-            value = data.get(key, default) if data else default
+    __slots__ = tuple(_types)
 
-            try:
-                # 尝试转换数据类型
-                if isinstance(default,float):
-                    # 支持带百分号的税率字符串（如 "3.00%" → 0.03）
-                    if isinstance(value, str) and value.endswith("%"):
-                        value = float(value.strip('%')) / 100
-                    else:
-                        value = float(value)
-                elif isinstance(default, int):
-                    value = int(float(value))  # 有些值如 "5.0"
-                elif isinstance(default, str):
-                    value = str(value)
-                else:
-                    value = default
-            except (ValueError, TypeError):
-                value = default  # 转换失败时使用默认值
-            self.__setattr__(key, value)
+    def __init__(self, data=None):
+        for key, default, convert in self._converters:
+            value = data.get(key, default) if data else default
+            if value.__class__ is not default.__class__:
+                try:
+                    # 尝试转换数据类型
+                    value = convert(value)
+                except (ValueError, TypeError):
+                    value = default  # 转换失败时使用默认值
+            setattr(self, key, value)
+
+    @classmethod
+    def from_trusted(cls, data: dict) -> "InvoiceItem":
+        """由类型已正确的数据(如数据库中保存的 items)直接构造, 跳过类型转换"""
+        item = cls.__new__(cls)
+        for key, default, _ in cls._converters:
+            setattr(item, key, data.get(key, default))
+        return item
 
     def set_name(self, name):
         self.name = name
@@ -85,17 +108,96 @@ class InvoiceItem:
         }
 
 
+class RowFields:
+    """
+    查询结果行(tuple / sqlite3.Row)的只读字段视图, 不复制数据
+
+    index 为 列名 -> 位置, 同一查询的所有行共用一份.
+    """
+    __slots__ = ("_row", "_index")
+
+    def __init__(self, row: Sequence, index: Dict[str, int]):
+        self._row = row
+        self._index = index
+
+    def get(self, key, default=None):
+        position = self._index.get(key)
+        return default if position is None else self._row[position]
+
+    def __getitem__(self, key):
+        return self._row[self._index[key]]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def to_dict(self) -> dict:
+        return dict(zip(self._index, self._row))
+
+
+# Invoice.data 中的文本字段
+_DATA_KEYS = (
+    "type",
+    "code",
+    "number",
+    "date",
+    "buyerTaxID",
+    "buyerName",
+    "buyerAddress",
+    "buyerBankAccount",
+    "sellerTaxID",
+    "sellerName",
+    "sellerAddress",
+    "sellerBankAccount",
+    "items_brief",
+    "items_unit",
+    "item_tag",
+    "payee",
+    "reviewer",
+    "noteDrawer",
+    "verificationCode",
+    "CRC",
+    "remark",
+    "item_num",
+    "total_items_num",
+)
+
+
 class Invoice:
+    __slots__ = ("_fields", "_items", "_data")
 
     def __init__(self, data=None):
+        """
+        data 为 None 时构造空发票(供 OCR 解析填充); 否则直接包装已有字段
+        (dict 或 RowFields, 不复制), 商品列表在首次访问时由字段 items 解析.
+        """
         if data is not None:
             self._fields = data
+            self._items: Optional[List[InvoiceItem]] = None
         else:
-            self._items: List[InvoiceItem] = []
             self._fields = {}
+            self._items = []
+        self._data = None
+
+    @classmethod
+    def from_row(cls, row: Sequence, index: Dict[str, int]) -> "Invoice":
+        """包装一行查询结果, index 为 列名 -> 位置"""
+        return cls(RowFields(row, index))
+
+    @classmethod
+    def from_cursor(cls, cursor) -> Iterator["Invoice"]:
+        """逐行包装 cursor 的查询结果"""
+        index = {column[0]: i for i, column in enumerate(cursor.description)}
+        for row in cursor:
+            yield cls(RowFields(row, index))
 
     def set_field(self, key, value):
+        if not isinstance(self._fields, dict):
+            self._fields = self._fields.to_dict()
         self._fields[key] = value
+        self._data = None
 
     def get_field(self, key, default=""):
         return self._fields.get(key, default)
@@ -106,50 +208,31 @@ class Invoice:
         except (ValueError, TypeError):
             return 0.0
 
-    @property
-    def items(self):
-        return [item.data for item in self._items]
+    def _load_items(self) -> List[InvoiceItem]:
+        if self._items is None:
+            items = self._fields.get("items")
+            if isinstance(items, str):
+                items = json.loads(items) if items else []
+            self._items = [InvoiceItem.from_trusted(item) for item in items or ()]
+        return self._items
 
     def add_item(self, item):
         if isinstance(item, InvoiceItem):
-            self._items.append(item)
+            self._load_items().append(item)
+            self._data = None
 
     @property
     def data(self):
-        keys = [
-            "type",
-            "code",
-            "number",
-            "date",
-            "buyerTaxID",
-            "buyerName",
-            "buyerAddress",
-            "buyerBankAccount",
-            "sellerTaxID",
-            "sellerName",
-            "sellerAddress",
-            "sellerBankAccount",
-            "items_brief",
-            "items_unit",
-            "item_tag",
-            "payee",
-            "reviewer",
-            "noteDrawer",
-            "verificationCode",
-            "CRC",
-            "remark",
-            "item_num",
-            "total_items_num",
-        ]
-        return {
-            k: self.get_field(k, "")
-            for k in keys
-        } | {
-            "items": self.items,
-            "amount": self.amount,
-            "taxAmount": self.taxAmount,
-            "totalAmount": self.totalAmount,
-        }
+        """全部字段组成的 dict, 结果在字段变更前缓存复用, 调用方不应修改"""
+        if self._data is None:
+            get = self._fields.get
+            data = {k: get(k, "") for k in _DATA_KEYS}
+            data["items"] = self.items
+            data["amount"] = self.amount
+            data["taxAmount"] = self.taxAmount
+            data["totalAmount"] = self.totalAmount
+            self._data = data
+        return self._data
 
     @property
     def type(self):
@@ -194,7 +277,7 @@ class Invoice:
     @property
     def items(self):
         """商品列表"""
-        return [item.data for item in self._items]
+        return [item.data for item in self._load_items()]
 
     @property
     def amount(self):
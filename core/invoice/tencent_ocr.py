@@ -1,13 +1,14 @@
 import os
 import requests
 import urllib.parse
-import re
 import hmac
 import time
 import hashlib
 import json
+import base64
 from datetime import datetime, timezone
 from .base import *
+from .tiling import tile_images, assign_regions
 from ..log import logger
 
 TENCENT_SecretId = os.getenv("TENCENT_SecretId")
@@ -156,9 +157,7 @@ class TencentOCR(object):
                     "tax_rate": item["TaxRate"],
                     "tax": item["Tax"],
                 }))
-        item_tag = re.findall(r"\*\S+\*", invoice._items[0].name)
-
-        invoice.set_field("item_tag", item_tag[0] if item_tag else "")
+        invoice.set_field("item_tag", extract_item_tag(invoice._items[0].name))
         invoice.set_field(
             "items_brief",
             invoice._items[0].name + (" 等" if len(invoice._items) > 1 else ""))
@@ -195,17 +194,20 @@ class TencentOCR(object):
         return invoice
 
     @staticmethod
-    def multiple_invoice_recognition(file_type: str, base64_data) -> Invoice:
-        """
-        通用票据识别（高级版） 免费接口1000次/月
+    def parse_pages(pages: list) -> Invoice:
+        """由 通用票据识别 接口的原始响应(Response 字段)解析发票"""
+        results = pages[0]["MixedInvoiceItems"]
 
-        doc: https://cloud.tencent.com/document/product/866/90802
-        """
-        if 'pdf' in file_type:
-            base64_data_with_type = 'data:application/pdf;base64,' + base64_data
-        elif 'image' in file_type:
-            base64_data_with_type = 'data:image/jpeg;base64,' + base64_data
+        invoice_type = results[0].get('SubType')
+        # 非动车发票一律认为是增值税发票
+        if invoice_type == "ElectronicTrainTicketFull":
+            return TencentOCR.parse_train_ticket(results, invoice_type)
+        else:
+            return TencentOCR.parse_vat_invoice(results, invoice_type)
 
+    @staticmethod
+    def recognize_general_invoice(base64_data_with_type: str) -> dict:
+        """调用 通用票据识别（高级版）, 返回原始响应的 Response 字段"""
         host = "ocr.tencentcloudapi.com"
         headers = {
             "Content-Type": "application/json",
@@ -218,16 +220,89 @@ class TencentOCR(object):
             "ImageBase64": base64_data_with_type,
             "EnableMultiplePage": True,
         }
-        results = []
-    
         response = TencentOCR.post(host,headers,data)
-        page = response.json().get('Response')
-        
-        results = page["MixedInvoiceItems"]
+        return response.json().get('Response')
 
-        invoice_type = results[0].get('SubType')
-        # 非动车发票一律认为是增值税发票
-        if invoice_type == "ElectronicTrainTicketFull":
-            return TencentOCR.parse_train_ticket(results, invoice_type)
-        else:
-            return TencentOCR.parse_vat_invoice(results, invoice_type)
+    @staticmethod
+    def multiple_invoice_recognition(file_type: str, base64_data, on_response: Callable = None) -> Invoice:
+        """
+        通用票据识别（高级版） 免费接口1000次/月
+
+        on_response 不为 None 时以 ("tencent_general_invoice", [原始响应]) 调用, 用于存档.
+
+        doc: https://cloud.tencent.com/document/product/866/90802
+        """
+        if 'pdf' in file_type:
+            base64_data_with_type = 'data:application/pdf;base64,' + base64_data
+        elif 'image' in file_type:
+            base64_data_with_type = 'data:image/jpeg;base64,' + base64_data
+
+        pages = [TencentOCR.recognize_general_invoice(base64_data_with_type)]
+
+        if on_response is not None:
+            on_response("tencent_general_invoice", pages)
+        return TencentOCR.parse_pages(pages)
+
+    @staticmethod
+    def _polygon_rect(polygon: dict) -> Optional[Tuple[int, int, int, int]]:
+        """Polygon (LeftTop / RightTop / RightBottom / LeftBottom 四个顶点) -> 外接矩形 (x, y, 宽, 高)"""
+        try:
+            points = [polygon[corner] for corner in ("LeftTop", "RightTop", "RightBottom", "LeftBottom")]
+            xs, ys = [point["X"] for point in points], [point["Y"] for point in points]
+        except (KeyError, TypeError):
+            return None
+        return min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys)
+
+    @staticmethod
+    def _shift_points(value, dx: int, dy: int):
+        """返回将 value 中所有坐标点 ({X, Y}) 平移 (-dx, -dy) 后的副本"""
+        if isinstance(value, list):
+            return [TencentOCR._shift_points(item, dx, dy) for item in value]
+        if not isinstance(value, dict):
+            return value
+        shifted = {key: TencentOCR._shift_points(item, dx, dy) for key, item in value.items()}
+        if isinstance(value.get("X"), (int, float)) and isinstance(value.get("Y"), (int, float)):
+            shifted["X"], shifted["Y"] = value["X"] - dx, value["Y"] - dy
+        return shifted
+
+    @staticmethod
+    def batch_invoice_recognition(contents: List[bytes]) -> List[Optional[list]]:
+        """
+        将多张小图拼接为一张后调用一次 通用票据识别, 按识别结果的位置(Polygon)分配回各图片
+
+        返回与 contents 一一对应的原始响应 (格式同 multiple_invoice_recognition 存档的 pages,
+        只含该图片的一张发票, Polygon / ItemPolygon 坐标换算回原图), 可直接交给 parse_pages 解析.
+        以下情况无法确定归属, 对应位置为 None, 应单独识别:
+        - 图片中识别出 0 张或多张发票
+        - 识别结果跨越多张图片 (涉及的图片均为 None), 或不在任何图片内 (全部为 None)
+        - 请求失败 (全部为 None)
+        """
+        try:
+            canvas, boxes = tile_images(contents)
+            response = TencentOCR.recognize_general_invoice(
+                'data:image/jpeg;base64,' + base64.b64encode(canvas).decode("utf-8"))
+            if "Error" in response:
+                raise ValueError(response["Error"].get("Message"))
+        except Exception as e:
+            logger.warning(f"Batch recognition of {len(contents)} images failed: {e}")
+            return [None] * len(contents)
+        return TencentOCR.split_batch_response(response, boxes)
+
+    @staticmethod
+    def split_batch_response(response: dict, boxes: List[Tuple[int, int, int, int]]) -> List[Optional[list]]:
+        """按 boxes (各图片在画布中的 (x, y, 宽, 高)) 拆分拼接识别的响应, 见 batch_invoice_recognition"""
+        items = response.get("MixedInvoiceItems") or []
+        rects = [TencentOCR._polygon_rect(item.get("Polygon")) for item in items]
+        results = []
+        for indexes, (x, y, _, _) in zip(assign_regions(rects, boxes), boxes):
+            if indexes is None or len(indexes) != 1:
+                results.append(None)
+                continue
+            item = dict(items[indexes[0]])
+            for key in ("Polygon", "ItemPolygon"):
+                if key in item:
+                    item[key] = TencentOCR._shift_points(item[key], x, y)
+            results.append([{**response, "MixedInvoiceItems": [item]}])
+        logger.debug(
+            f"Batch recognition: {sum(r is not None for r in results)}/{len(boxes)} images assigned.")
+        return results
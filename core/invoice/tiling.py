@@ -0,0 +1,91 @@
+import io
+import math
+from typing import *
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# 长边不超过 TILE_MAX_SIDE 的图片才参与拼接, 每张画布最多 MAX_TILES 张, 画布长边不超过 4000
+TILE_MAX_SIDE = 1600
+MAX_TILES = 4
+# 图片之间留白, 避免相邻发票被识别为一张
+TILE_GAP = 80
+# 识别结果的区域至少有该比例落在某张图片内才归属于它
+MIN_OVERLAP = 0.9
+
+
+def is_tileable(content: bytes) -> bool:
+    """图片能否参与拼接 (只读取文件头)"""
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            return max(image.size) <= TILE_MAX_SIDE
+    except Exception:
+        return False
+
+
+def tile_images(contents: List[bytes]) -> Tuple[bytes, List[Tuple[int, int, int, int]]]:
+    """
+    将多张图片按行拼接为一张 JPEG 画布, 图片之间及四周以白色留白
+
+    Returns:
+        (画布内容, 各图片在画布中的 (x, y, 宽, 高))
+    """
+    if not 0 < len(contents) <= MAX_TILES:
+        raise ValueError(f"Can tile 1 to {MAX_TILES} images, got {len(contents)}.")
+    images = []
+    for content in contents:
+        with Image.open(io.BytesIO(content)) as image:
+            images.append(ImageOps.exif_transpose(image).convert("RGB"))
+
+    columns = math.ceil(math.sqrt(len(images)))
+    boxes, width, y = [], 0, TILE_GAP
+    for start in range(0, len(images), columns):
+        row = images[start:start + columns]
+        x = TILE_GAP
+        for image in row:
+            boxes.append((x, y, image.width, image.height))
+            x += image.width + TILE_GAP
+        width = max(width, x)
+        y += max(image.height for image in row) + TILE_GAP
+
+    canvas = Image.new("RGB", (width, y), "white")
+    for image, (x, y, _, _) in zip(images, boxes):
+        canvas.paste(image, (x, y))
+    buffer = io.BytesIO()
+    canvas.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue(), boxes
+
+
+def _overlap(rect: Tuple[int, int, int, int], box: Tuple[int, int, int, int]) -> int:
+    width = min(rect[0] + rect[2], box[0] + box[2]) - max(rect[0], box[0])
+    height = min(rect[1] + rect[3], box[1] + box[3]) - max(rect[1], box[1])
+    return max(width, 0) * max(height, 0)
+
+
+def assign_regions(rects: List[Optional[Tuple[int, int, int, int]]],
+                   boxes: List[Tuple[int, int, int, int]]) -> List[Optional[List[int]]]:
+    """
+    识别结果的区域 (x, y, 宽, 高) -> 各图片包含的区域下标
+
+    区域至少 MIN_OVERLAP 落在某张图片内时归属于它. 否则无法确定归属:
+    与之重叠的图片均为 None, 区域缺失或不与任何图片重叠时全部为 None.
+    """
+    assigned: List[Optional[List[int]]] = [[] for _ in boxes]
+    ambiguous = set()
+    for index, rect in enumerate(rects):
+        if rect is None or rect[2] <= 0 or rect[3] <= 0:
+            ambiguous.update(range(len(boxes)))
+            continue
+        overlaps = [_overlap(rect, box) for box in boxes]
+        best = max(range(len(boxes)), key=overlaps.__getitem__)
+        if overlaps[best] >= MIN_OVERLAP * rect[2] * rect[3]:
+            assigned[best].append(index)
+        elif any(overlaps):
+            ambiguous.update(i for i, overlap in enumerate(overlaps) if overlap)
+        else:
+            ambiguous.update(range(len(boxes)))
+    for index in ambiguous:
+        assigned[index] = None
+    return assigned
@@ -0,0 +1,263 @@
+import hashlib
+import heapq
+import importlib
+import time
+from collections import Counter
+from types import ModuleType
+from typing import *
+from sqlite_utils import Database
+from .db import ensure_invoice_items
+
+# 开票日期统一为 YYYY-MM-DD 便于比较 ("2024年05月01日" -> "2024-05-01")
+NORMALIZED_DATE_SQL = "replace(replace(replace({column}, '年', '-'), '月', '-'), '日', '')"
+
+NUMERIC_FIELDS = {"amount", "taxAmount", "totalAmount", "item_num", "total_items_num"}
+
+# invoice_items 表中可用于商品条件的字段
+ITEM_FIELDS = {"name", "tag", "unit", "num", "unit_price", "amount", "tax_rate", "tax"}
+ITEM_NUMERIC_FIELDS = {"num", "unit_price", "amount", "tax"}
+
+
+class RuleError(ValueError):
+    pass
+
+
+def _compile_condition(field: str,
+                       condition,
+                       columns: Set[str],
+                       numeric_fields: Set[str] = NUMERIC_FIELDS,
+                       table: str = "invoices") -> Tuple[str, list]:
+    """单个字段条件 -> (SQL 表达式, 参数)"""
+    if field not in columns:
+        raise RuleError(f"Unknown field {{{field}}} in rule.")
+    column = f"{table}.[{field}]"
+    text = f"COALESCE({column}, '')"
+    number = f"CAST({column} AS REAL)"
+    date = NORMALIZED_DATE_SQL.format(column=text)
+
+    if not isinstance(condition, dict):
+        condition = {"in": condition} if isinstance(condition, (list, tuple)) \
+            else {"eq": condition}
+
+    parts, params = [], []
+    for operator, value in condition.items():
+        if operator in ("in", "not_in"):
+            values = list(value)
+            placeholders = ", ".join("?" for _ in values)
+            negate = "NOT " if operator == "not_in" else ""
+            parts.append(f"{text} {negate}IN ({placeholders})")
+            params.extend(values)
+        elif operator in ("eq", "ne"):
+            target = number if field in numeric_fields else text
+            parts.append(f"{target} {'=' if operator == 'eq' else '!='} ?")
+            params.append(value)
+        elif operator in ("contains", "not_contains"):
+            values = [value] if isinstance(value, str) else list(value)
+            expression = " OR ".join(f"instr({text}, ?) > 0" for _ in values)
+            parts.append(f"{'NOT ' if operator == 'not_contains' else ''}({expression})")
+            params.extend(values)
+        elif operator in ("gt", "ge", "lt", "le"):
+            symbol = {"gt": ">", "ge": ">=", "lt": "<", "le": "<="}[operator]
+            parts.append(f"{number} {symbol} ?")
+            params.append(float(value))
+        elif operator in ("before", "after"):
+            parts.append(f"{date} {'<' if operator == 'before' else '>'} ?")
+            params.append(value)
+        else:
+            raise RuleError(f"Unknown operator {{{operator}}} for field {{{field}}}.")
+    return " AND ".join(f"({part})" for part in parts), params
+
+
+def _compile_when(when: dict, columns: Set[str]) -> Tuple[str, list]:
+    """条件组: 各字段条件取 AND, "any" 为子条件组列表取 OR"""
+    parts, params = [], []
+    for field, condition in when.items():
+        if field == "items":
+            # 商品条件: 存在至少一个满足全部条件的商品
+            item_parts = []
+            for item_field, item_condition in condition.items():
+                sql, sub_params = _compile_condition(item_field, item_condition,
+                                                     ITEM_FIELDS, ITEM_NUMERIC_FIELDS,
+                                                     "invoice_items")
+                item_parts.append(f"({sql})")
+                params.extend(sub_params)
+            if not item_parts:
+                raise RuleError("Empty items condition in rule.")
+            parts.append(f"""EXISTS (
+                SELECT 1 FROM invoice_items
+                WHERE invoice_items.file_token = invoices.file_token
+                  AND {' AND '.join(item_parts)})""")
+        elif field == "any":
+            sub_parts = []
+            for sub_when in condition:
+                sql, sub_params = _compile_when(sub_when, columns)
+                sub_parts.append(f"({sql})")
+                params.extend(sub_params)
+            parts.append(" OR ".join(sub_parts))
+        else:
+            sql, sub_params = _compile_condition(field, condition, columns)
+            parts.append(sql)
+            params.extend(sub_params)
+    if not parts:
+        raise RuleError("Empty condition in rule.")
+    return " AND ".join(f"({part})" for part in parts), params
+
+
+def compile_rules(rules: List[dict], columns: Iterable[str]) -> Tuple[str, list]:
+    """
+    声明式规则 -> UPDATE 语句
+
+    规则按顺序匹配, 命中第一条的发票置为 -2 并写入该规则的 message,
+    与 vertify_invoice 中 if/elif 的语义一致. 返回的语句需追加 scope 条件参数.
+    """
+    columns = set(columns)
+    cases, case_params, conditions, condition_params = [], [], [], []
+    for rule in rules:
+        if "when" not in rule or "message" not in rule:
+            raise RuleError(f"Rule must have 'when' and 'message': {rule}")
+        sql, params = _compile_when(rule["when"], columns)
+        cases.append(f"WHEN {sql} THEN ?")
+        case_params.extend(params + [rule["message"]])
+        conditions.append(f"({sql})")
+        condition_params.extend(params)
+    statement = f"""
+        UPDATE invoices
+        SET error_message = CASE {' '.join(cases)} END,
+            status = '-2'
+        WHERE processed AND ({' OR '.join(conditions)}) AND ({{scope}})
+    """
+    return statement, case_params + condition_params
+
+
+def apply_rules(db: Database,
+                rules: List[dict],
+                scope: str = "1",
+                scope_params: Sequence = ()) -> int:
+    """在一个事务内对 scope 范围内的已处理发票执行声明式规则, 返回未通过校验的数量"""
+    statement, params = compile_rules(rules, db["invoices"].columns_dict)
+    if "invoice_items" in statement:
+        # 商品条件依赖 invoice_items, 旧数据库中由 invoices.items 回填
+        ensure_invoice_items(db)
+    with db.conn:
+        cursor = db.conn.execute(statement.format(scope=scope),
+                                 params + list(scope_params))
+    return cursor.rowcount
+
+
+def rule_fingerprint(module: ModuleType) -> str:
+    """
+    自定义规则模块的指纹
+
+    模块定义了 RULES_VERSION 时直接使用该版本号, 否则取模块源文件的哈希.
+    """
+    version = getattr(module, "RULES_VERSION", None)
+    if version is not None:
+        return f"v:{version}"
+    with open(module.__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def evaluate_python_rules(module_name: str,
+                          columns: Sequence[str],
+                          rows: List[tuple]) -> List[Tuple[str, Optional[dict], Optional[str]]]:
+    """
+    对一组发票执行 {module_name}.vertify_invoice, 可在子进程中运行
+
+    rows 为按 columns 排列的查询结果行, 直接包装为 Invoice 而不转换为 dict.
+    单张发票出错不影响其余发票.
+
+    Returns:
+        list: [(file_token, 校验结果 | None, 错误信息 | None), ...], 顺序与输入一致
+    """
+    from .invoice import Invoice
+    module = importlib.import_module(module_name)
+    index = {column: i for i, column in enumerate(columns)}
+    token_position = index["file_token"]
+    results = []
+    for row in rows:
+        try:
+            result = module.vertify_invoice(Invoice.from_row(row, index))
+            results.append((row[token_position], {
+                "status": result["status"],
+                "message": result.get("message"),
+            }, None))
+        except Exception as e:
+            results.append((row[token_position], None, str(e)))
+    return results
+
+
+def profile_python_rules(module: ModuleType, rows: Iterable[dict], top: int = 10) -> dict:
+    """
+    只读地对每张发票执行 module.vertify_invoice 并统计
+
+    Returns:
+        dict:
+        {
+            "total": 发票数量,
+            "outcomes": Counter({"success"|"error"|"exception": 数量}),
+            "messages": Counter({未通过校验的 message: 数量}),
+            "latency": {"p50"|"p90"|"p99"|"max": 秒},
+            "slowest": [(耗时, file_token), ...],
+            "diff": Counter({"newly_failed"|"message_changed"|"would_pass": 数量}),
+            "diff_examples": {类别: [file_token, ...]},
+        }
+        diff 为规则结果与数据库中已存储状态(status/error_message)的差异
+    """
+    from .invoice import Invoice
+    outcomes, messages, diff = Counter(), Counter(), Counter()
+    diff_examples: Dict[str, List[str]] = {}
+    latencies, slowest = [], []
+    for row in rows:
+        start = time.perf_counter()
+        try:
+            result = module.vertify_invoice(Invoice(row))
+            outcome = result["status"]
+            message = result.get("message")
+        except Exception as e:
+            outcome, message = "exception", f"{type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - start
+
+        latencies.append(elapsed)
+        if len(slowest) < top:
+            heapq.heappush(slowest, (elapsed, row["file_token"]))
+        else:
+            heapq.heappushpop(slowest, (elapsed, row["file_token"]))
+        outcomes[outcome] += 1
+        if outcome != "success":
+            messages[message] += 1
+
+        change = None
+        stored_failed = str(row.get("status")) == "-2"
+        if outcome == "error" and not stored_failed:
+            change = "newly_failed"
+        elif outcome == "error" and row.get("error_message") != message:
+            change = "message_changed"
+        elif outcome == "success" and stored_failed:
+            change = "would_pass"
+        if change:
+            diff[change] += 1
+            examples = diff_examples.setdefault(change, [])
+            if len(examples) < top:
+                examples.append(row["file_token"])
+
+    latencies.sort()
+
+    def percentile(p):
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    return {
+        "total": len(latencies),
+        "outcomes": outcomes,
+        "messages": messages,
+        "latency": {
+            "p50": percentile(0.50),
+            "p90": percentile(0.90),
+            "p99": percentile(0.99),
+            "max": latencies[-1] if latencies else 0.0,
+        },
+        "slowest": sorted(slowest, reverse=True),
+        "diff": diff,
+        "diff_examples": diff_examples,
+    }
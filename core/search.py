@@ -0,0 +1,169 @@
+from typing import *
+from sqlite_utils import Database
+from .group import TRIGRAM_MIN_LENGTH, trigram_available
+from .rules import NORMALIZED_DATE_SQL
+
+# invoice_search 中的检索字段 -> invoices 中的来源
+SEARCH_COLUMNS = {
+    "seller": "NEW.sellerName",
+    "buyer": "NEW.buyerName",
+    "items": """(
+        SELECT group_concat(json_extract(value, '$.name'), ' ')
+        FROM json_each(CASE WHEN json_valid(NEW.items) THEN NEW.items ELSE '[]' END)
+    )""",
+    "remark": "NEW.remark",
+}
+SEARCH_SOURCE_COLUMNS = {"sellerName", "buyerName", "items", "remark"}
+_INVOICE_DATE_SQL = NORMALIZED_DATE_SQL.format(column="date")
+
+
+def ensure_invoice_search(db: Database) -> bool:
+    """
+    创建 FTS5 trigram 全文索引 invoice_search (销售方、购买方、商品名称、备注) 及查询用的索引
+
+    invoices 表上的触发器在插入、删除及上述字段更新时同步索引, 首次创建时由已有发票回填.
+    SQLite 不支持 trigram 分词器或 invoices 缺少上述字段时返回 False, 查询退回 LIKE 扫描.
+    """
+    if not db["invoices"].exists():
+        return False
+    columns = db["invoices"].columns_dict
+    with db.conn:
+        if "status" in columns:
+            db.conn.execute("CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices(status)")
+        if "totalAmount" in columns:
+            db.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_invoices_total_amount ON invoices(totalAmount)")
+        if "date" in columns:
+            db.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_invoices_normalized_date ON invoices({_INVOICE_DATE_SQL})")
+        if db["attachments"].exists():
+            db.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_attachments_belonger ON attachments(belonger)")
+
+    if db["invoice_search"].exists():
+        return True
+    if not SEARCH_SOURCE_COLUMNS <= set(columns) or not trigram_available(db):
+        return False
+
+    fields = ", ".join(SEARCH_COLUMNS)
+    values = ", ".join(SEARCH_COLUMNS.values())
+    insert = f"""
+        INSERT OR REPLACE INTO invoice_search (rowid, file_token, {fields})
+        VALUES (NEW.rowid, NEW.file_token, {values});
+    """
+    delete = "DELETE FROM invoice_search WHERE rowid = OLD.rowid;"
+    with db.conn:
+        db.conn.execute(f"""
+            CREATE VIRTUAL TABLE invoice_search USING fts5(
+                file_token UNINDEXED, {fields}, tokenize='trigram'
+            )
+        """)
+        db.conn.execute(f"""
+            CREATE TRIGGER invoice_search_insert AFTER INSERT ON invoices
+            BEGIN {insert} END
+        """)
+        db.conn.execute(f"""
+            CREATE TRIGGER invoice_search_update
+            AFTER UPDATE OF file_token, {", ".join(sorted(SEARCH_SOURCE_COLUMNS))} ON invoices
+            BEGIN {delete} {insert} END
+        """)
+        db.conn.execute(f"""
+            CREATE TRIGGER invoice_search_delete AFTER DELETE ON invoices
+            BEGIN {delete} END
+        """)
+        # 回填时以 invoices 代替 NEW
+        db.conn.execute(f"""
+            INSERT INTO invoice_search (rowid, file_token, {fields})
+            SELECT rowid, file_token, {values.replace("NEW.", "invoices.")}
+            FROM invoices
+        """)
+    return True
+
+
+def _escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _search_condition(terms: Dict[Optional[str], str], fts: bool) -> Tuple[str, list]:
+    """
+    {字段 | None(全部字段): 文本} -> 子串匹配条件
+
+    每个字段按空白拆分为多个词, 所有词都需出现. 使用 FTS5 时不少于 3 个字的词走 MATCH,
+    更短的词在 invoice_search 上以 LIKE 过滤; 不使用 FTS5 时直接在 invoices 上 LIKE 扫描.
+    """
+    sources = {
+        "seller": "i.sellerName", "buyer": "i.buyerName",
+        "items": "i.items", "remark": "i.remark",
+    }
+    matches, likes, params = [], [], []
+    for field, text in terms.items():
+        for word in text.split():
+            if fts and len(word) >= TRIGRAM_MIN_LENGTH:
+                phrase = '"' + word.replace('"', '""') + '"'
+                matches.append(f"{{{field}}} : {phrase}" if field else phrase)
+                continue
+            fields = [field] if field else list(SEARCH_COLUMNS)
+            if fts:
+                columns = [f"invoice_search.{name}" for name in fields]
+            else:
+                columns = [sources[name] for name in fields]
+            likes.append("(" + " OR ".join(f"{column} LIKE ? ESCAPE '\\'" for column in columns) + ")")
+            params.extend([f"%{_escape_like(word)}%"] * len(columns))
+
+    if not fts:
+        return " AND ".join(likes), params
+    conditions = []
+    if matches:
+        conditions.append("invoice_search MATCH ?")
+        params.insert(0, " AND ".join(matches))
+    conditions.extend(likes)
+    return f"""i.rowid IN (
+        SELECT rowid FROM invoice_search WHERE {" AND ".join(conditions)}
+    )""", params
+
+
+def search_conditions(db: Database,
+                      text: Optional[str] = None,
+                      seller: Optional[str] = None,
+                      buyer: Optional[str] = None,
+                      item: Optional[str] = None,
+                      remark: Optional[str] = None,
+                      date_from: Optional[str] = None,
+                      date_to: Optional[str] = None,
+                      min_amount: Optional[float] = None,
+                      max_amount: Optional[float] = None,
+                      status: Optional[Sequence[str]] = None,
+                      belonger: Optional[str] = None) -> Tuple[str, list]:
+    """
+    查询条件 -> (WHERE 子句, 参数), 字段以 invoices i / attachments a 为别名
+
+    文本条件为子串匹配 (text 匹配任一字段), 日期为 YYYY-MM-DD 闭区间, 金额为价税合计闭区间.
+    """
+    fts = ensure_invoice_search(db)
+    conditions, params = [], []
+    terms = {field: value for field, value in (
+        (None, text), ("seller", seller), ("buyer", buyer), ("items", item), ("remark", remark)) if value}
+    if terms:
+        condition, condition_params = _search_condition(terms, fts)
+        if condition:
+            conditions.append(condition)
+            params.extend(condition_params)
+    if date_from:
+        conditions.append(f"{NORMALIZED_DATE_SQL.format(column='i.date')} >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append(f"{NORMALIZED_DATE_SQL.format(column='i.date')} <= ?")
+        params.append(date_to)
+    if min_amount is not None:
+        conditions.append("i.totalAmount >= ?")
+        params.append(min_amount)
+    if max_amount is not None:
+        conditions.append("i.totalAmount <= ?")
+        params.append(max_amount)
+    if status:
+        conditions.append(f"i.status IN ({', '.join('?' for _ in status)})")
+        params.extend(status)
+    if belonger:
+        conditions.append("a.belonger = ?")
+        params.append(belonger)
+    return " AND ".join(conditions), params
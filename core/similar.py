@@ -0,0 +1,149 @@
+import io
+from typing import *
+from sqlite_utils import Database
+from .log import logger
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+SIMILAR_MESSAGE = "This image looks like the one in file_token: "
+
+# dHash 缩略图尺寸: (HASH_SIZE + 1) x HASH_SIZE, 共 HASH_SIZE ** 2 = 64 位
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def dhash(content: bytes) -> Optional[int]:
+    """
+    图像内容 -> 64 位 dHash, 无法解码时返回 None
+
+    先按 EXIF 方向摆正并转为灰度、拉伸对比度, 再缩放为 9x8 缩略图, 比较每行相邻像素的明暗.
+    重新拍摄的同一张发票(尺寸、压缩、亮度不同)得到的哈希只相差少量位.
+    """
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image.draft("L", (HASH_SIZE * 16, HASH_SIZE * 16))
+            image = ImageOps.exif_transpose(image).convert("L")
+            image = ImageOps.autocontrast(image).resize((HASH_SIZE + 1, HASH_SIZE),
+                                                        Image.BILINEAR)
+            pixels = list(image.getdata())
+    except Exception as e:
+        logger.debug(f"Failed to hash image: {e}")
+        return None
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _to_signed(value: int) -> int:
+    # SQLite INTEGER 为有符号 64 位
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def ensure_image_hashes(db: Database):
+    with db.conn:
+        db.conn.execute("""
+            CREATE TABLE IF NOT EXISTS image_hashes (
+                file_token TEXT PRIMARY KEY,
+                dhash INTEGER NOT NULL
+            )
+        """)
+
+
+class ImageHashIndex:
+    """
+    发票图像的感知哈希索引, 用于在 OCR 前发现重新拍摄/重新上传的同一张发票
+
+    哈希保存在 image_hashes 表; 内存中以多索引哈希查找: 64 位哈希切分为 threshold + 1 段,
+    距离不超过 threshold 的两个哈希至少有一段完全相同 (抽屉原理), 只需比较同段相同的候选.
+    只有已成功识别、且本身不是重复/相似发票的图像作为查找对象.
+    与 ResponseArchive 相同, 新哈希缓存后按批写入.
+    """
+
+    def __init__(self, db: Database, threshold: int = 6, batch_size: Optional[int] = 200):
+        if not 0 <= threshold < HASH_BITS:
+            raise ValueError(f"threshold must be between 0 and {HASH_BITS - 1}")
+        self.db = db
+        self.threshold = threshold
+        self.batch_size = batch_size
+        bands = threshold + 1
+        # 各段 (起始位, 掩码), 位数尽量平均
+        self._bands = [
+            (i * HASH_BITS // bands, (1 << ((i + 1) * HASH_BITS // bands - i * HASH_BITS // bands)) - 1)
+            for i in range(bands)
+        ]
+        self._tables: List[Dict[int, List[Tuple[int, str]]]] = [{} for _ in self._bands]
+        self._hashes: Dict[str, int] = {}
+        self._pending: Dict[str, int] = {}
+        ensure_image_hashes(db)
+
+    @classmethod
+    def load(cls, db: Database, threshold: int = 6) -> "ImageHashIndex":
+        index = cls(db, threshold)
+        if not db["invoices"].exists():
+            return index
+        columns = db["invoices"].columns_dict
+        conditions = ["invoices.processed"]
+        for column in ("duplicate_of", "similar_to"):
+            if column in columns:
+                conditions.append(f"invoices.{column} IS NULL")
+        rows = db.execute(f"""
+            SELECT image_hashes.file_token, image_hashes.dhash
+            FROM image_hashes JOIN invoices ON invoices.file_token = image_hashes.file_token
+            WHERE {" AND ".join(conditions)}
+            ORDER BY invoices.rowid
+        """).fetchall()
+        for file_token, value in rows:
+            index.add(file_token, value & ((1 << 64) - 1))
+        logger.debug(f"Loaded {len(rows)} image hashes.")
+        return index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def find(self, value: int) -> Optional[Tuple[str, int]]:
+        """返回距离最近 (相同时取最早加入) 且不超过 threshold 的 (file_token, 距离)"""
+        best = None
+        for (shift, mask), table in zip(self._bands, self._tables):
+            for order, file_token in table.get((value >> shift) & mask, ()):
+                distance = hamming(value, self._hashes[file_token])
+                if distance <= self.threshold and (best is None or (distance, order) < best[:2]):
+                    best = (distance, order, file_token)
+        return (best[2], best[0]) if best else None
+
+    def add(self, file_token: str, value: int):
+        """将已识别的图像加入查找对象"""
+        if file_token in self._hashes:
+            return
+        self._hashes[file_token] = value
+        order = len(self._hashes)
+        for (shift, mask), table in zip(self._bands, self._tables):
+            table.setdefault((value >> shift) & mask, []).append((order, file_token))
+
+    def record(self, file_token: str, value: int):
+        """将图像的哈希写入 image_hashes 表 (不加入查找对象)"""
+        self._pending[file_token] = value
+        if self.batch_size and len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        with self.db.conn:
+            self.db.conn.executemany("""
+                INSERT INTO image_hashes (file_token, dhash) VALUES (?, ?)
+                ON CONFLICT(file_token) DO UPDATE SET dhash = excluded.dhash
+            """, [(file_token, _to_signed(value)) for file_token, value in self._pending.items()])
+        self._pending.clear()
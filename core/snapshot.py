@@ -0,0 +1,321 @@
+import csv
+import os
+import shutil
+from typing import *
+from sqlite_utils import Database
+from .db import ensure_invoice_items
+from .log import logger
+from .rules import NORMALIZED_DATE_SQL
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+SNAPSHOT_FORMATS = ("parquet", "arrow", "csv")
+SNAPSHOT_CHUNK_SIZE = 50000
+
+# 快照中各表的字段及类型 (string / float / int), 以 month 结尾的表可按月分区
+INVOICE_SNAPSHOT_COLUMNS = (
+    ("file_token", "string"), ("type", "string"), ("code", "string"), ("number", "string"),
+    ("date", "string"), ("buyerName", "string"), ("buyerTaxID", "string"),
+    ("sellerName", "string"), ("sellerTaxID", "string"), ("items_brief", "string"),
+    ("remark", "string"), ("item_num", "int"), ("total_items_num", "int"),
+    ("amount", "float"), ("taxAmount", "float"), ("totalAmount", "float"),
+    ("status", "string"), ("error_message", "string"), ("duplicate_of", "string"),
+    ("uploader", "string"), ("uploader_id", "string"), ("belonger", "string"),
+    ("belonger_id", "string"), ("month", "string"),
+)
+ITEM_SNAPSHOT_COLUMNS = (
+    ("file_token", "string"), ("position", "int"), ("name", "string"), ("tag", "string"),
+    ("unit", "string"), ("num", "int"), ("unit_price", "float"), ("amount", "float"),
+    ("tax_rate", "string"), ("tax", "float"), ("month", "string"),
+)
+ATTACHMENT_SNAPSHOT_COLUMNS = (
+    ("file_token", "string"), ("record_uid", "string"), ("position", "int"),
+    ("uploader", "string"), ("uploader_id", "string"), ("belonger", "string"),
+    ("belonger_id", "string"),
+)
+
+_SQL_TYPES = {"float": "REAL", "int": "INTEGER", "string": "TEXT"}
+_MONTH_SQL = f"substr({NORMALIZED_DATE_SQL.format(column='i.date')}, 1, 7)"
+
+
+# 快照中取自 invoices 的字段 (items 展开为商品表), 只有这些字段变化时才记录发票的变化
+SNAPSHOT_SOURCE_COLUMNS = tuple(
+    key for key, _ in INVOICE_SNAPSHOT_COLUMNS
+    if key not in ("uploader", "uploader_id", "belonger", "belonger_id", "month")
+) + ("items", )
+
+
+def ensure_invoice_changes(db: Database):
+    """
+    创建 invoice_changes 表及 invoices / attachments 表上的触发器
+
+    插入发票、快照字段更新、或附件的上传人/收款人变化时, 该发票的 seq 变为新的最大值,
+    增量快照据此只导出上次之后变化的发票. verified_with 等簿记字段的更新不记录.
+    """
+    update_columns = ", ".join(f"[{column}]" for column in SNAPSHOT_SOURCE_COLUMNS)
+    triggers = {
+        "invoice_changes_insert": ("AFTER INSERT ON invoices", "NEW"),
+        "invoice_changes_update": (f"AFTER UPDATE OF {update_columns} ON invoices", "NEW"),
+    }
+    if db["attachments"].exists():
+        triggers.update({
+            "invoice_changes_attachment_insert": ("AFTER INSERT ON attachments", "NEW"),
+            "invoice_changes_attachment_update": (
+                "AFTER UPDATE OF file_token, uploader, uploader_id, belonger, belonger_id ON attachments",
+                "NEW"),
+            "invoice_changes_attachment_delete": ("AFTER DELETE ON attachments", "OLD"),
+        })
+    existing = dict(db.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'invoice_changes_%'"))
+    with db.conn:
+        db.conn.execute("""
+            CREATE TABLE IF NOT EXISTS invoice_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_token TEXT NOT NULL UNIQUE
+            )
+        """)
+        for name, (event, row) in triggers.items():
+            if name in existing and event in existing[name]:
+                continue
+            # 旧版本的 invoice_changes_update 对任意字段的更新都会触发
+            db.conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+            db.conn.execute(f"""
+                CREATE TRIGGER {name} {event}
+                BEGIN
+                    INSERT OR REPLACE INTO invoice_changes (file_token) VALUES ({row}.file_token);
+                END
+            """)
+        db.conn.execute("""
+            CREATE TABLE IF NOT EXISTS snapshot_state (
+                target TEXT PRIMARY KEY,
+                last_seq INTEGER NOT NULL
+            )
+        """)
+
+
+def _select(alias: str, columns: Set[str], key: str, kind: str) -> str:
+    if key not in columns:
+        return f"NULL AS [{key}]"
+    if kind == "string":
+        return f"NULLIF(CAST({alias}.[{key}] AS TEXT), '') AS [{key}]"
+    return f"CAST(NULLIF({alias}.[{key}], '') AS {_SQL_TYPES[kind]}) AS [{key}]"
+
+
+def invoice_query(db: Database, where: str = "") -> str:
+    """快照中 invoices 表的查询 (发票 i 关联附件 a), where 为附加的过滤条件"""
+    columns = set(db["invoices"].columns_dict)
+    people = {"uploader", "uploader_id", "belonger", "belonger_id"}
+    fields = []
+    for key, kind in INVOICE_SNAPSHOT_COLUMNS:
+        if key in people:
+            fields.append(f"a.[{key}]")
+        elif key == "month":
+            fields.append(f"{_MONTH_SQL} AS month" if "date" in columns else "NULL AS month")
+        else:
+            fields.append(_select("i", columns, key, kind))
+    return f"""
+        SELECT {", ".join(fields)}
+        FROM invoices i
+        LEFT JOIN attachments a ON a.file_token = i.file_token
+        {f"WHERE {where}" if where else ""}
+    """
+
+
+def _item_query(db: Database) -> str:
+    columns = set(db["invoice_items"].columns_dict)
+    fields = [
+        _select("t", columns, key, kind)
+        for key, kind in ITEM_SNAPSHOT_COLUMNS if key != "month"
+    ]
+    month = _MONTH_SQL if "date" in db["invoices"].columns_dict else "NULL"
+    return f"""
+        SELECT {", ".join(fields)}, {month} AS month
+        FROM invoice_items t
+        JOIN invoices i ON i.file_token = t.file_token
+    """
+
+
+class _PartWriter:
+    """将分块读取的行写入 {directory}[/month=YYYY-MM]/{part_name}.{format}, 一次只打开一个文件"""
+
+    def __init__(self, fmt: str, directory: str, part_name: str, columns: Sequence[Tuple[str, str]]):
+        self.fmt = fmt
+        self.directory = directory
+        self.part_name = part_name
+        self.columns = columns
+        self.rows = 0
+        self.files = 0
+        self._partition = None
+        self._file = None
+        self._writer = None
+        if fmt != "csv":
+            types = {"string": pyarrow.string(), "float": pyarrow.float64(), "int": pyarrow.int64()}
+            self.schema = pyarrow.schema([(key, types[kind]) for key, kind in columns])
+
+    def _open(self, partition: Optional[str]):
+        self.close()
+        directory = self.directory
+        if partition is not None:
+            directory = os.path.join(directory, f"month={partition}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.part_name}.{self.fmt}")
+        if self.fmt == "csv":
+            self._file = open(path, "w", encoding="utf-8", newline="")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow([key for key, _ in self.columns])
+        elif self.fmt == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self._file = pyarrow.OSFile(path, "wb")
+            self._writer = pyarrow.ipc.new_file(self._file, self.schema)
+        self._partition = partition
+        self.files += 1
+
+    def write(self, rows: List[tuple], partition: Optional[str] = None):
+        if self._writer is None or partition != self._partition:
+            self._open(partition)
+        if self.fmt == "csv":
+            self._writer.writerows(rows)
+        else:
+            columns = list(zip(*rows)) or [()] * len(self.schema)
+            arrays = [
+                pyarrow.array(values, type=self.schema.field(i).type)
+                for i, values in enumerate(columns)
+            ]
+            batch = pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+            if self.fmt == "parquet":
+                self._writer.write_table(pyarrow.Table.from_batches([batch]))
+            else:
+                self._writer.write_batch(batch)
+        self.rows += len(rows)
+
+    def close(self):
+        if self._writer is not None and self.fmt != "csv":
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+        self._writer = self._file = None
+
+
+def _write_table(db: Database, sql: str, params: Sequence, writer: _PartWriter,
+                 partitioned: bool, chunk_size: int):
+    """分块读取查询结果并写入, 按月分区时结果按 month 排序, 每个分区只打开一次文件"""
+    cursor = db.conn.cursor()
+    if partitioned:
+        sql = f"SELECT * FROM ({sql}) ORDER BY month"
+    cursor.execute(sql, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            if not partitioned:
+                writer.write(rows)
+                continue
+            # 分区列不重复写入文件
+            start = 0
+            for i in range(1, len(rows) + 1):
+                if i == len(rows) or rows[i][-1] != rows[start][-1]:
+                    writer.write([row[:-1] for row in rows[start:i]], rows[start][-1] or "unknown")
+                    start = i
+    finally:
+        writer.close()
+
+
+def write_snapshot(db: Database,
+                   output_dir: str,
+                   fmt: str = "parquet",
+                   partition_by_month: bool = False,
+                   incremental: bool = False,
+                   chunk_size: int = SNAPSHOT_CHUNK_SIZE) -> Dict[str, int]:
+    """
+    将发票、商品、附件关联信息写为 Parquet / Arrow IPC / CSV 快照
+
+    目录结构为 {output_dir}/{invoices|items|attachments}/[month=YYYY-MM/]part-{seq}.{fmt},
+    类型已转换, 人员字段已展开, 读取时无需再解析 JSON 或访问 SQLite.
+    incremental 为 True 且该目录已有快照时, invoices / items 只追加上次快照后插入、快照字段更新
+    或上传人/收款人变化过的发票 (读取时按 file_token 取 seq 最大的记录), attachments 总是完整重写;
+    否则完整重写全部表.
+
+    Returns:
+        dict: 各表写入的行数
+    """
+    if fmt not in SNAPSHOT_FORMATS:
+        raise ValueError(f"Unsupported snapshot format {{{fmt}}}, use one of {SNAPSHOT_FORMATS}")
+    if fmt != "csv" and pyarrow is None:
+        raise RuntimeError(f"pyarrow is required to write {fmt} snapshots.")
+
+    ensure_invoice_changes(db)
+    ensure_invoice_items(db)
+    target = f"{os.path.abspath(output_dir)}:{fmt}{':month' if partition_by_month else ''}"
+    seq = db.execute("SELECT COALESCE(MAX(seq), 0) FROM invoice_changes").fetchone()[0]
+    row = db.execute("SELECT last_seq FROM snapshot_state WHERE target = ?", (target, )).fetchone()
+    last_seq = row[0] if incremental and row and os.path.isdir(output_dir) else None
+
+    tables = [("invoices", INVOICE_SNAPSHOT_COLUMNS, invoice_query(db), partition_by_month),
+              ("items", ITEM_SNAPSHOT_COLUMNS, _item_query(db), partition_by_month),
+              ("attachments", ATTACHMENT_SNAPSHOT_COLUMNS,
+               "SELECT file_token, record_uid, position, uploader, uploader_id, belonger, belonger_id FROM attachments",
+               False)]
+    counts = {}
+    for name, columns, sql, partitioned in tables:
+        if partitioned:
+            columns = columns[:-1]
+        directory = os.path.join(output_dir, name)
+        if last_seq is not None and name != "attachments":
+            sql = f"""
+                {sql}
+                WHERE i.file_token IN (SELECT file_token FROM invoice_changes WHERE seq > ?)
+            """
+            writer = _PartWriter(fmt, directory, f"part-{seq:012d}", columns)
+            _write_table(db, sql, (last_seq, ), writer, partitioned, chunk_size)
+        else:
+            # 先写入临时目录, 完成后替换旧快照
+            tmp_directory = f"{directory}.tmp"
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            writer = _PartWriter(fmt, tmp_directory, f"part-{seq:012d}", columns)
+            _write_table(db, sql, (), writer, partitioned, chunk_size)
+            os.makedirs(tmp_directory, exist_ok=True)
+            shutil.rmtree(directory, ignore_errors=True)
+            os.replace(tmp_directory, directory)
+        counts[name] = writer.rows
+        logger.debug(f"Snapshot {name}: {writer.rows} rows in {writer.files} files.")
+
+    with db.conn:
+        db.conn.execute("""
+            INSERT INTO snapshot_state (target, last_seq) VALUES (?, ?)
+            ON CONFLICT(target) DO UPDATE SET last_seq = excluded.last_seq
+        """, (target, seq))
+    return counts
+
+
+def write_query_result(db: Database,
+                       path: str,
+                       where: str = "",
+                       params: Sequence = (),
+                       chunk_size: int = SNAPSHOT_CHUNK_SIZE) -> int:
+    """
+    将满足 where 条件的发票以快照中 invoices 表的字段写入单个文件, 格式由扩展名 (.parquet/.arrow/.csv) 决定
+
+    Returns:
+        int: 写入的行数
+    """
+    directory, file_name = os.path.split(path)
+    part_name, ext = os.path.splitext(file_name)
+    fmt = ext.lstrip(".")
+    if fmt not in SNAPSHOT_FORMATS:
+        raise ValueError(f"Unsupported output format {{{ext}}}, use one of {SNAPSHOT_FORMATS}")
+    if fmt != "csv" and pyarrow is None:
+        raise RuntimeError(f"pyarrow is required to write {fmt} files.")
+    writer = _PartWriter(fmt, directory or ".", part_name, INVOICE_SNAPSHOT_COLUMNS)
+    _write_table(db, invoice_query(db, where), params, writer, False, chunk_size)
+    if writer.files == 0:
+        # 没有结果时也写出只有表头的文件
+        writer.write([])
+        writer.close()
+    return writer.rows
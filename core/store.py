@@ -0,0 +1,246 @@
+import hashlib
+import os
+import re
+import time
+from typing import *
+from sqlite_utils import Database
+from .log import logger
+from .utils import file_sha256, link_or_copy
+
+RAW_STORE_DIR = os.getenv("RAW_STORE_DIR") or "raw_store"
+RAW_STORE_MAX_SIZE = os.getenv("RAW_STORE_MAX_SIZE") or ""
+
+
+def parse_size(text: str) -> Optional[int]:
+    """"500M" / "2G" / "1048576" -> 字节数, 空值表示不限制"""
+    text = (text or "").strip().upper()
+    if not text:
+        return None
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)I?B?", text)
+    if not match:
+        raise ValueError(f"Invalid size {{{text}}}")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** " KMGT".index(unit or " "))
+
+
+def ensure_store_tables(db: Database):
+    with db.conn:
+        db.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                file_token TEXT PRIMARY KEY,
+                file_hash TEXT NOT NULL,
+                file_name TEXT,
+                size INTEGER
+            )
+        """)
+        db.conn.execute("CREATE INDEX IF NOT EXISTS idx_files_file_hash ON files(file_hash)")
+        db.conn.execute("""
+            CREATE TABLE IF NOT EXISTS store_objects (
+                file_hash TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        db.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_store_objects_last_used ON store_objects(last_used)")
+
+
+class ContentStore:
+    """
+    本地文件内容存储, 按 sha256 分片保存 ({root}/ab/cd/abcd...)
+
+    - files 表: file_token -> 文件哈希、原始文件名、大小
+    - store_objects 表: 已保存的文件及最近使用时间, 超出 max_size 时按最近使用时间淘汰
+
+    相同内容的文件只保存一份. 读取时校验哈希, 损坏的文件会被删除并视为不存在.
+    与 ResponseArchive 相同, 新文件的记录缓存后按批提交; 最近使用时间在 close
+    (或 with 语句结束) 时批量写入, 随后执行淘汰.
+    """
+
+    def __init__(self,
+                 db: Database,
+                 root: str = RAW_STORE_DIR,
+                 max_size: Optional[int] = None,
+                 batch_size: Optional[int] = 200):
+        self.db = db
+        self.root = root
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self._touched: Dict[str, float] = {}
+        # 待写入的 files / store_objects 记录
+        self._files: Dict[str, Tuple[str, Optional[str], int]] = {}
+        self._objects: Dict[str, Tuple[int, float]] = {}
+        ensure_store_tables(db)
+
+    @classmethod
+    def from_env(cls, db: Database) -> "ContentStore":
+        """由 .env 中的 RAW_STORE_DIR / RAW_STORE_MAX_SIZE 创建"""
+        return cls(db, RAW_STORE_DIR, parse_size(RAW_STORE_MAX_SIZE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def object_path(self, file_hash: str) -> str:
+        return os.path.join(self.root, file_hash[:2], file_hash[2:4], file_hash)
+
+    def put(self, file_token: str, file_name: Optional[str], content: bytes) -> str:
+        """保存文件内容并记录 file_token, 返回文件哈希"""
+        file_hash = hashlib.sha256(content).hexdigest()
+        path = self.object_path(file_hash)
+        if not os.path.exists(path) or os.path.getsize(path) != len(content):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再原子替换, 中途退出不会留下不完整的文件
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        self._record(file_token, file_hash, file_name, len(content))
+        return file_hash
+
+    def _record(self, file_token: str, file_hash: str, file_name: Optional[str], size: int):
+        self._files[file_token] = (file_hash, file_name, size)
+        self._objects[file_hash] = (size, time.time())
+        self._touched.pop(file_hash, None)
+        if self.batch_size and len(self._files) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """提交缓存的 files / store_objects 记录"""
+        if not self._files and not self._objects:
+            return
+        with self.db.conn:
+            self.db.conn.executemany("""
+                INSERT INTO files (file_token, file_hash, file_name, size) VALUES (?, ?, ?, ?)
+                ON CONFLICT(file_token) DO UPDATE SET
+                    file_hash = excluded.file_hash,
+                    file_name = excluded.file_name,
+                    size = excluded.size
+            """, [(file_token, *row) for file_token, row in self._files.items()])
+            self.db.conn.executemany("""
+                INSERT INTO store_objects (file_hash, size, last_used) VALUES (?, ?, ?)
+                ON CONFLICT(file_hash) DO UPDATE SET last_used = excluded.last_used
+            """, [(file_hash, *row) for file_hash, row in self._objects.items()])
+        logger.debug(f"Recorded {len(self._files)} stored files.")
+        self._files.clear()
+        self._objects.clear()
+
+    def put_file(self, file_token: str, file_name: Optional[str], path: str, file_hash: str):
+        """将已校验(哈希为 file_hash)的本地文件链接或复制到存储中并记录 file_token"""
+        object_path = self.object_path(file_hash)
+        size = os.path.getsize(path)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            link_or_copy(path, object_path)
+        self._record(file_token, file_hash, file_name, size)
+
+    def lookup(self, file_token: str) -> Optional[Tuple[str, str]]:
+        """file_token -> (文件哈希, 原始文件名), 未记录时返回 None"""
+        if file_token in self._files:
+            self.flush()
+        return self.db.execute(
+            "SELECT file_hash, file_name FROM files WHERE file_token = ?",
+            (file_token, )).fetchone()
+
+    def path(self, file_token: str, verify: bool = True) -> Optional[str]:
+        """
+        已保存文件的路径, 不存在或校验失败时返回 None
+
+        verify 为 False 时只比较文件大小, 不计算哈希.
+        """
+        if file_token in self._files:
+            self.flush()
+        row = self.db.execute("""
+            SELECT files.file_hash, store_objects.size
+            FROM files JOIN store_objects ON store_objects.file_hash = files.file_hash
+            WHERE files.file_token = ?
+        """, (file_token, )).fetchone()
+        if row is None:
+            return None
+        file_hash, size = row
+        path = self.object_path(file_hash)
+        try:
+            if os.path.getsize(path) != size or (verify and file_sha256(path) != file_hash):
+                raise ValueError("content mismatch")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Stored file {file_hash} for {file_token} is missing or corrupted: {e}")
+            self.discard(file_hash)
+            return None
+        self._touched[file_hash] = time.time()
+        return path
+
+    def read(self, file_token: str) -> Optional[bytes]:
+        """读取并校验已保存的文件内容, 不存在或校验失败时返回 None"""
+        path = self.path(file_token, verify=False)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            content = f.read()
+        file_hash = os.path.basename(path)
+        if hashlib.sha256(content).hexdigest() != file_hash:
+            logger.warning(f"Stored file {file_hash} for {file_token} is corrupted.")
+            self.discard(file_hash)
+            return None
+        return content
+
+    def discard(self, file_hash: str):
+        """删除已保存的文件 (files 表中的记录保留, 下次下载时重新保存)"""
+        self.flush()
+        try:
+            os.remove(self.object_path(file_hash))
+        except FileNotFoundError:
+            pass
+        with self.db.conn:
+            self.db.conn.execute("DELETE FROM store_objects WHERE file_hash = ?", (file_hash, ))
+        self._touched.pop(file_hash, None)
+
+    def evict(self) -> int:
+        """
+        按最近使用时间淘汰文件, 直到总大小不超过 max_size, 返回淘汰的文件数量
+
+        与导出目录共享的文件 (硬链接数大于 1) 删除后不释放空间, 不计入总大小也不淘汰.
+        已不存在的文件只删除记录.
+        """
+        if self.max_size is None:
+            return 0
+        self.flush()
+        owned, missing = [], []
+        for file_hash, size in self.db.execute(
+                "SELECT file_hash, size FROM store_objects ORDER BY last_used").fetchall():
+            try:
+                if os.stat(self.object_path(file_hash)).st_nlink == 1:
+                    owned.append((file_hash, size))
+            except FileNotFoundError:
+                missing.append((file_hash, ))
+        total = sum(size for _, size in owned)
+        evicted = []
+        for file_hash, size in owned:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(self.object_path(file_hash))
+            except FileNotFoundError:
+                pass
+            evicted.append((file_hash, ))
+            total -= size
+        if evicted or missing:
+            with self.db.conn:
+                self.db.conn.executemany("DELETE FROM store_objects WHERE file_hash = ?",
+                                         evicted + missing)
+        logger.debug(f"Evicted {len(evicted)} stored files.")
+        return len(evicted)
+
+    def close(self):
+        self.flush()
+        if self._touched:
+            with self.db.conn:
+                self.db.conn.executemany(
+                    "UPDATE store_objects SET last_used = ? WHERE file_hash = ?",
+                    [(last_used, file_hash) for file_hash, last_used in self._touched.items()])
+            self._touched.clear()
+        self.evict()
+
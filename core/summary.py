@@ -0,0 +1,155 @@
+from typing import *
+from sqlite_utils import Database
+from .db import ensure_invoice_identity
+from .rules import NORMALIZED_DATE_SQL
+
+# 汇总维度 -> 说明
+SUMMARY_DIMENSIONS = {
+    "status": "状态",
+    "belonger": "收款人",
+    "seller": "销售方",
+    "month": "开票月份",
+}
+
+# 汇总依赖的 invoices 字段
+SUMMARY_SOURCE_COLUMNS = {"status", "sellerName", "date", "totalAmount", "processed", "duplicate_of"}
+
+_CENTS_SQL = "CAST(ROUND(COALESCE(CAST(NULLIF({row}.totalAmount, '') AS REAL), 0) * 100) AS INTEGER)"
+# status 之外的维度只统计已识别且非重复的发票
+_COUNTED_SQL = "{row}.processed AND {row}.duplicate_of IS NULL"
+_UPSERT = """
+    ON CONFLICT(dimension, key) DO UPDATE SET
+        invoices = invoices + excluded.invoices,
+        total_cents = total_cents + excluded.total_cents;
+"""
+
+
+def _invoice_keys(row: str) -> Dict[str, str]:
+    """发票所在的各维度取值 (belonger 取自 attachments), 空值归为 ''"""
+    return {
+        "status": f"COALESCE(CAST({row}.status AS TEXT), '')",
+        "belonger": f"COALESCE((SELECT belonger FROM attachments WHERE file_token = {row}.file_token), '')",
+        "seller": f"COALESCE({row}.sellerName, '')",
+        "month": f"COALESCE(substr({NORMALIZED_DATE_SQL.format(column=f'{row}.date')}, 1, 7), '')",
+    }
+
+
+def _counted(dimension: str, row: str) -> str:
+    return "1" if dimension == "status" else _COUNTED_SQL.format(row=row)
+
+
+def _apply(row: str, sign: int, dimensions: Iterable[str] = SUMMARY_DIMENSIONS) -> str:
+    """将 row (NEW / OLD) 所在的发票计入 (sign=1) 或移出 (sign=-1) 各维度汇总的语句"""
+    keys = _invoice_keys(row)
+    cents = _CENTS_SQL.format(row=row)
+    return "".join(f"""
+        INSERT INTO invoice_summary (dimension, key, invoices, total_cents)
+        SELECT '{dimension}', {keys[dimension]}, {sign}, {sign} * {cents}
+        WHERE {_counted(dimension, row)}
+        {_UPSERT}""" for dimension in dimensions)
+
+
+def _move_belonger(file_token: str, old: str, new: str) -> str:
+    """附件的收款人从 old 变为 new 时, 移动对应发票在 belonger 维度上的汇总"""
+    cents = _CENTS_SQL.format(row="invoices")
+    return "".join(f"""
+        INSERT INTO invoice_summary (dimension, key, invoices, total_cents)
+        SELECT 'belonger', COALESCE({key}, ''), {sign}, {sign} * {cents}
+        FROM invoices WHERE invoices.file_token = {file_token} AND {_COUNTED_SQL.format(row="invoices")}
+        {_UPSERT}""" for key, sign in ((old, -1), (new, 1)))
+
+
+def _summary_triggers() -> Dict[str, str]:
+    """触发器名 -> 触发条件及语句"""
+    return {
+        "invoice_summary_insert": f"""
+            AFTER INSERT ON invoices
+            BEGIN {_apply("NEW", 1)} END""",
+        "invoice_summary_delete": f"""
+            AFTER DELETE ON invoices
+            BEGIN {_apply("OLD", -1)} END""",
+        "invoice_summary_update": f"""
+            AFTER UPDATE OF file_token, {", ".join(sorted(SUMMARY_SOURCE_COLUMNS))} ON invoices
+            BEGIN {_apply("OLD", -1)} {_apply("NEW", 1)} END""",
+        "invoice_summary_attachment_insert": f"""
+            AFTER INSERT ON attachments
+            BEGIN {_move_belonger("NEW.file_token", "NULL", "NEW.belonger")} END""",
+        "invoice_summary_attachment_delete": f"""
+            AFTER DELETE ON attachments
+            BEGIN {_move_belonger("OLD.file_token", "OLD.belonger", "NULL")} END""",
+        "invoice_summary_attachment_update": f"""
+            AFTER UPDATE OF file_token, belonger ON attachments
+            BEGIN
+                {_move_belonger("OLD.file_token", "OLD.belonger", "NULL")}
+                {_move_belonger("NEW.file_token", "NULL", "NEW.belonger")}
+            END""",
+    }
+
+
+def ensure_invoice_summary(db: Database, rebuild: bool = False) -> bool:
+    """
+    创建 invoice_summary 汇总表 (维度, 取值, 发票数, 价税合计(分)) 及维护它的触发器
+
+    - invoices 插入/删除时计入/移出, 状态、销售方、日期、金额、识别/重复标记变化时先移出旧值再计入新值
+    - attachments 插入/删除/收款人变化时移动对应发票的 belonger 汇总
+    status 维度统计全部发票, 其余维度只统计已识别且非重复 (duplicate_of 为空) 的发票.
+    首次创建、旧版本触发器升级或 rebuild 为 True 时由现有数据全量计算.
+    invoices 缺少所需字段或 attachments 不存在时返回 False.
+    """
+    if db["invoices"].exists():
+        ensure_invoice_identity(db)
+    if not db["invoices"].exists() or not db["attachments"].exists() \
+            or not SUMMARY_SOURCE_COLUMNS <= set(db["invoices"].columns_dict):
+        return False
+    exists = db["invoice_summary"].exists()
+    # 旧版本的触发器统计全部发票, 需替换并全量重算
+    outdated = exists and "duplicate_of" not in (db.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'invoice_summary_update'"
+    ).fetchone() or ("", ))[0]
+    if exists and not rebuild and not outdated:
+        return True
+
+    keys = _invoice_keys("invoices")
+    cents = _CENTS_SQL.format(row="invoices")
+    with db.conn:
+        if not exists:
+            db.conn.execute("""
+                CREATE TABLE invoice_summary (
+                    dimension TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    invoices INTEGER NOT NULL,
+                    total_cents INTEGER NOT NULL,
+                    PRIMARY KEY (dimension, key)
+                )
+            """)
+        if not exists or outdated:
+            for name, body in _summary_triggers().items():
+                db.conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+                db.conn.execute(f"CREATE TRIGGER {name} {body}")
+        db.conn.execute("DELETE FROM invoice_summary")
+        for dimension in SUMMARY_DIMENSIONS:
+            db.conn.execute(f"""
+                INSERT INTO invoice_summary (dimension, key, invoices, total_cents)
+                SELECT '{dimension}', {keys[dimension]} AS key, COUNT(*), SUM({cents})
+                FROM invoices
+                WHERE {_counted(dimension, "invoices")}
+                GROUP BY key
+            """)
+    return True
+
+
+def iter_summary(db: Database,
+                 dimension: str,
+                 top: Optional[int] = None) -> Iterator[Tuple[str, int, int]]:
+    """按价税合计降序读取某一维度的汇总, 返回 (取值, 发票数, 价税合计(分)); month 维度按月份排序"""
+    order = "key" if dimension == "month" else "total_cents DESC, key"
+    sql = f"""
+        SELECT key, invoices, total_cents FROM invoice_summary
+        WHERE dimension = ? AND invoices != 0
+        ORDER BY {order}
+    """
+    params = [dimension]
+    if top:
+        sql += " LIMIT ?"
+        params.append(top)
+    yield from db.execute(sql, params)
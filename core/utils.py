@@ -1,4 +1,9 @@
+import hashlib
+import os
 import re
+import shutil
+from collections import deque
+from itertools import islice
 from .log import logger
 
 def extract_params_from_url(url: str, need_table_id = True):
@@ -29,3 +34,57 @@ def extract_text(obj, d):
             return obj[d][0]['text']
     else:
         return None
+
+
+def batched(iterable, size: int):
+    """按 size 个一组切分可迭代对象, 最后一组可能不足 size 个"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def bounded_map(executor, fn, iterable, prefetch: int):
+    """
+    与 executor.map 相同, 按输入顺序返回结果,
+    但最多只提交 prefetch 个未完成的任务, 不会一次性读完整个输入
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= prefetch:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def link_or_copy(src: str, dst: str):
+    """创建硬链接, 跨文件系统等无法链接时复制"""
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def file_sha256(path: str) -> str:
+    """分块计算文件的 sha256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fsync_directory(path: str):
+    """将目录项(如 rename 结果)刷入磁盘, 不支持的平台上忽略"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
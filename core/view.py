@@ -0,0 +1,185 @@
+from typing import *
+from sqlite_utils import Database
+
+# 对外展示/导出使用的发票字段, 顺序与云文档字段一致
+INVOICE_VIEW_FIELDS = ("file_token", "type", "number", "date", "buyerTaxID",
+                       "buyerName", "sellerTaxID", "sellerName", "items_brief",
+                       "items_unit", "remark", "item_num", "total_items_num",
+                       "totalAmount", "error_message", "items", "status")
+
+
+class InvoiceRow(NamedTuple):
+    """invoice_view 中的一行, 已完成类型转换与上传人/收款人关联, 空值均为 None"""
+    file_token: str
+    type: Optional[str]
+    number: Optional[str]
+    date: Optional[str]
+    buyerTaxID: Optional[str]
+    buyerName: Optional[str]
+    sellerTaxID: Optional[str]
+    sellerName: Optional[str]
+    items_brief: Optional[str]
+    items_unit: Optional[str]
+    remark: Optional[str]
+    item_num: Optional[int]
+    total_items_num: Optional[int]
+    totalAmount: Optional[int]
+    error_message: Optional[str]
+    items: Optional[str]
+    status: Optional[str]
+    uploader: Optional[str]
+    uploader_id: Optional[str]
+    belonger: Optional[str]
+    belonger_id: Optional[str]
+
+    def invoice_fields(self) -> Iterator[Tuple[str, Any]]:
+        """非空的发票字段 (不含人员字段)"""
+        for key, value in zip(INVOICE_VIEW_FIELDS, self):
+            if value is not None:
+                yield key, value
+
+    def as_dict(self) -> dict:
+        """非空字段组成的 dict, 人员字段取姓名"""
+        data = dict(self.invoice_fields())
+        if self.uploader:
+            data["uploader"] = self.uploader
+        if self.belonger:
+            data["belonger"] = self.belonger
+        return data
+
+
+# table_fields_type_map 中的 数字类型 / 状态类型 字段在视图中完成转换
+_VIEW_COLUMNS = {
+    "item_num": "CAST(NULLIF(i.item_num, '') AS INTEGER)",
+    "total_items_num": "CAST(NULLIF(i.total_items_num, '') AS INTEGER)",
+    "totalAmount": "CAST(NULLIF(i.totalAmount, '') AS INTEGER)",
+    "status": "CAST(NULLIF(i.status, '') AS TEXT)",
+}
+
+
+def _view_column(key: str) -> str:
+    return _VIEW_COLUMNS.get(key, f"NULLIF(i.[{key}], '')")
+
+
+def refresh_attachments(db: Database, invoice_column: str,
+                        uploader_column: str, belonger_column: str):
+    """
+    由 records 表更新 attachments 表 (file_token -> 所属记录及上传人/收款人)
+
+    records 中的人员字段为 JSON 文本, 在此一次性展开, 之后的查询无需再做 json_extract.
+    只删除已不在 records 中的附件、写入新增或变化的附件, 未变化的行不触发 attachments 上的触发器.
+    """
+    with db.conn:
+        db.conn.execute("""
+            CREATE TABLE IF NOT EXISTS attachments (
+                file_token TEXT PRIMARY KEY,
+                record_uid TEXT,
+                position INTEGER,
+                uploader TEXT,
+                uploader_id TEXT,
+                belonger TEXT,
+                belonger_id TEXT
+            )
+        """)
+        db.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_attachments_record_uid ON attachments(record_uid)"
+        )
+        columns = db["records"].columns_dict if db["records"].exists() else {}
+        if invoice_column not in columns:
+            db.conn.execute("DELETE FROM attachments")
+            return
+
+        def person(column, attribute):
+            if column not in columns:
+                return "NULL"
+            return f"json_extract(records.[{column}], '$[0].{attribute}')"
+
+        # records 只展开一次, 再与 attachments 比较
+        db.conn.execute("DROP TABLE IF EXISTS temp.attachments_new")
+        db.conn.execute("""
+            CREATE TEMP TABLE attachments_new (
+                file_token TEXT PRIMARY KEY,
+                record_uid TEXT,
+                position INTEGER,
+                uploader TEXT,
+                uploader_id TEXT,
+                belonger TEXT,
+                belonger_id TEXT
+            )
+        """)
+        db.conn.execute(f"""
+            INSERT OR REPLACE INTO temp.attachments_new
+                (file_token, record_uid, position, uploader, uploader_id, belonger, belonger_id)
+            SELECT
+                json_extract(value, '$.file_token'),
+                records.uid,
+                key,
+                {person(uploader_column, 'name')},
+                {person(uploader_column, 'id')},
+                {person(belonger_column, 'name')},
+                {person(belonger_column, 'id')}
+            FROM records, json_each(records.[{invoice_column}])
+            WHERE json_extract(value, '$.file_token') IS NOT NULL
+        """)
+        db.conn.execute("""
+            DELETE FROM attachments
+            WHERE file_token NOT IN (SELECT file_token FROM temp.attachments_new)
+        """)
+        db.conn.execute("""
+            INSERT INTO attachments
+                (file_token, record_uid, position, uploader, uploader_id, belonger, belonger_id)
+            SELECT file_token, record_uid, position, uploader, uploader_id, belonger, belonger_id
+            FROM temp.attachments_new
+            WHERE true
+            ON CONFLICT(file_token) DO UPDATE SET
+                record_uid = excluded.record_uid,
+                position = excluded.position,
+                uploader = excluded.uploader,
+                uploader_id = excluded.uploader_id,
+                belonger = excluded.belonger,
+                belonger_id = excluded.belonger_id
+            WHERE attachments.record_uid IS NOT excluded.record_uid
+               OR attachments.position IS NOT excluded.position
+               OR attachments.uploader IS NOT excluded.uploader
+               OR attachments.uploader_id IS NOT excluded.uploader_id
+               OR attachments.belonger IS NOT excluded.belonger
+               OR attachments.belonger_id IS NOT excluded.belonger_id
+        """)
+        db.conn.execute("DROP TABLE temp.attachments_new")
+
+
+def ensure_invoice_view(db: Database, invoice_column: str,
+                        uploader_column: str, belonger_column: str):
+    """创建 invoice_view 视图 (attachments 表不存在时先由 records 表生成)"""
+    if not db["attachments"].exists():
+        refresh_attachments(db, invoice_column, uploader_column,
+                            belonger_column)
+    columns = ",\n                ".join(
+        f"{_view_column(key)} AS [{key}]" for key in INVOICE_VIEW_FIELDS)
+    with db.conn:
+        db.conn.execute(f"""
+            CREATE VIEW IF NOT EXISTS invoice_view AS
+            SELECT
+                {columns},
+                a.uploader, a.uploader_id, a.belonger, a.belonger_id
+            FROM invoices i
+            LEFT JOIN attachments a ON a.file_token = i.file_token
+        """)
+
+
+def iter_invoice_rows(db: Database,
+                      where: str = "",
+                      params: Sequence = (),
+                      arraysize: int = 1000) -> Iterator[InvoiceRow]:
+    """以 InvoiceRow 逐行读取 invoice_view, 不一次性载入全部数据"""
+    cursor = db.conn.cursor()
+    cursor.row_factory = lambda _, row: InvoiceRow._make(row)
+    cursor.arraysize = arraysize
+    cursor.execute(
+        f"SELECT * FROM invoice_view {f'WHERE {where}' if where else ''}",
+        params)
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            break
+        yield from rows
@@ -2,6 +2,40 @@ import os
 import sys
 from core.invoice import Invoice
 
+# 规则版本(可选)
+# 每张发票会记录校验时的规则指纹, fetch/recheck 只校验新发票及在旧版规则下校验过的发票.
+# 默认指纹为本文件内容的哈希; 定义 RULES_VERSION 后改用该值, 仅在修改它时才会重新校验全部发票.
+# RULES_VERSION = 1
+
+# 声明式校验规则(可选)
+# 定义 RULES 后校验将编译为 SQL 在数据库内批量执行, 不再逐张调用 vertify_invoice.
+# 规则按顺序匹配, 发票命中第一条规则即视为未通过校验(status 置为 -2, 备注为 message).
+# when 中各字段条件同时满足才算命中, "any": [{...}, {...}] 表示满足其一即可.
+# 支持的条件:
+#   "字段": 值 / [值, ...]             等于 / 属于列表
+#   {"eq"|"ne": 值}                    等于 / 不等于
+#   {"in"|"not_in": [值, ...]}         属于 / 不属于列表 (如 销售方/购买方 名单、发票类型)
+#   {"contains"|"not_contains": 文本}  包含 / 不包含 (文本或文本列表)
+#   {"gt"|"ge"|"lt"|"le": 数值}        金额等数值范围
+#   {"before"|"after": "YYYY-MM-DD"}  开票日期范围 (仅用于 date 字段)
+# "items": {"字段": 条件, ...} 表示存在满足全部条件的商品, 可用字段:
+#   name(名称) tag(标签, 如 "*客运服务*") unit num unit_price amount tax_rate tax
+# 下例与 vertify_invoice 等价:
+# RULES = [
+#     {
+#         "when": {"buyerName": {"ne": "南京理工大学"}, "type": "电子发票（铁路电子客票）"},
+#         "message": "需等待管理员确认动车发票的抬头是否有要求",
+#     },
+#     {
+#         "when": {"buyerName": {"ne": "南京理工大学"}},
+#         "message": "发票抬头不匹配",
+#     },
+#     {
+#         "when": {"items_brief": {"contains": "客运服务"}},
+#         "message": "客运服务费不允许报销",
+#     },
+# ]
+
 def vertify_invoice(invoice: Invoice):
     """
     自定义发票校验规则
@@ -23,28 +57,23 @@ def vertify_invoice(invoice: Invoice):
     else:
         return {"status": "success"}
 
-def export_invoice(invoice: Invoice, raw_file_name: str, status: str, belonger: str, output_dir: str):
-    def hardlink(src, dst):
-        if not os.path.exists(dst):
-                os.link(src, dst)
-
-    raw_file_path = os.path.join(output_dir, "raw", raw_file_name)
-    _, ext = os.path.splitext(raw_file_name)
-
-    # 示例1: 按{收款人-金额-发票号-file_token}命名,按标签分组导出
-    file_name = f"{belonger}-{invoice.totalAmount}-{invoice.number}-{raw_file_name}" + ext
-    dst_path = os.path.join(output_dir, "by_state", status)
-    os.makedirs(dst_path, exist_ok=True)
-    hardlink(raw_file_path, os.path.join(dst_path, file_name))
+def export_links(invoice: Invoice, raw_file_name: str, status: str, belonger: str):
+    """
+    自定义导出目录结构
 
-    # 示例2： 按{标签-金额-发票号-file_token}命名,按收款人分组导出
-    file_name = f"{status}-{invoice.totalAmount}-{invoice.number}-{raw_file_name}" + ext
-    dst_path = os.path.join(output_dir, "by_belonger", belonger)
-    os.makedirs(dst_path, exist_ok=True)
-    hardlink(raw_file_path, os.path.join(dst_path, file_name))
+    返回该发票在导出目录(output)下的各个路径, 每个路径都是 raw/{raw_file_name} 的硬链接.
+    export 会据此计算完整的目录树, 只创建、删除或移动与上次导出不同的文件;
+    发票的状态或收款人变化后, 旧目录中的链接会被移走, 不会残留.
 
-    # 示例3：按{金额-发票号}命名,用status=="0"筛选发票,按收款人分组导出
-    file_name = f"{invoice.totalAmount}-{invoice.number}" + ext
-    dst_path = os.path.join(output_dir, "by_filter", belonger)
-    os.makedirs(dst_path, exist_ok=True)
-    hardlink(raw_file_path, os.path.join(dst_path, file_name))
\ No newline at end of file
+    Returns:
+        list: [相对路径, ...]
+    """
+    _, ext = os.path.splitext(raw_file_name)
+    return [
+        # 示例1: 按{收款人-金额-发票号-file_token}命名,按标签分组导出
+        os.path.join("by_state", status, f"{belonger}-{invoice.totalAmount}-{invoice.number}-{raw_file_name}" + ext),
+        # 示例2： 按{标签-金额-发票号-file_token}命名,按收款人分组导出
+        os.path.join("by_belonger", belonger, f"{status}-{invoice.totalAmount}-{invoice.number}-{raw_file_name}" + ext),
+        # 示例3：按{金额-发票号}命名,用status=="0"筛选发票,按收款人分组导出
+        os.path.join("by_filter", belonger, f"{invoice.totalAmount}-{invoice.number}" + ext),
+    ]
@@ -1,17 +1,46 @@
 import base64
+import hashlib
+import importlib
 import json
 import os
+import time
 from core import *
 from core.invoice import Invoice
 from core.log import LogLevel
 from core.invoice.baidu_ocr import BaiduOCR
 from core.invoice.tencent_ocr import TencentOCR
-from core.utils import extract_params_from_url, extract_text
+from core.invoice.tiling import MAX_TILES, is_tileable
+from core.utils import (extract_params_from_url, extract_text, batched,
+                        bounded_map, link_or_copy)
+from core.db import (open_database, InvoiceIndex, InvoiceWriter,
+                     ensure_invoice_identity, find_duplicate_clusters,
+                     mark_duplicates, release_duplicates, to_cents,
+                     DUPLICATE_MESSAGE)
+from core.group import read_group_request, apply_group
+from core.audit import AUDIT_CHECKS, run_audit, iter_findings
+from core.archive import RESPONSE_PARSERS, ResponseArchive, reparse_responses
+from core.store import ContentStore
+from core.similar import HASH_BITS, SIMILAR_MESSAGE, ImageHashIndex, dhash, Image
+from core.download import DownloadError, download_file, scan_raw_files, record_raw_files
+from core.snapshot import (INVOICE_SNAPSHOT_COLUMNS, invoice_query, write_query_result,
+                           write_snapshot)
+from core.search import search_conditions
+from core.summary import SUMMARY_DIMENSIONS, ensure_invoice_summary, iter_summary
+from core.export import (check_archive_path, plan_export, keep_export_links, apply_export,
+                         write_archive)
+from core.view import ensure_invoice_view, iter_invoice_rows, refresh_attachments
+from core.rules import (RuleError, apply_rules, rule_fingerprint,
+                        evaluate_python_rules, profile_python_rules)
 from sqlite_utils import Database
+from sqlite_utils.db import jsonify_if_needed
 from tqdm import tqdm
 from yaspin import yaspin
 import custom_rule
-from typing import Callable
+from typing import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
 from i18n import I18n
 
 UPLOADER_COLUMN_NAME = "创建人"
@@ -22,6 +51,9 @@ APPROVAL_REMARKS_COLUMN_NAME = "审批备注"
 
 LARK_LOG_LEVEL = LogLevel.INFO
 
+VERIFY_CHUNK_SIZE = 200  # 自定义规则校验时每块的发票数量
+REPARSE_CHUNK_SIZE = 100  # 重新解析存档响应时每块的发票数量
+
 i18n = I18n(lang_code='zh_CN')
 
 table_fields_type_map = {
@@ -48,41 +80,107 @@ table_fields_type_map = {
 }
 
 
+def prepare_invoice_view(db: Database, refresh: bool = False):
+    """准备 invoice_view 视图, refresh 为 True 时由 records 表重建关联信息"""
+    if refresh:
+        refresh_attachments(db, INVOICE_COLUMN_NAME, UPLOADER_COLUMN_NAME,
+                            BELONGER_COLUMN_NAME)
+    ensure_invoice_view(db, INVOICE_COLUMN_NAME, UPLOADER_COLUMN_NAME,
+                        BELONGER_COLUMN_NAME)
+
+
+# 数据库字段名 -> 云文档字段名 (i18n)
+FIELD_NAMES = {key: i18n.t(key) for key in table_fields_type_map}
+
+# report 推送的汇总表字段名
+REPORT_FIELDS = {"dimension": "维度", "key": "项目", "invoices": "发票数", "total": "价税合计"}
+
+
+def bitable_fields(row) -> dict:
+    """将 InvoiceRow 转换为云文档记录字段"""
+    fields = {FIELD_NAMES[key]: value for key, value in row.invoice_fields()}
+    if row.uploader_id:
+        fields[FIELD_NAMES["uploader"]] = [{"id": row.uploader_id, "type": "user"}]
+    if row.belonger_id:
+        fields[FIELD_NAMES["belonger"]] = [{"id": row.belonger_id, "type": "user"}]
+    return fields
+
+
+def upload_in_batches(batches: Iterable, send: Callable) -> bool:
+    """
+    流水线上传: 后台线程发送当前批次的同时, 主线程准备下一批次
+
+    内存中最多同时存在两个批次. send 返回 False 时停止并返回 False.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for batch in batches:
+            if pending is not None and not pending.result():
+                return False
+            pending = executor.submit(send, batch)
+        return pending.result() if pending is not None else True
+
+
+def _recognized_pages(provider: str, pages: list, file_type: str, base64_data: str,
+                      on_response: Callable = None) -> Invoice:
+    """以已有的原始响应代替 OCR 调用 (如拼接识别的结果), 接口与各 OCR 方法相同"""
+    if on_response is not None:
+        on_response(provider, pages)
+    return RESPONSE_PARSERS[provider](pages)
+
+
+def _chain_processors(*processors: Callable) -> Callable:
+    """依次尝试各识别方法, 返回第一个包含号码与金额的结果, 接口与各 OCR 方法相同"""
+    def process(file_type: str, base64_data: str, on_response: Callable = None) -> Invoice:
+        error = None
+        for processor in processors:
+            try:
+                invoice = processor(file_type, base64_data, on_response)
+            except Exception as e:
+                logger.debug(f"OCR with {processor} failed: {e}")
+                error = e
+                continue
+            if invoice.number and invoice.totalAmount:
+                return invoice
+            error = ValueError("Missing required fields: number or totalAmount.")
+        raise error
+    return process
+
+
 def process_invoice_with_ocr(client, file_token: str, file_type: str,
                              base64_data: str, use_fallback: bool,
-                             db: Database, main_processor: Callable, fallback_processor: Callable):
+                             writer: InvoiceWriter, main_processor: Callable, fallback_processor: Callable,
+                             file_hash: str = None, archive: ResponseArchive = None):
     import lark_oapi as lark
     import lark_oapi.api.drive.v1 as drive_v1
     client: lark.Client = client
+    provider = None
+
+    def on_response(name: str, pages: list):
+        # 记录最近一次响应的接口, 并存档原始响应供 reparse 使用
+        nonlocal provider
+        provider = name
+        if archive is not None and file_hash is not None:
+            archive.add(file_hash, name, pages)
 
     def perform_ocr(method: str):
         if "image" in file_type:
-            return method("image", base64_data)
+            return method("image", base64_data, on_response)
         elif "pdf" in file_type:
-            return method("pdf", base64_data)
+            return method("pdf", base64_data, on_response)
         else:
             raise ValueError("Unsupported file type")
 
-    def check_duplicate(number: str):
-        if not "invoices" in db.table_names():
-            return None
-        rows = list(db["invoices"].rows_where("number = ?", (number, )))
-        for row in rows:
-            if not row.get("error_message"):
-                return row["file_token"]
-        return None
-
     def insert_result(data: dict, processed: bool, error: str = None):
         record = {
             **data, "file_token": file_token,
+            "file_hash": file_hash,
+            "ocr_provider": provider if processed else None,
             "processed": processed,
             "error_message": error,
             "status": '0' if error is None else '-1'
         }
-        db["invoices"].insert(record,
-                              pk="file_token",
-                              replace=True,
-                              alter=True)
+        writer.insert(record)
 
     def get_file_tmp_download_url(file_token: str):
         request: drive_v1.BatchGetTmpDownloadUrlMediaRequest = drive_v1.BatchGetTmpDownloadUrlMediaRequest.builder() \
@@ -109,13 +207,7 @@ def process_invoice_with_ocr(client, file_token: str, file_type: str,
             logger.info(ocr_result.data)
             raise ValueError("Missing required fields: number or totalAmount.")
 
-        duplicate_token = check_duplicate(ocr_result.data.get('number'))
-        if duplicate_token:
-            msg = f"This file has been processed in file_token: {duplicate_token}"
-            logger.debug(msg)
-            insert_result(ocr_result.data, True, msg)
-            return
-
+        # 重复发票由数据库在写入时按 invoice_key 判定
         insert_result(ocr_result.data, True)
         logger.debug(f"Processed file {file_token} successfully.")
 
@@ -130,14 +222,6 @@ def process_invoice_with_ocr(client, file_token: str, file_type: str,
                     raise ValueError(
                         "Missing required fields in fallback OCR.")
 
-                duplicate_token = check_duplicate(
-                    ocr_result.data.get('number'))
-                if duplicate_token:
-                    msg = f"This file has been processed in file_token: {duplicate_token}"
-                    logger.debug(msg)
-                    insert_result(ocr_result.data, True, msg)
-                    return
-
                 insert_result(ocr_result.data, True)
                 logger.debug(
                     f"Processed file {file_token} successfully (fallback).")
@@ -156,10 +240,96 @@ def process_invoice_with_ocr(client, file_token: str, file_type: str,
             insert_result({}, False, error_msg)
 
 
+def verify_invoices(db: Database, full: bool = False, jobs: int = 1):
+    """
+    使用自定义规则校验已处理的发票
+
+    custom_rule 中定义了声明式规则 RULES 时编译为 SQL 批量执行,
+    否则逐张调用 custom_rule.vertify_invoice.
+
+    每张发票记录校验时使用的规则指纹(verified_with), 默认只校验新写入的发票
+    以及在旧版规则下校验过的发票; full 为 True 时校验全部已处理的发票.
+
+    jobs > 1 时 vertify_invoice 在进程池中按块并行执行 (仅对 Python 规则生效).
+    """
+    if not "invoices" in db.table_names():
+        return
+    if "verified_with" not in db["invoices"].columns_dict:
+        db["invoices"].add_column("verified_with", str)
+    fingerprint = rule_fingerprint(custom_rule)
+    if full:
+        scope, scope_params = "1", ()
+    else:
+        scope, scope_params = "verified_with IS NULL OR verified_with != ?", (fingerprint, )
+
+    rules = getattr(custom_rule, "RULES", None)
+    if rules:
+        try:
+            failed = apply_rules(db, rules, scope, scope_params)
+        except RuleError as e:
+            logger.error(f"Invalid custom rules: {e}")
+            return
+        with db.conn:
+            db.conn.execute(
+                f"UPDATE invoices SET verified_with = ? WHERE processed AND ({scope})",
+                (fingerprint, *scope_params))
+        logger.debug(f"{failed} invoices failed verification.")
+        return
+
+    # 以 tuple 读取并分块, 子进程中直接包装为 Invoice, 不构造 dict
+    cursor = db.conn.execute(f"SELECT * FROM invoices WHERE processed AND ({scope})", scope_params)
+    columns = [column[0] for column in cursor.description]
+    total = db["invoices"].count_where(f"processed AND ({scope})", scope_params)
+    evaluate = partial(evaluate_python_rules, custom_rule.__name__, columns)
+    chunks = batched(cursor, VERIFY_CHUNK_SIZE)
+    # 校验结果在遍历结束后一次性提交; 校验出错的发票不记录指纹, 下次运行时重试
+    with InvoiceWriter(db, batch_size=None) as writer, \
+            tqdm(total=total, desc="Verifying invoices") as progress:
+        if jobs > 1:
+            # 子进程按块执行规则, 结果按输入顺序返回
+            executor = ProcessPoolExecutor(max_workers=jobs)
+            results = bounded_map(executor, evaluate, chunks, prefetch=jobs * 2)
+        else:
+            executor = None
+            results = map(evaluate, chunks)
+        try:
+            for chunk_results in results:
+                for file_token, verification_result, error in chunk_results:
+                    if error is not None:
+                        logger.error(
+                            f"Error verifying file {file_token}: {error}")
+                    elif verification_result["status"] == "error":
+                        logger.debug(
+                            f"Verification failed for file {file_token}: {verification_result['message']}"
+                        )
+                        writer.update(
+                            file_token, {
+                                "error_message": verification_result["message"],
+                                "status": '-2',
+                                "verified_with": fingerprint,
+                            })
+                    else:
+                        logger.debug(
+                            f"Verification passed for file {file_token}.")
+                        writer.update(file_token,
+                                      {"verified_with": fingerprint})
+                progress.update(len(chunk_results))
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+
 def fetch_from_table(table_url: str,
                      db_path: str = "invoices.db",
                      use_fallback: bool = False,
-                     interface: str = "baidu"):
+                     interface: str = "baidu",
+                     full_verify: bool = False,
+                     similar_threshold: int = None,
+                     batch_images: int = None):
+    if similar_threshold is not None and not 0 <= similar_threshold < HASH_BITS:
+        logger.error(f"--similar must be between 0 and {HASH_BITS - 1}, got {similar_threshold}.")
+        return
+
     # 检查是否有可用的api
     main_processor: Callable = None
     fallback_processor: Callable = None
@@ -178,7 +348,21 @@ def fetch_from_table(table_url: str,
         exit()
         return
 
-    db = Database(db_path)
+    if similar_threshold is not None and Image is None:
+        logger.warning("Pillow is not installed, skipping similar image detection.")
+        similar_threshold = None
+    if batch_images is not None:
+        if interface != 'tencent':
+            logger.warning("Image batching is only supported by the tencent interface, skipping.")
+            batch_images = None
+        elif Image is None:
+            logger.warning("Pillow is not installed, skipping image batching.")
+            batch_images = None
+        elif not 2 <= batch_images <= MAX_TILES:
+            logger.warning(f"Batch size must be between 2 and {MAX_TILES}, using {MAX_TILES}.")
+            batch_images = MAX_TILES
+
+    db = open_database(db_path)
     lark_bitable_app_token, lark_bitable_table_id = extract_params_from_url(
         table_url)
 
@@ -240,6 +424,7 @@ def fetch_from_table(table_url: str,
             if not response.data.has_more:
                 break
             page_token = response.data.page_token
+        prepare_invoice_view(db, refresh=True)
         spinner.ok("✅ Done")
 
     logger.info("Processing invoice files...")
@@ -259,70 +444,116 @@ def fetch_from_table(table_url: str,
             "file_token": row[1],
             "type": row[2],
         } for row in result]
-        for invoice_file in tqdm(invoice_files, desc="Processing invoices"):
-            if "invoices" in db.table_names():
-                row = next(
-                    db["invoices"].rows_where("file_token = ?",
-                                              (invoice_file['file_token'], )),
-                    None)
-                if row and row.get("processed", False):
+        # 跳过与查重均查询内存索引, 写入层在写入时同步更新索引
+        index = InvoiceIndex.load(db)
+        # 与已识别图像相似(重新拍摄)的发票在识别前标记, 不调用 OCR
+        similar = ImageHashIndex.load(db, similar_threshold) if similar_threshold is not None else None
+        # 识别结果经由写入层批量提交; 中途退出时 with 语句保证已识别的结果与原始响应落盘
+        with InvoiceWriter(db, index=index) as writer, ResponseArchive(db) as archive, \
+                ContentStore.from_env(db) as store:
+
+            def recognize(invoice_file: dict, base64_data: str, file_hash: str, image_hash: int,
+                          processor: Callable = main_processor, fallback: Callable = fallback_processor):
+                process_invoice_with_ocr(client, invoice_file['file_token'],
+                                         invoice_file['type'], base64_data,
+                                         use_fallback, writer, processor, fallback,
+                                         file_hash, archive)
+                if image_hash is not None and index.is_processed(invoice_file['file_token']):
+                    similar.add(invoice_file['file_token'], image_hash)
+
+            # 待拼接识别的小图: (invoice_file, content, base64_data, file_hash, image_hash)
+            pending = []
+
+            def recognize_batch():
+                results = TencentOCR.batch_invoice_recognition([item[1] for item in pending])
+                for (invoice_file, _, base64_data, file_hash, image_hash), pages in zip(pending, results):
+                    if pages is None:
+                        recognize(invoice_file, base64_data, file_hash, image_hash)
+                    else:
+                        # 以拼接识别的结果作为主识别结果, 解析失败时再单独识别, 仍失败时使用备用识别
+                        recognize(invoice_file, base64_data, file_hash, image_hash,
+                                  partial(_recognized_pages, "tencent_general_invoice", pages),
+                                  _chain_processors(main_processor, fallback_processor)
+                                  if fallback_processor else main_processor)
+                pending.clear()
+
+            for invoice_file in tqdm(invoice_files, desc="Processing invoices"):
+                if index.is_processed(invoice_file['file_token']):
                     logger.debug(
                         f"File {invoice_file['file_token']} already processed, skipping."
                     )
                     continue
 
-            request: drive_v1.DownloadMediaRequest = drive_v1.DownloadMediaRequest.builder() \
-                .file_token(invoice_file['file_token']) \
-                .build()
-
-            response: drive_v1.DownloadMediaResponse = client.drive.v1.media.download(
-                request)
+                # 本地存储中已有的文件(如上次识别失败的文件)不再下载
+                content = store.read(invoice_file['file_token'])
+                if content is None:
+                    request: drive_v1.DownloadMediaRequest = drive_v1.DownloadMediaRequest.builder() \
+                        .file_token(invoice_file['file_token']) \
+                        .build()
+
+                    response: drive_v1.DownloadMediaResponse = client.drive.v1.media.download(
+                        request)
+
+                    if not response.success():
+                        lark.logger.error(
+                            f"client.drive.v1.media.download failed, code: {response.code}, msg: {response.msg},log_id: {response.get_log_id()}"
+                        )
+                        return
+                    if response.file is not None:
+                        content = response.file.read()
+                        store.put(invoice_file['file_token'], response.file_name, content)
+
+                # Read the file content and encode it to base64
+                file_hash = None
+                if content is not None:
+                    file_hash = hashlib.sha256(content).hexdigest()
+                    base64_data = base64.b64encode(content).decode("utf-8")
+                else:
+                    invoice_file["error_message"] = "File is empty."
+                    logger.warning(
+                        f"File {invoice_file['file_token']} is empty or not found."
+                    )
 
-            if not response.success():
-                lark.logger.error(
-                    f"client.drive.v1.media.download failed, code: {response.code}, msg: {response.msg},log_id: {response.get_log_id()}"
-                )
-                return
+                image_hash = None
+                if similar is not None and content is not None and "image" in (invoice_file['type'] or ""):
+                    image_hash = dhash(content)
+                if image_hash is not None:
+                    similar.record(invoice_file['file_token'], image_hash)
+                    match = similar.find(image_hash)
+                    if match is not None:
+                        original, distance = match
+                        # 保持未识别状态, 不加 --similar 重新运行时照常识别
+                        writer.insert({
+                            "file_token": invoice_file['file_token'],
+                            "file_hash": file_hash,
+                            "processed": False,
+                            "status": '-1',
+                            "error_message": f"{SIMILAR_MESSAGE}{original} (distance {distance})",
+                            "similar_to": original,
+                        })
+                        logger.info(
+                            f"File {invoice_file['file_token']} looks like {original} (distance {distance}), skipping OCR."
+                        )
+                        continue
 
-            # Read the file content and encode it to base64
-            if response.file is not None:
-                base64_data = base64.b64encode(
-                    response.file.read()).decode("utf-8")
-            else:
-                invoice_file["error_message"] = "File is empty."
-                logger.warning(
-                    f"File {invoice_file['file_token']} is empty or not found."
-                )
+                if batch_images and content is not None and "image" in (invoice_file['type'] or "") \
+                        and is_tileable(content):
+                    pending.append((invoice_file, content, base64_data, file_hash, image_hash))
+                    if len(pending) >= batch_images:
+                        recognize_batch()
+                    continue
 
-            process_invoice_with_ocr(client, invoice_file['file_token'],
-                                     invoice_file['type'], base64_data,
-                                     use_fallback, db, main_processor, fallback_processor)
+                recognize(invoice_file, base64_data, file_hash, image_hash)
+            if len(pending) > 1:
+                recognize_batch()
+            for invoice_file, _, base64_data, file_hash, image_hash in pending:
+                recognize(invoice_file, base64_data, file_hash, image_hash)
+            if similar is not None:
+                similar.flush()
 
     logger.info("Verifying invoice data with custom rules...")
     with yaspin(text="", spinner="dots") as spinner:
-        invoices_data = db["invoices"].rows_where("processed = ?", (True, ))
-        for invoice_data in tqdm(invoices_data, desc="Verifying invoices"):
-            try:
-                invoice = Invoice(invoice_data)
-                verification_result = custom_rule.vertify_invoice(invoice)
-
-                if verification_result["status"] == "error":
-                    logger.debug(
-                        f"Verification failed for file {invoice_data['file_token']}: {verification_result['message']}"
-                    )
-                    db["invoices"].update(
-                        invoice_data['file_token'], {
-                            "error_message": verification_result["message"],
-                            "status": '-2'
-                        })
-                else:
-                    logger.debug(
-                        f"Verification passed for file {invoice_data['file_token']}."
-                    )
-            except Exception as e:
-                logger.error(
-                    f"Error verifying file {invoice_data['file_token']}: {str(e)}"
-                )
+        verify_invoices(db, full_verify)
 
         spinner.ok("✅ Done")
 
@@ -399,8 +630,23 @@ def fetch_from_table(table_url: str,
     )
 
 
-def export_to_local_path(db_path: str = "invoices.db", output_dir: str = "output"):
-    db = Database(db_path)
+def export_to_local_path(db_path: str = "invoices.db",
+                         output_dir: str = "output",
+                         jobs: int = 8,
+                         archive: str = None):
+    """
+    导出发票文件到 output_dir, 目录结构由 custom_rule 决定
+
+    指定 archive 时按同样的结构直接写入压缩包 (.zip / .tar / .tar.gz / .tar.zst), 不创建导出目录树;
+    文件仍会下载到 {output_dir}/raw 以便下次复用.
+    """
+    if archive:
+        try:
+            check_archive_path(archive)
+        except (ValueError, RuntimeError) as e:
+            logger.error(e)
+            return
+    db = open_database(db_path)
     raw_path = os.path.join(output_dir, 'raw')
     os.makedirs(raw_path, exist_ok=True)
 
@@ -429,105 +675,335 @@ def export_to_local_path(db_path: str = "invoices.db", output_dir: str = "output
             logger.error("No invoices found in the database.")
             return
         
-        # get invoices data
-        keys = ("file_token", "type", "number", "date", "buyerTaxID",
-                "buyerName", "sellerTaxID", "sellerName", "items_brief",
-                "items_unit", "remark", "item_num", "total_items_num",
-                "totalAmount", "error_message", "items", "status")
-        result = db.execute(
-            f"SELECT {', '.join(keys)} FROM invoices").fetchall()
-        invoices_data = [{
-            key: row[index]
-            for index, key in enumerate(keys)
-        } for row in result]
-
-        # format all invoices data
-        for invoice_data in invoices_data:
-            for key, type_value in table_fields_type_map.items():
-                if key in invoice_data:
-                    value = invoice_data[key]
-
-                    if value in (None, '', [], {}, ()):
-                        del invoice_data[key]
-                        continue
-
-                    if type_value == 2:
-                        invoice_data[key] = int(value)
-                    elif type_value == 3:
-                        invoice_data[key] = str(value)
-
-        # add uploader and belonger data
-        result = db.execute(f"""
-            SELECT
-                json_extract(records.{UPLOADER_COLUMN_NAME}, '$[0].name') AS uploader,
-                json_extract(records.{BELONGER_COLUMN_NAME}, '$[0].name') AS belonger,
-                json_extract(value, '$.file_token') AS file_token
-            FROM records, json_each(records.{INVOICE_COLUMN_NAME})
-        """).fetchall()
-
-        invoices_by_token = {
-            data['file_token']: data
-            for data in invoices_data
-        }
-        for row in result:
-            file_token = row[2]
-            if file_token in invoices_by_token:
-                invoice_data = invoices_by_token[file_token]
-                if row[0]:
-                    invoice_data['uploader'] = row[0]
-                if row[1]:
-                    invoice_data['belonger'] = row[1]
+        prepare_invoice_view(db)
+        invoices_data = list(iter_invoice_rows(db))
         spinner.ok("✅ Done")
 
     logger.info("Downloading all invoices...")
-    existing_files = {}
-    for file in os.listdir(raw_path):
-        if os.path.isfile(os.path.join(raw_path, file)):
-            name, _ = os.path.splitext(file)
-            existing_files = existing_files | {name:file}
-    for invoice_data in tqdm(invoices_data, desc="Downloading invoices"):
-        if invoice_data['file_token'] in existing_files:
-            invoice_data['file_name'] = existing_files[invoice_data['file_token']]
-            continue
+    existing_files = scan_raw_files(db, raw_path,
+                                    {invoice_data.file_token for invoice_data in invoices_data})
 
+    def fetch_media(file_token: str, offset: int):
+        # 在下载线程中执行, 不访问数据库
         request: drive_v1.DownloadMediaRequest = drive_v1.DownloadMediaRequest.builder() \
-                .file_token(invoice_data['file_token']) \
+                .file_token(file_token) \
                 .build()
+        if offset:
+            request.headers["Range"] = f"bytes={offset}-"
         response: drive_v1.DownloadMediaResponse = client.drive.v1.media.download(
             request)
         if not response.success():
-            lark.logger.error(
+            raise RuntimeError(
                 f"client.drive.v1.media.download failed, code: {response.code}, msg: {response.msg},log_id: {response.get_log_id()}"
             )
+        if response.file is None:
+            raise RuntimeError("File is empty or not found.")
+        partial_content = bool(offset) and response.raw.status_code == 206
+        return response.file_name, response.file.read(), partial_content
+
+    file_names = {}
+    completed, failed = [], []
+    with ContentStore.from_env(db) as store:
+        pending = []
+        for invoice_data in invoices_data:
+            file_token = invoice_data.file_token
+            file_name = existing_files.get(file_token)
+            if file_name is not None:
+                file_names[file_token] = file_name
+                continue
+
+            # fetch 时已保存到本地存储的文件直接链接过来, 无需下载
+            stored_path = store.path(file_token)
+            if stored_path is not None:
+                _, stored_name = store.lookup(file_token)
+                _, ext = os.path.splitext(stored_name or "")
+                file_name = file_token + ext
+                link_or_copy(stored_path, os.path.join(raw_path, file_name))
+                file_names[file_token] = file_name
+                completed.append((file_token, file_name, os.path.getsize(stored_path),
+                                  os.path.basename(stored_path)))
+                continue
+            pending.append(file_token)
+
+        # 并发下载, 单个文件失败(重试后)不影响其余文件
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = {
+                executor.submit(download_file, partial(fetch_media, file_token), raw_path, file_token): file_token
+                for file_token in pending
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading invoices"):
+                file_token = futures[future]
+                try:
+                    file_name, size, file_hash = future.result()
+                except DownloadError as e:
+                    logger.error(f"Failed to download file {file_token}: {e}")
+                    failed.append(file_token)
+                    continue
+                file_names[file_token] = file_name
+                completed.append((file_token, file_name, size, file_hash))
+                store.put_file(file_token, file_name, os.path.join(raw_path, file_name), file_hash)
+    record_raw_files(db, raw_path, completed)
+    if failed:
+        logger.warning(
+            f"{len(failed)} files could not be downloaded and are skipped, run export again to retry.")
+
+    logger.info("Export invoice file by custom rule...")
+
+    def invoice_links():
+        for invoice_data in invoices_data:
+            file_name = file_names.get(invoice_data.file_token)
+            if file_name is None:
+                continue
+            invoice = Invoice(invoice_data.as_dict())
+            belonger = invoice_data.belonger or 'unknown'
+            for path in custom_rule.export_links(invoice, file_name, invoice_data.status, belonger):
+                yield path, file_name, invoice_data, invoice, belonger
+
+    if archive:
+        if not hasattr(custom_rule, "export_links"):
+            logger.error("Archive export requires custom_rule.export_links.")
             return
+        if failed:
+            # 不写入缺少文件的压缩包
+            logger.error(
+                f"Archive not written: {len(failed)} files could not be downloaded, run export again to retry.")
+            return
+        count = write_archive(archive, raw_path, (
+            (path, file_name, {"file_token": invoice_data.file_token,
+                               "status": invoice_data.status,
+                               "belonger": belonger,
+                               "number": invoice.number,
+                               "date": invoice.date,
+                               "totalAmount": invoice.totalAmount})
+            for path, file_name, invoice_data, invoice, belonger in invoice_links()))
+        logger.info(f"导出成功，{count} 个文件已写入 \"{archive}\".")
+        return
+    if hasattr(custom_rule, "export_links"):
+        plan = plan_export((path, file_name) for path, file_name, *_ in invoice_links())
+        # 下载失败的发票保留上次导出的文件, 下次导出时再更新
+        keep_export_links(db, plan, set(failed))
+        stats = apply_export(db, output_dir, plan)
+        logger.info(
+            f"Export links: {stats['created']} created, {stats['renamed']} moved, "
+            f"{stats['removed']} removed, {stats['unchanged']} unchanged.")
+    else:
+        # 旧版 custom_rule 只定义了 export_invoice, 逐张导出
+        for invoice_data in tqdm(invoices_data, desc="exporting by custom rule"):
+            if invoice_data.file_token not in file_names:
+                continue
+            invoice = Invoice(invoice_data.as_dict())
+            custom_rule.export_invoice(invoice, file_names[invoice_data.file_token], invoice_data.status, invoice_data.belonger or 'unknown', output_dir)
 
-        # Read the file content and encode it to base64
-        if response.file is not None:
-            _, ext = os.path.splitext(response.file_name)
-            file_name = invoice_data['file_token'] + ext
-            file_path = f"{raw_path}/{file_name}"
-            invoice_data['file_name'] = file_name
-            f = open(file_path, "wb")
-            f.write(response.file.read())
-            f.close()
-        else:
-            logger.warning(
-                f"File {invoice_data['file_token']} is empty or not found."
+    logger.info(f"导出成功，请检查目录 \"{output_dir}\".")
+
+
+def export_snapshot(db_path: str = "invoices.db",
+                    output_dir: str = "output/snapshot",
+                    fmt: str = "parquet",
+                    partition_by_month: bool = False,
+                    incremental: bool = False):
+    """
+    导出发票、商品明细、记录附件关联的列式快照 (Parquet / Arrow / CSV), 供 BI 与月末报表直接读取
+    """
+    db = open_database(db_path)
+    if not "invoices" in db.table_names():
+        logger.error("No invoices found in the database.")
+        return
+
+    logger.info(f"Writing {fmt} snapshot...")
+    with yaspin(text="", spinner="dots") as spinner:
+        prepare_invoice_view(db)
+        try:
+            counts = write_snapshot(db, output_dir, fmt, partition_by_month, incremental)
+        except (ValueError, RuntimeError) as e:
+            spinner.fail("❌ Failed")
+            logger.error(e)
+            return
+        spinner.ok("✅ Done")
+    logger.info(
+        f"导出成功，{', '.join(f'{name}: {count} 行' for name, count in counts.items())}，请检查目录 \"{output_dir}\".")
+
+
+def query_invoices(db_path: str = "invoices.db",
+                   text: str = None,
+                   seller: str = None,
+                   buyer: str = None,
+                   item: str = None,
+                   remark: str = None,
+                   date_from: str = None,
+                   date_to: str = None,
+                   min_amount: float = None,
+                   max_amount: float = None,
+                   status: list = None,
+                   belonger: str = None,
+                   limit: int = 50,
+                   output: str = None):
+    """
+    检索发票: 销售方/购买方/商品名称/备注 的子串全文匹配 (FTS5 trigram 索引), 结合日期、金额、状态、收款人过滤
+
+    指定 output 时将全部结果写入文件 (.csv / .parquet / .arrow, 字段与 export --format 的 invoices 相同),
+    否则打印前 limit 条.
+    """
+    db = open_database(db_path)
+    if not "invoices" in db.table_names():
+        logger.error("No invoices found in the database.")
+        return
+
+    prepare_invoice_view(db)
+    where, params = search_conditions(db, text, seller, buyer, item, remark, date_from, date_to,
+                                      min_amount, max_amount, status, belonger)
+    if output:
+        try:
+            count = write_query_result(db, output, where, params)
+        except (ValueError, RuntimeError) as e:
+            logger.error(e)
+            return
+        logger.info(f"{count} invoices written to \"{output}\".")
+        return
+
+    columns = [key for key, _ in INVOICE_SNAPSHOT_COLUMNS]
+    total = db.execute(f"SELECT COUNT(*) FROM ({invoice_query(db, where)})", params).fetchone()[0]
+    for row in db.execute(f"{invoice_query(db, where)} LIMIT ?", [*params, limit]):
+        row = dict(zip(columns, row))
+        logger.info(
+            f"  {row['file_token']} {row['date'] or '-'} {row['sellerName'] or '-'} "
+            f"{row['totalAmount'] if row['totalAmount'] is not None else '-'} "
+            f"status={row['status']} belonger={row['belonger'] or '-'} {row['items_brief'] or ''}")
+    logger.info(f"Found {total} invoices{f', showing first {limit}' if total > limit else ''}.")
+
+
+def report_invoices(db_path: str = "invoices.db",
+                    dimensions: list = None,
+                    top: int = 20,
+                    table_url: str = None,
+                    rebuild: bool = False):
+    """
+    按 状态/收款人/销售方/开票月份 汇总发票数量与价税合计
+
+    汇总由 invoice_summary 表直接读取 (触发器随发票写入增量维护, 首次运行时全量计算),
+    指定 table_url 时将全部汇总覆盖写入该多维表格 (需包含 维度/项目/发票数/价税合计 字段).
+    """
+    db = open_database(db_path)
+    if not "invoices" in db.table_names():
+        logger.error("No invoices found in the database.")
+        return
+
+    prepare_invoice_view(db)
+    if not ensure_invoice_summary(db, rebuild):
+        logger.error("Invoices table is missing fields required by the report.")
+        return
+
+    dimensions = dimensions or list(SUMMARY_DIMENSIONS)
+    for dimension in dimensions:
+        logger.info(f"{SUMMARY_DIMENSIONS[dimension]}:")
+        for key, count, total_cents in iter_summary(db, dimension, top):
+            logger.info(f"  {key or '-'}: {count} invoices, {total_cents / 100:.2f}")
+
+    if table_url:
+        push_report_to_table(db, table_url, dimensions)
+
+
+def push_report_to_table(db: Database, table_url: str, dimensions: list):
+    """(飞书)以当前汇总覆盖多维表格中的全部记录"""
+    lark_bitable_app_token, lark_bitable_table_id = extract_params_from_url(table_url)
+
+    logger.info("Creating client for Lark API.")
+    with yaspin(text="", spinner="dots") as spinner:
+        # 延迟导入 lark_oapi，提高主程序启动速度
+        import lark_oapi as lark
+        import lark_oapi.api.bitable.v1 as bitable_v1
+
+        if not (lark.APP_ID and lark.APP_SECRET):
+            logger.error(
+                "Lark APP_ID and APP_SECRET are not set. Please check file .env for LARK_APP_ID and LARK_APP_SECRET."
             )
+            return
+        client = lark.Client.builder() \
+            .app_id(lark.APP_ID) \
+            .app_secret(lark.APP_SECRET) \
+            .log_level(LARK_LOG_LEVEL) \
+            .build()
+        spinner.ok("✅ Done")
 
-    logger.info("Export invoice file by custom rule...")
-    for invoice_data in tqdm(invoices_data, desc="exporting by custom rule"):
-        invoice = Invoice(invoice_data)
-        custom_rule.export_invoice(invoice, invoice_data['file_name'], invoice_data['status'], invoice_data.get('belonger','unknown'), output_dir)
+    logger.info("Pushing report to the table...")
+    with yaspin(text="", spinner="dots") as spinner:
+        BATCH_SIZE = 500
+        record_ids = []
+        page_token = ""
+        while True:
+            request: bitable_v1.SearchAppTableRecordRequest = bitable_v1.SearchAppTableRecordRequest.builder() \
+                .app_token(lark_bitable_app_token) \
+                .table_id(lark_bitable_table_id) \
+                .page_token(page_token) \
+                .page_size(500) \
+                .request_body(bitable_v1.SearchAppTableRecordRequestBody.builder()
+                        .build()) \
+                .build()
+            response: bitable_v1.SearchAppTableRecordResponse = client.bitable.v1.app_table_record.search(
+                request)
+            if not response.success():
+                lark.logger.error(
+                    f"client.bitable.v1.app_table_record.search failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
+                )
+                return
+            record_ids.extend(record.record_id for record in response.data.items or [])
+            if not response.data.has_more:
+                break
+            page_token = response.data.page_token
 
-    logger.info(f"导出成功，请检查目录 \"{output_dir}\".")
+        def send(batch):
+            action, records = batch
+            if action == "delete":
+                request: bitable_v1.BatchDeleteAppTableRecordRequest = bitable_v1.BatchDeleteAppTableRecordRequest.builder() \
+                    .app_token(lark_bitable_app_token) \
+                    .table_id(lark_bitable_table_id) \
+                    .request_body(bitable_v1.BatchDeleteAppTableRecordRequestBody.builder()
+                        .records(records)
+                        .build()) \
+                    .build()
+                response: bitable_v1.BatchDeleteAppTableRecordResponse = client.bitable.v1.app_table_record.batch_delete(
+                    request)
+            else:
+                request: bitable_v1.BatchCreateAppTableRecordRequest = bitable_v1.BatchCreateAppTableRecordRequest.builder() \
+                    .app_token(lark_bitable_app_token) \
+                    .table_id(lark_bitable_table_id) \
+                    .request_body(bitable_v1.BatchCreateAppTableRecordRequestBody.builder()
+                        .records(records)
+                        .build()) \
+                    .build()
+                response: bitable_v1.BatchCreateAppTableRecordResponse = client.bitable.v1.app_table_record.batch_create(
+                    request)
+            if not response.success():
+                lark.logger.error(
+                    f"client.bitable.v1.app_table_record.batch_{action} failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
+                )
+                return False
+            return True
+
+        def produce():
+            for batch in batched(record_ids, BATCH_SIZE):
+                yield "delete", list(batch)
+            records = (
+                {"fields": {REPORT_FIELDS["dimension"]: SUMMARY_DIMENSIONS[dimension],
+                            REPORT_FIELDS["key"]: key,
+                            REPORT_FIELDS["invoices"]: count,
+                            REPORT_FIELDS["total"]: total_cents / 100}}
+                for dimension in dimensions
+                for key, count, total_cents in iter_summary(db, dimension)
+            )
+            for batch in batched(records, BATCH_SIZE):
+                yield "create", list(batch)
+
+        if not upload_in_batches(produce(), send):
+            return
+        spinner.ok("✅ Done")
 
 
 def create_lark_app_table(table_url: str, db_path: str = "invoices.db"):
     """
     (飞书)创建展示发票信息的数据表
     """
-    db = Database(db_path)
+    db = open_database(db_path)
     lark_bitable_app_token, _ = extract_params_from_url(table_url, need_table_id = False)
 
     logger.info("Creating client for Lark API.")
@@ -592,67 +1068,9 @@ def create_lark_app_table(table_url: str, db_path: str = "invoices.db"):
 
     logger.info("Inserting invoices data.")
     with yaspin(text="", spinner="dots") as spinner:
-        # get invoices data
-        keys = ("file_token", "type", "number", "date", "buyerTaxID",
-                "buyerName", "sellerTaxID", "sellerName", "items_brief",
-                "items_unit", "remark", "item_num", "total_items_num",
-                "totalAmount", "error_message", "items", "status")
-        result = db.execute(
-            f"SELECT {', '.join(keys)} FROM invoices").fetchall()
-        invoices_data = [{
-            key: row[index]
-            for index, key in enumerate(keys)
-        } for row in result]
-
-        # format all invoices data
-        for invoice_data in invoices_data:
-            for key, type_value in table_fields_type_map.items():
-                if key in invoice_data:
-                    value = invoice_data[key]
-
-                    if value in (None, '', [], {}, ()):
-                        del invoice_data[key]
-                        continue
-
-                    if type_value == 2:
-                        invoice_data[key] = int(value)
-                    elif type_value == 3:
-                        invoice_data[key] = str(value)
-
-        # add uploader and belonger data
-        result = db.execute(f"""
-            SELECT
-                json_extract(records.{UPLOADER_COLUMN_NAME}, '$[0].id') AS uploader_id,
-                json_extract(records.{BELONGER_COLUMN_NAME}, '$[0].id') AS belonger_id,
-                json_extract(value, '$.file_token') AS file_token
-            FROM records, json_each(records.{INVOICE_COLUMN_NAME})
-        """).fetchall()
-
-        invoices_by_token = {
-            data['file_token']: data
-            for data in invoices_data
-        }
-        for row in result:
-            file_token = row[2]
-            if file_token in invoices_by_token:
-                invoice_data = invoices_by_token[file_token]
-                if row[0]:
-                    invoice_data['uploader'] = [{"id": row[0], "type": "user"}]
-                if row[1]:
-                    invoice_data['belonger'] = [{"id": row[1], "type": "user"}]
-
-        # i18n support
-        records = []
-        for data in invoices_data:
-            fields = {}
-            for key,value in data.items():
-                fields[i18n.t(key)] = value
-            records.append({"fields":fields})
-
-        # try insert to bitable table
         BATCH_SIZE = 1000
-        while records:
-            batch = records[:BATCH_SIZE]
+
+        def send(batch):
             request: bitable_v1.BatchCreateAppTableRecordRequest = bitable_v1.BatchCreateAppTableRecordRequest.builder() \
                 .app_token(lark_bitable_app_token) \
                 .table_id(lark_bitable_table_id) \
@@ -667,37 +1085,22 @@ def create_lark_app_table(table_url: str, db_path: str = "invoices.db"):
                 lark.logger.error(
                     f"client.bitable.v1.app_table_record.batch_create failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}, resp: \n{json.dumps(json.loads(response.raw.content), indent=4, ensure_ascii=False)}"
                 )
-                return
-            records = records[BATCH_SIZE:]
+                return False
+            return True
+
+        # try insert to bitable table
+        prepare_invoice_view(db)
+        records = ({"fields": bitable_fields(row)}
+                   for row in iter_invoice_rows(db, arraysize=BATCH_SIZE))
+        if not upload_in_batches(batched(records, BATCH_SIZE), send):
+            return
         spinner.ok("✅ Done")
 
-def recheck_invoices(db_path: str = "invoices.db"):
-    db = Database(db_path)
+def recheck_invoices(db_path: str = "invoices.db", full: bool = False, jobs: int = 1):
+    db = open_database(db_path)
     logger.info("Verifying invoice data with custom rules...")
     with yaspin(text="", spinner="dots") as spinner:
-        invoices_data = db["invoices"].rows_where("processed = ?", (True, ))
-        for invoice_data in tqdm(invoices_data, desc="Verifying invoices"):
-            try:
-                invoice = Invoice(invoice_data)
-                verification_result = custom_rule.vertify_invoice(invoice)
-
-                if verification_result["status"] == "error":
-                    logger.debug(
-                        f"Verification failed for file {invoice_data['file_token']}: {verification_result['message']}"
-                    )
-                    db["invoices"].update(
-                        invoice_data['file_token'], {
-                            "error_message": verification_result["message"],
-                            "status": '-2'
-                        })
-                else:
-                    logger.debug(
-                        f"Verification passed for file {invoice_data['file_token']}."
-                    )
-            except Exception as e:
-                logger.error(
-                    f"Error verifying file {invoice_data['file_token']}: {str(e)}"
-                )
+        verify_invoices(db, full, jobs)
 
         spinner.ok("✅ Done")
 
@@ -706,7 +1109,7 @@ def sync_from_table(table_url: str, db_path: str = "invoices.db"):
     """
     同步数据 方向 本地数据库<-远程云文档
     """
-    db = Database(db_path)
+    db = open_database(db_path)
     lark_bitable_app_token, lark_bitable_table_id = extract_params_from_url(
         table_url)
 
@@ -755,14 +1158,16 @@ def sync_from_table(table_url: str, db_path: str = "invoices.db"):
             lark.logger.debug(
                 f"Fetched {len(response.data.items)} records from the table.")
 
-            for record in response.data.items:
-                db["invoices"].update(
-                    extract_text(record.fields, i18n.t('file_token')), {
-                        "error_message":
-                        extract_text(record.fields, i18n.t('error_message')),
-                        "status":
-                        extract_text(record.fields, i18n.t('status'))
-                    })
+            # 每页记录在一个事务内批量更新
+            with InvoiceWriter(db, batch_size=None) as writer:
+                for record in response.data.items:
+                    writer.update(
+                        extract_text(record.fields, i18n.t('file_token')), {
+                            "error_message":
+                            extract_text(record.fields, i18n.t('error_message')),
+                            "status":
+                            extract_text(record.fields, i18n.t('status'))
+                        })
             if not response.data.has_more:
                 break
             page_token = response.data.page_token
@@ -773,7 +1178,7 @@ def sync_to_table(table_url: str, db_path: str = "invoices.db"):
     """
     同步数据 方向 本地数据库->远程云文档
     """
-    db = Database(db_path)
+    db = open_database(db_path)
     lark_bitable_app_token, lark_bitable_table_id = extract_params_from_url(
         table_url)
 
@@ -833,113 +1238,69 @@ def sync_to_table(table_url: str, db_path: str = "invoices.db"):
 
     logger.info("Updating invoices data.")
     with yaspin(text="", spinner="dots") as spinner:
-        # get invoices data
-        keys = ("file_token", "type", "number", "date", "buyerTaxID",
-                "buyerName", "sellerTaxID", "sellerName", "items_brief",
-                "items_unit", "remark", "item_num", "total_items_num",
-                "totalAmount", "error_message", "items", "status")
-        result = db.execute(
-            f"SELECT {', '.join(keys)} FROM invoices").fetchall()
-        invoices_data = [{
-            key: row[index]
-            for index, key in enumerate(keys)
-        } for row in result]
-
-        # format all invoices data
-        for invoice_data in invoices_data:
-            for key, type_value in table_fields_type_map.items():
-                if key in invoice_data:
-                    value = invoice_data[key]
-
-                    if value in (None, '', [], {}, ()):
-                        del invoice_data[key]
-                        continue
-
-                    if type_value == 2:
-                        invoice_data[key] = int(value)
-                    elif type_value == 3:
-                        invoice_data[key] = str(value)
-
-        # add uploader and belonger data
-        result = db.execute(f"""
-            SELECT
-                json_extract(records.{UPLOADER_COLUMN_NAME}, '$[0].id') AS uploader_id,
-                json_extract(records.{BELONGER_COLUMN_NAME}, '$[0].id') AS belonger_id,
-                json_extract(value, '$.file_token') AS file_token
-            FROM records, json_each(records.{INVOICE_COLUMN_NAME})
-        """).fetchall()
+        BATCH_SIZE = 1000
 
-        invoices_by_token = {
-            data['file_token']: data
-            for data in invoices_data
-        }
-        for row in result:
-            file_token = row[2]
-            if file_token in invoices_by_token:
-                invoice_data = invoices_by_token[file_token]
-                if row[0]:
-                    invoice_data['uploader'] = [{"id": row[0], "type": "user"}]
-                if row[1]:
-                    invoice_data['belonger'] = [{"id": row[1], "type": "user"}]
-
-        update_records = []
-        insert_records = []
-        # add i18n support 
-        for data in invoices_data:
-            if data['file_token'] in record_ids:
-                update_records.append({
-                    "fields": {
-                        i18n.t("error_message"): data.get('error_message'),
-                        i18n.t("status"): data.get('status'),
-                    },
-                    "record_id":
-                    record_ids[data['file_token']]
-                })
+        def send(batch):
+            action, records = batch
+            if action == "update":
+                request: bitable_v1.BatchUpdateAppTableRecordRequest = bitable_v1.BatchUpdateAppTableRecordRequest.builder() \
+                    .app_token(lark_bitable_app_token) \
+                    .table_id(lark_bitable_table_id) \
+                    .request_body(bitable_v1.BatchUpdateAppTableRecordRequestBody.builder()
+                        .records(records)
+                        .build()) \
+                    .build()
+                response: bitable_v1.BatchUpdateAppTableRecordResponse = client.bitable.v1.app_table_record.batch_update(
+                    request)
             else:
-                fields = {}
-                for key,value in data.items():
-                    fields[i18n.t(key)] = value
-                insert_records.append({"fields": fields})
-
-        # try upate to bitable table
-        BATCH_SIZE = 1000
-        while update_records:
-            batch = update_records[:BATCH_SIZE]
-            request: bitable_v1.BatchUpdateAppTableRecordRequest = bitable_v1.BatchUpdateAppTableRecordRequest.builder() \
-                .app_token(lark_bitable_app_token) \
-                .table_id(lark_bitable_table_id) \
-                .request_body(bitable_v1.BatchUpdateAppTableRecordRequestBody.builder()
-                    .records(batch)
-                    .build()) \
-                .build()
-            response: bitable_v1.BatchUpdateAppTableRecordResponse = client.bitable.v1.app_table_record.batch_update(
-                request)
+                # Insert invoice records that do not exist in the table
+                request: bitable_v1.BatchCreateAppTableRecordRequest = bitable_v1.BatchCreateAppTableRecordRequest.builder() \
+                    .app_token(lark_bitable_app_token) \
+                    .table_id(lark_bitable_table_id) \
+                    .ignore_consistency_check(True) \
+                    .request_body(bitable_v1.BatchCreateAppTableRecordRequestBody.builder()
+                        .records(records)
+                        .build()) \
+                    .build()
+                response: bitable_v1.BatchCreateAppTableRecordResponse = client.bitable.v1.app_table_record.batch_create(
+                    request)
             if not response.success():
                 lark.logger.error(
-                    f"client.bitable.v1.app_table_record.batch_update failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}, resp: \n{json.dumps(json.loads(response.raw.content), indent=4, ensure_ascii=False)}"
+                    f"client.bitable.v1.app_table_record.batch_{action} failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}, resp: \n{json.dumps(json.loads(response.raw.content), indent=4, ensure_ascii=False)}"
                 )
-                return
-            update_records = update_records[BATCH_SIZE:]
+                return False
+            return True
+
+        def produce():
+            update_records = []
+            insert_records = []
+            for row in iter_invoice_rows(db, arraysize=BATCH_SIZE):
+                if row.file_token in record_ids:
+                    update_records.append({
+                        "fields": {
+                            FIELD_NAMES["error_message"]: row.error_message,
+                            FIELD_NAMES["status"]: row.status,
+                        },
+                        "record_id":
+                        record_ids[row.file_token]
+                    })
+                    if len(update_records) >= BATCH_SIZE:
+                        yield "update", update_records
+                        update_records = []
+                else:
+                    insert_records.append({"fields": bitable_fields(row)})
+                    if len(insert_records) >= BATCH_SIZE:
+                        yield "create", insert_records
+                        insert_records = []
+            if update_records:
+                yield "update", update_records
+            if insert_records:
+                yield "create", insert_records
 
-        # Insert invoice records that do not exist in the table
-        while insert_records:
-            batch = insert_records[:BATCH_SIZE]
-            request: bitable_v1.BatchCreateAppTableRecordRequest = bitable_v1.BatchCreateAppTableRecordRequest.builder() \
-                .app_token(lark_bitable_app_token) \
-                .table_id(lark_bitable_table_id) \
-                .ignore_consistency_check(True) \
-                .request_body(bitable_v1.BatchCreateAppTableRecordRequestBody.builder()
-                    .records(batch)
-                    .build()) \
-                .build()
-            response: bitable_v1.BatchCreateAppTableRecordResponse = client.bitable.v1.app_table_record.batch_create(
-                request)
-            if not response.success():
-                lark.logger.error(
-                    f"client.bitable.v1.app_table_record.batch_create failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}, resp: \n{json.dumps(json.loads(response.raw.content), indent=4, ensure_ascii=False)}"
-                )
-                return
-            insert_records = insert_records[BATCH_SIZE:]
+        # try upate to bitable table
+        prepare_invoice_view(db)
+        if not upload_in_batches(produce(), send):
+            return
         spinner.ok("✅ Done")
 
 
@@ -947,7 +1308,7 @@ def auto_sync(table_url: str, db_path: str = "invoices.db"):
     """
     根据修改时间自动选择同步方向
     """
-    db = Database(db_path)
+    db = open_database(db_path)
     lark_bitable_app_token, lark_bitable_table_id = extract_params_from_url(
         table_url)
 
@@ -1044,33 +1405,244 @@ def auto_sync(table_url: str, db_path: str = "invoices.db"):
 
 
 def group_invoices(file_path, db_path: str = "invoices.db"):
-    db = Database(db_path)
+    """
+    按参数文件(JSON 或 NDJSON)批量设置发票的 status, 报告命中/未命中的关键字数量
+    """
+    db = open_database(db_path)
 
     logger.info('Parsing target file.')
+    try:
+        request, entries = read_group_request(file_path)
+        key: str = request['key']
+        like_match: bool = request.get('like_match', False)
+        case_insensitive: bool = request.get('case_insensitive', True)
+        if not isinstance(key, str):
+            raise ValueError('key has wrong type.')
+        logger.debug(f'group key:{key}, like_match:{like_match}, case_insensitive:{case_insensitive}')
+    except Exception:
+        logger.exception("传入的参数文件格式错误，请检查 JSON 格式或字段内容")
+        return
+
+    logger.info('Updating invoices data.')
     with yaspin(text="", spinner="dots") as spinner:
-        with open(file_path, 'r') as f:
-            request = json.loads(f.read())
         try:
-            key: str = request['key']
-            target: list = request['target']
-            like_match: bool = request.get('like_match', False)
-            case_insensitive: bool = request.get('case_insensitive', True)
-            if not isinstance(key, str) or not isinstance(target, list):
-                raise ValueError('key or target has wrong type.')
-            logger.debug(f'group key:{key}, like_match:{like_match}, case_insensitive:{case_insensitive}')
-        except Exception:
-            logger.exception("传入的参数文件格式错误，请检查 JSON 格式或字段内容")
+            result = apply_group(db, key, entries, like_match, case_insensitive)
+        except ValueError as e:
+            spinner.fail("❌ Failed")
+            logger.error(e)
+            return
+        spinner.ok("✅ Done")
 
+    logger.info(
+        f"{result['entries']} entries: {result['matched']} matched, {result['unmatched']} unmatched, "
+        f"{result['updated']} invoices updated."
+    )
+    if result["unmatched_examples"]:
+        logger.info(f"Unmatched entries (first {len(result['unmatched_examples'])}): "
+                    f"{', '.join(result['unmatched_examples'])}")
+
+
+def dedupe_invoices(db_path: str = "invoices.db", dry_run: bool = False):
+    """
+    按发票唯一标识(invoice_key)重新扫描数据库, 报告并标记重复发票
+
+    带有重复提示但不属于任何重复簇的发票 (旧版本仅按号码误判) 恢复为正常状态并重新校验.
+    """
+    db = open_database(db_path)
+    if not "invoices" in db.table_names():
+        logger.error("No invoices found in the database.")
+        return
+
+    logger.info("Scanning invoices for duplicates...")
+    with yaspin(text="", spinner="dots") as spinner:
+        if dry_run:
+            clusters = find_duplicate_clusters(db)
+            duplicates = {file_token for members in clusters.values()
+                          for file_token, original in members if file_token != original}
+            released = sum(
+                1 for file_token, in db.execute(
+                    "SELECT file_token FROM invoices WHERE error_message LIKE ?",
+                    (f"{DUPLICATE_MESSAGE}%", ))
+                if file_token not in duplicates)
+        else:
+            released = ensure_invoice_identity(db)
+            clusters = mark_duplicates(db)
+            released += release_duplicates(db)
         spinner.ok("✅ Done")
 
-    logger.info('Updating invoices data.')
+    for key, members in clusters.items():
+        original = members[0][1]
+        duplicates = [file_token for file_token, _ in members if file_token != original]
+        logger.info(f"{key}: original {original}, duplicates {', '.join(duplicates)}")
+    logger.info(
+        f"Found {len(clusters)} duplicate clusters covering {sum(len(m) for m in clusters.values())} invoices."
+    )
+    logger.info(
+        f"{'Would release' if dry_run else 'Released'} {released} invoices wrongly marked as duplicates."
+    )
+    if released and not dry_run:
+        logger.info("Verifying released invoices with custom rules...")
+        verify_invoices(db)
+
+
+def profile_rules(db_path: str = "invoices.db", watch: bool = False, top: int = 10):
+    """
+    只读地对数据库中全部已处理发票执行 custom_rule.vertify_invoice,
+    报告各结果/备注的数量、耗时分布、最慢的发票, 以及与已存储状态的差异
+
+    watch 为 True 时监视 custom_rule.py, 文件修改后重新载入并再次报告
+    """
+    db = open_database(db_path, read_only=True)
+    if not "invoices" in db.table_names():
+        logger.error("No invoices found in the database.")
+        return
+
+    def report():
+        rows = db["invoices"].rows_where("processed = ?", (True, ))
+        result = profile_python_rules(custom_rule, rows, top)
+        logger.info(f"Profiled {result['total']} invoices with rules {rule_fingerprint(custom_rule)}.")
+        for outcome, count in result["outcomes"].most_common():
+            logger.info(f"  outcome {outcome}: {count}")
+        for message, count in result["messages"].most_common():
+            logger.info(f"  message {message}: {count}")
+        latency = result["latency"]
+        logger.info(
+            "  latency p50 {:.3f}ms, p90 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms".format(
+                *(latency[key] * 1000 for key in ("p50", "p90", "p99", "max"))))
+        for elapsed, file_token in result["slowest"]:
+            logger.info(f"  slow {file_token}: {elapsed * 1000:.3f}ms")
+        if not result["diff"]:
+            logger.info("  no difference from stored statuses.")
+        for change, count in result["diff"].most_common():
+            logger.info(
+                f"  {change}: {count} (e.g. {', '.join(result['diff_examples'][change])})")
+
+    report()
+    if not watch:
+        return
+
+    logger.info(f"Watching {custom_rule.__file__} for changes, press Ctrl+C to stop.")
+    last_mtime = os.path.getmtime(custom_rule.__file__)
+    try:
+        while True:
+            time.sleep(1)
+            mtime = os.path.getmtime(custom_rule.__file__)
+            if mtime == last_mtime:
+                continue
+            last_mtime = mtime
+            try:
+                importlib.reload(custom_rule)
+            except Exception:
+                logger.exception("Failed to reload custom_rule.")
+                continue
+            report()
+    except KeyboardInterrupt:
+        pass
+
+
+def audit_invoices(db_path: str = "invoices.db", tolerance: float = 0.01, top: int = 10):
+    """
+    金额一致性审计: 检查 金额+税额、商品明细合计 与价税合计是否一致,
+    以及记录的审批后金额与其发票合计是否一致, 问题写入 audit_findings 表
+    """
+    db = open_database(db_path)
+    if not "invoices" in db.table_names():
+        logger.error("No invoices found in the database.")
+        return
+
+    logger.info("Auditing invoice amounts...")
     with yaspin(text="", spinner="dots") as spinner:
-        if not case_insensitive:
-            db.execute("PRAGMA case_sensitive_like = ON")
-        for data in target:
-            for key_word, status in data.items():
-                value = f"%{key_word}%" if like_match else key_word
-                db.execute(f"UPDATE invoices SET status = ? WHERE {key} LIKE ?",
-                        (status, value))
-        db.conn.commit()
+        prepare_invoice_view(db)
+        counts = run_audit(db, TOTAL_AMOUNT_COLUMN_NAME, to_cents(tolerance))
         spinner.ok("✅ Done")
+
+    for check_name, description in AUDIT_CHECKS.items():
+        if check_name in counts:
+            logger.info(f"  {check_name} ({description}): {counts[check_name]}")
+        else:
+            logger.info(f"  {check_name} ({description}): skipped, required columns not found")
+    for finding in iter_findings(db, top):
+        logger.info(
+            f"  [{finding['check_name']}] {finding['subject']}: expected {finding['expected'] / 100:.2f}, "
+            f"actual {finding['actual'] / 100:.2f}, difference {finding['difference'] / 100:.2f} "
+            f"({finding['detail']})")
+    logger.info(f"Found {sum(counts.values())} findings, see table audit_findings for details.")
+
+
+def reparse_invoices(db_path: str = "invoices.db", jobs: int = 1):
+    """
+    以当前的解析逻辑离线重新解析 ocr_responses 中存档的原始响应 (不访问网络),
+    仅更新解析结果有变化的发票, 之后重新校验这些发票
+
+    jobs > 1 时在进程池中按块并行解析.
+    """
+    db = open_database(db_path)
+    if not {"invoices", "ocr_responses"} <= set(db.table_names()) \
+            or "file_hash" not in db["invoices"].columns_dict:
+        logger.error("No archived OCR responses found in the database.")
+        return
+
+    file_tokens = [row[0] for row in db.execute("""
+        SELECT file_token FROM invoices
+        WHERE file_hash IN (SELECT file_hash FROM ocr_responses)
+        ORDER BY file_token
+    """)]
+
+    def load_chunks():
+        # 按块读取存档, 优先使用上次成功解析的接口的响应
+        for chunk_tokens in batched(file_tokens, REPARSE_CHUNK_SIZE):
+            rows = db.execute(f"""
+                SELECT i.file_token, r.provider, r.codec, r.payload
+                FROM invoices i
+                JOIN ocr_responses r ON r.file_hash = i.file_hash
+                WHERE i.file_token IN ({", ".join("?" for _ in chunk_tokens)})
+                ORDER BY i.file_token, r.provider = i.ocr_provider DESC, r.created_at DESC
+            """, chunk_tokens).fetchall()
+            yield [(file_token, [row[1:] for row in group])
+                   for file_token, group in groupby(rows, key=itemgetter(0))]
+
+    changed = failed = 0
+    with InvoiceWriter(db) as writer, \
+            tqdm(total=len(file_tokens), desc="Reparsing invoices") as progress:
+        if jobs > 1:
+            executor = ProcessPoolExecutor(max_workers=jobs)
+            results = bounded_map(executor, reparse_responses, load_chunks(), prefetch=jobs * 2)
+        else:
+            executor = None
+            results = map(reparse_responses, load_chunks())
+        try:
+            for chunk_results in results:
+                chunk_tokens = [result[0] for result in chunk_results]
+                existing = {
+                    row["file_token"]: row
+                    for row in db["invoices"].rows_where(
+                        f"file_token IN ({', '.join('?' for _ in chunk_tokens)})", chunk_tokens)
+                }
+                for file_token, provider, data, error in chunk_results:
+                    progress.update(1)
+                    if error is not None:
+                        logger.debug(f"Reparse failed for file {file_token}: {error}")
+                        failed += 1
+                        continue
+                    row = existing[file_token]
+                    fields = {**data, "ocr_provider": provider, "processed": True}
+                    if all(jsonify_if_needed(value) == row.get(key) for key, value in fields.items()):
+                        continue
+                    record = {**row, **fields, "verified_with": None}
+                    if not row.get("processed") or str(row.get("status")) in ("-1", "-2"):
+                        # 解析/查重/校验产生的状态随新结果重新判定, 自定义状态保留
+                        record["status"] = '0'
+                        record["error_message"] = None
+                    writer.insert(record)
+                    changed += 1
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    logger.info(
+        f"Reparsed {len(file_tokens)} invoices: {changed} changed, {failed} failed.")
+    if changed:
+        logger.info("Verifying invoice data with custom rules...")
+        with yaspin(text="", spinner="dots") as spinner:
+            verify_invoices(db, jobs=jobs)
+            spinner.ok("✅ Done")
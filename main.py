@@ -5,9 +5,11 @@ from dotenv import load_dotenv
 def main():
     load_dotenv()
     
-    from function import (fetch_from_table, export_to_local_path,
+    from function import (fetch_from_table, export_to_local_path, export_snapshot,
                       create_lark_app_table, recheck_invoices, sync_from_table,
-                      sync_to_table, auto_sync, group_invoices)
+                      sync_to_table, auto_sync, group_invoices,
+                      dedupe_invoices, profile_rules, audit_invoices,
+                      reparse_invoices, query_invoices, report_invoices)
 
     parser = argparse.ArgumentParser(description="发票处理脚本")
 
@@ -29,6 +31,18 @@ def main():
     fetch_parser.add_argument("--interface",
                               choices=["baidu", "tencent"],
                               help="使用指定接口解析发票 [baidu | tencent]")
+    fetch_parser.add_argument("--full",
+                              default=False,
+                              action="store_true",
+                              help="校验全部已处理的发票（默认仅校验新发票及规则变更后未重新校验的发票）")
+    fetch_parser.add_argument("--similar",
+                              type=int,
+                              metavar="N",
+                              help="识别前比较图片的感知哈希, 与已识别图片相差不超过 N 位(建议 6)的视为重新拍摄的同一张发票, 不调用 OCR 并标记（需要 Pillow）")
+    fetch_parser.add_argument("--batch",
+                              type=int,
+                              metavar="N",
+                              help="将至多 N 张(2-4)小尺寸图片拼接为一张后调用一次识别, 按识别结果的位置分配回各文件, 无法确定归属时单独识别（仅 tencent 接口, 需要 Pillow）")
 
     # 子命令：sync
     sync_parser = subparsers.add_parser(
@@ -64,6 +78,26 @@ def main():
     export_parser.add_argument("--db",
                                default="invoices.db",
                                help="SQLite 数据库路径")
+    export_parser.add_argument("--jobs",
+                               type=int,
+                               default=8,
+                               help="并发下载文件的线程数")
+    export_parser.add_argument("--archive",
+                               default=None,
+                               help="按相同目录结构直接导出为压缩包(如 out.zip / out.tar.zst), 附带 manifest.csv 清单")
+    export_parser.add_argument("--format",
+                               choices=["parquet", "arrow", "csv"],
+                               default=None,
+                               help="改为导出发票/商品/附件的列式快照到 --snapshot-dir (parquet/arrow 需要 pyarrow)")
+    export_parser.add_argument("--snapshot-dir",
+                               default="output/snapshot",
+                               help="快照目录")
+    export_parser.add_argument("--by-month",
+                               action="store_true",
+                               help="快照按开票月份分区 (month=YYYY-MM)")
+    export_parser.add_argument("--incremental",
+                               action="store_true",
+                               help="快照只追加上次快照后新增或更新的发票")
 
     # 子命令：recheck
     recheck_parser = subparsers.add_parser(
@@ -71,21 +105,150 @@ def main():
     recheck_parser.add_argument("--db",
                                 default="invoices.db",
                                 help="SQLite 数据库路径")
+    recheck_parser.add_argument("--full",
+                                default=False,
+                                action="store_true",
+                                help="校验全部已处理的发票（默认仅校验新发票及规则变更后未重新校验的发票）")
+    recheck_parser.add_argument("--jobs",
+                                type=int,
+                                default=1,
+                                metavar="N",
+                                help="使用 N 个进程并行执行自定义校验规则 vertify_invoice")
 
     # 子命令：group
     group_parser = subparsers.add_parser("group",
                                          help="解析给定的json文件,设置发票的status")
-    group_parser.add_argument("target", help="必填参数：指定处理目标，例如 'group.json'")
+    group_parser.add_argument("target", help="必填参数：指定处理目标，例如 'group.json'（也支持逐行读取的 NDJSON 文件）")
     group_parser.add_argument("--db",
                               default="invoices.db",
                               help="SQLite 数据库路径")
 
+    # 子命令：dedupe
+    dedupe_parser = subparsers.add_parser(
+        "dedupe", help="按发票代码/号码等唯一标识重新扫描数据库，报告并标记重复发票")
+    dedupe_parser.add_argument("--db",
+                               default="invoices.db",
+                               help="SQLite 数据库路径")
+    dedupe_parser.add_argument("--dry-run",
+                               default=False,
+                               action="store_true",
+                               help="仅报告重复发票，不修改数据库")
+
+    # 子命令：rules
+    rules_parser = subparsers.add_parser("rules", help="自定义校验规则调试工具")
+    rules_subparsers = rules_parser.add_subparsers(dest="rules_command", required=True)
+    rules_profile_parser = rules_subparsers.add_parser(
+        "profile",
+        help="只读地对数据库内发票执行 vertify_invoice，报告结果统计、耗时及与当前状态的差异")
+    rules_profile_parser.add_argument("--db",
+                                      default="invoices.db",
+                                      help="SQLite 数据库路径")
+    rules_profile_parser.add_argument("--watch",
+                                      default=False,
+                                      action="store_true",
+                                      help="监视 custom_rule.py，修改后自动重新载入并报告")
+    rules_profile_parser.add_argument("--top",
+                                      type=int,
+                                      default=10,
+                                      help="列出最慢的发票及差异示例的数量")
+
+    # 子命令：audit
+    audit_parser = subparsers.add_parser(
+        "audit", help="金额一致性审计，问题写入数据库 audit_findings 表")
+    audit_parser.add_argument("--db",
+                              default="invoices.db",
+                              help="SQLite 数据库路径")
+    audit_parser.add_argument("--tolerance",
+                              type=float,
+                              default=0.01,
+                              help="允许的金额误差（元），默认 0.01")
+    audit_parser.add_argument("--top",
+                              type=int,
+                              default=10,
+                              help="列出差额最大的问题数量")
+
+    # 子命令：reparse
+    reparse_parser = subparsers.add_parser(
+        "reparse", help="以当前解析逻辑离线重新解析存档的 OCR 原始响应（不消耗 OCR 额度）")
+    reparse_parser.add_argument("--db",
+                                default="invoices.db",
+                                help="SQLite 数据库路径")
+    reparse_parser.add_argument("--jobs",
+                                type=int,
+                                default=1,
+                                metavar="N",
+                                help="使用 N 个进程并行解析")
+
+    # 子命令：query
+    query_parser = subparsers.add_parser(
+        "query", help="检索发票(销售方/购买方/商品名称/备注 全文匹配, 按日期、金额、状态、收款人过滤)")
+    query_parser.add_argument("text",
+                              nargs="?",
+                              default=None,
+                              help="在销售方、购买方、商品名称、备注中匹配的文本, 多个词以空格分隔且需全部出现")
+    query_parser.add_argument("--db",
+                              default="invoices.db",
+                              help="SQLite 数据库路径")
+    query_parser.add_argument("--seller", default=None, help="销售方名称包含的文本")
+    query_parser.add_argument("--buyer", default=None, help="购买方名称包含的文本")
+    query_parser.add_argument("--item", default=None, help="商品名称包含的文本")
+    query_parser.add_argument("--remark", default=None, help="备注包含的文本")
+    query_parser.add_argument("--from",
+                              dest="date_from",
+                              default=None,
+                              help="开票日期不早于 (YYYY-MM-DD)")
+    query_parser.add_argument("--to",
+                              dest="date_to",
+                              default=None,
+                              help="开票日期不晚于 (YYYY-MM-DD)")
+    query_parser.add_argument("--min-amount", type=float, default=None, help="价税合计下限")
+    query_parser.add_argument("--max-amount", type=float, default=None, help="价税合计上限")
+    query_parser.add_argument("--status",
+                              nargs="+",
+                              default=None,
+                              help="状态, 可指定多个")
+    query_parser.add_argument("--belonger", default=None, help="收款人姓名")
+    query_parser.add_argument("--limit",
+                              type=int,
+                              default=50,
+                              help="未指定 --output 时打印的最大条数")
+    query_parser.add_argument("--output",
+                              default=None,
+                              help="将全部结果写入文件 (.csv / .parquet / .arrow)")
+
+    # 子命令：report
+    report_parser = subparsers.add_parser(
+        "report", help="按状态/收款人/销售方/开票月份汇总发票数量与价税合计")
+    report_parser.add_argument("--db",
+                               default="invoices.db",
+                               help="SQLite 数据库路径")
+    report_parser.add_argument("--by",
+                               nargs="+",
+                               choices=["status", "belonger", "seller", "month"],
+                               default=None,
+                               help="汇总维度, 默认全部")
+    report_parser.add_argument("--top",
+                               type=int,
+                               default=20,
+                               help="每个维度打印的最大条数")
+    report_parser.add_argument("--url",
+                               default=None,
+                               help="(可选)多维表格链接, 将汇总覆盖写入该表 (需包含 维度/项目/发票数/价税合计 字段)")
+    report_parser.add_argument("--rebuild",
+                               action="store_true",
+                               help="由全部发票重新计算汇总")
+
     args = parser.parse_args()
 
     if args.command == "fetch":
-        fetch_from_table(args.url, args.db, args.fallback, args.interface)
+        fetch_from_table(args.url, args.db, args.fallback, args.interface,
+                         args.full, args.similar, args.batch)
     elif args.command == "export":
-        export_to_local_path(args.db)
+        if args.format:
+            export_snapshot(args.db, args.snapshot_dir, args.format,
+                            args.by_month, args.incremental)
+        else:
+            export_to_local_path(args.db, jobs=args.jobs, archive=args.archive)
     elif args.command == "sync":
         if args.force == "database":
             sync_to_table(args.url, args.db)
@@ -96,9 +259,25 @@ def main():
     elif args.command == "create":
         create_lark_app_table(args.url, args.db)
     elif args.command == "recheck":
-        recheck_invoices(args.db)
+        recheck_invoices(args.db, args.full, args.jobs)
     elif args.command == "group":
         group_invoices(args.target, args.db)
+    elif args.command == "dedupe":
+        dedupe_invoices(args.db, args.dry_run)
+    elif args.command == "rules":
+        if args.rules_command == "profile":
+            profile_rules(args.db, args.watch, args.top)
+    elif args.command == "audit":
+        audit_invoices(args.db, args.tolerance, args.top)
+    elif args.command == "reparse":
+        reparse_invoices(args.db, args.jobs)
+    elif args.command == "query":
+        query_invoices(args.db, args.text, args.seller, args.buyer, args.item,
+                       args.remark, args.date_from, args.date_to,
+                       args.min_amount, args.max_amount, args.status,
+                       args.belonger, args.limit, args.output)
+    elif args.command == "report":
+        report_invoices(args.db, args.by, args.top, args.url, args.rebuild)
 
 
 if __name__ == "__main__":
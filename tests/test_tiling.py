@@ -0,0 +1,90 @@
+from core.invoice.tencent_ocr import TencentOCR
+from core.invoice.tiling import assign_regions
+
+# 三张图片在画布中的位置 (x, y, 宽, 高), 与 tile_images 的布局一致 (2 列, 间隔 80)
+BOXES = [(80, 80, 600, 400), (760, 80, 500, 700), (80, 860, 600, 400)]
+
+
+def polygon(x, y, width, height):
+    return {
+        "LeftTop": {"X": x, "Y": y},
+        "RightTop": {"X": x + width, "Y": y},
+        "RightBottom": {"X": x + width, "Y": y + height},
+        "LeftBottom": {"X": x, "Y": y + height},
+    }
+
+
+def invoice_item(number, x, y, width, height):
+    """RecognizeGeneralInvoice 返回的 MixedInvoiceItems 中的一项"""
+    return {
+        "Code": "OK",
+        "Type": 3,
+        "Polygon": polygon(x, y, width, height),
+        "Angle": 0.0,
+        "SingleInvoiceInfos": {
+            "VatElectronicInvoiceFull": {
+                "Number": number,
+                "Date": "2024年01月02日",
+                "Total": "106.00",
+                "Seller": "测试销售方",
+                "VatElectronicItems": [{
+                    "Name": "*办公用品*纸张", "Specification": "", "Unit": "包",
+                    "Quantity": "1", "Price": "100", "Total": "100", "TaxRate": "6%", "Tax": "6",
+                }],
+            },
+        },
+        "Page": 1,
+        "SubType": "VatElectronicInvoiceFull",
+        "TypeDescription": "增值税发票",
+        "CutImage": "",
+        "SubTypeDescription": "电子发票(普通发票)",
+        "ItemPolygon": [
+            {"Row": 0, "Key": {"AutoName": "发票号码"}, "Value": {"AutoContent": number},
+             "Polygon": polygon(x + 10, y + 10, 100, 20)},
+        ],
+    }
+
+
+def response(*items):
+    return {"MixedInvoiceItems": list(items), "TotalPDFCount": 0, "RequestId": "test"}
+
+
+def test_assign_regions_from_polygons():
+    items = [invoice_item("1", 90, 90, 580, 380), invoice_item("2", 770, 100, 480, 660)]
+    rects = [TencentOCR._polygon_rect(item["Polygon"]) for item in items]
+    assert rects == [(90, 90, 580, 380), (770, 100, 480, 660)]
+    assert assign_regions(rects, BOXES) == [[0], [1], []]
+
+
+def test_assign_regions_ambiguous():
+    # 跨越前两张图片
+    assert assign_regions([(500, 100, 400, 200)], BOXES) == [None, None, []]
+    # 不在任何图片内 / 缺少位置
+    assert assign_regions([(0, 0, 50, 50)], BOXES) == [None, None, None]
+    assert assign_regions([None], BOXES) == [None, None, None]
+
+
+def test_split_batch_response():
+    results = TencentOCR.split_batch_response(response(
+        invoice_item("1", 90, 90, 580, 380),
+        invoice_item("2", 770, 100, 480, 660),
+        invoice_item("3", 100, 870, 200, 100),
+        invoice_item("4", 400, 870, 200, 100),
+    ), BOXES)
+    assert results[2] is None  # 一张图片中识别出两张发票
+
+    item = results[0][0]["MixedInvoiceItems"][0]
+    assert item["Polygon"]["LeftTop"] == {"X": 10, "Y": 10}
+    assert item["Polygon"]["RightBottom"] == {"X": 590, "Y": 390}
+    assert item["ItemPolygon"][0]["Polygon"]["LeftTop"] == {"X": 20, "Y": 20}
+    assert results[1][0]["MixedInvoiceItems"][0]["Polygon"]["LeftTop"] == {"X": 10, "Y": 20}
+    assert results[0][0]["RequestId"] == "test"
+
+    assert TencentOCR.parse_pages(results[0]).number == "1"
+    assert TencentOCR.parse_pages(results[1]).number == "2"
+
+
+def test_split_batch_response_without_polygon():
+    item = invoice_item("1", 90, 90, 580, 380)
+    del item["Polygon"]
+    assert TencentOCR.split_batch_response(response(item), BOXES) == [None, None, None]